@@ -0,0 +1,51 @@
+'''
+Sends a report to many synthetic recipients through email_report's delivery module and the fake SendGrid,
+then drains the retry queue, and reports the time, requests and recipients for each pass
+Needs the sendgrid package (pip install -r email_report/requirements.txt)
+
+Run from the repository root:
+    python benchmarks/bench_delivery.py
+    python benchmarks/bench_delivery.py --recipients 50000 --latency 0.2 --throttle 0.2 --rate 20 --concurrency 8
+'''
+import argparse, os, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "email_report"))
+import delivery, storage
+from fake_sendgrid import FakeSendGrid
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--recipients", type=int, default=10000)
+    parser.add_argument("--latency", type=float, default=0.1)
+    parser.add_argument("--throttle", type=float, default=0.1, help="share of requests the fake answers with 429")
+    parser.add_argument("--rate", type=float, default=delivery.default_rate, help="requests per second")
+    parser.add_argument("--concurrency", type=int, default=delivery.default_concurrency)
+    args = parser.parse_args()
+
+    fake = FakeSendGrid(latency=args.latency, throttle=args.throttle).start()
+    os.environ.update({ delivery.host_variable : fake.url, delivery.rate_variable : str(args.rate), delivery.concurrency_variable : str(args.concurrency), "SENDGRID_API_KEY" : "fake" })
+    storage.set_backend(storage.MemoryBackend())
+
+    recipients = ["subscriber{0}@example.com".format(i) for i in range(args.recipients)]
+    html = "<p>" + "x" * 8000 + "</p>"
+    text = "x" * 2000
+
+    print("{0:>8} {1:>8} {2:>8} {3:>8} {4:>8} {5:>9}".format("pass", "seconds", "requests", "sent", "queued", "failed"))
+    start = time.perf_counter()
+    summary = delivery.deliver("report@example.com", recipients, "Benchmark", html, text)
+    print("{0:>8} {1:>8.2f} {2:>8} {3:>8} {4:>8} {5:>9}".format("deliver", time.perf_counter() - start, fake.requests, summary["sent"], summary["queued"], summary["failed"]))
+
+    retry = 0
+    while summary["queued"] and retry < delivery.max_attempts:
+        retry += 1
+        requests = fake.requests
+        start = time.perf_counter()
+        summary = delivery.retry_queued(now=time.time() + delivery.backoff * 2 ** retry)    # pretend the backoff has passed
+        print("{0:>8} {1:>8.2f} {2:>8} {3:>8} {4:>8} {5:>9}".format("retry " + str(retry), time.perf_counter() - start, fake.requests - requests, summary["sent"], summary["queued"], summary["failed"]))
+
+    print("fake SendGrid: {0} requests, {1:.1f} MB received, statuses {2}, {3} of {4} recipients accepted".format(
+        fake.requests, fake.bytes_received / 1e6, fake.statuses, fake.recipients, args.recipients))
+    fake.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+'''
+Compares the old ArcGIS path (decode the whole body, then a nested loop over features and zips)
+with the new one (stream the features array through a set lookup) on synthetic payloads
+
+Run from the repository root:
+    python benchmarks/bench_filter.py
+    python benchmarks/bench_filter.py --features 10000 100000 --zips 5 500
+'''
+import argparse, io, json, os, sys, time, tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "check_safety"))
+import arcgis
+
+'''
+Takes a number of features
+Returns the bytes of an ArcGIS-style query response with that many features, one per zip starting at 90000
+'''
+def make_payload(feature_count):
+    features = [{ "attributes" : { "Zip_Number" : 90000 + i, "Population" : 30000, "Cases" : i % 1000, "CaseRates" : 1.5 }} for i in range(feature_count)]
+    response = { "objectIdFieldName" : "FID", "fields" : [{ "name" : "Zip_Number" }], "features" : features }
+    return json.dumps(response).encode()
+
+'''
+The path check_safety used before features were streamed and indexed
+'''
+def old_path(payload, zip_codes_to_keep):
+    data = json.loads(payload.decode())
+
+    filtered_data = dict()
+    for entry in data["features"]:
+        for zip in zip_codes_to_keep:
+            if "attributes" in entry and "Zip_Number" in entry["attributes"] and entry["attributes"]["Zip_Number"] == zip:
+                filtered_data.update({ zip : entry["attributes"] })
+    return filtered_data
+
+def new_path(payload, zip_codes_to_keep):
+    return arcgis.filter_features(arcgis.iter_features(io.BytesIO(payload)), zip_codes_to_keep)
+
+'''
+Takes a function and its arguments
+Returns (result, seconds, peak bytes allocated while it ran)
+'''
+def measure(function, *args):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = function(*args)
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, seconds, peak
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--features", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--zips", type=int, nargs="+", default=[5, 100])
+    args = parser.parse_args()
+
+    print("{0:>9} {1:>5} {2:>10} {3:>10} {4:>12} {5:>12}".format("features", "zips", "old s", "new s", "old peak MB", "new peak MB"))
+    for feature_count in args.features:
+        payload = make_payload(feature_count)
+        for zip_count in args.zips:
+            step = max(1, feature_count // zip_count)
+            zip_codes_to_keep = [90000 + i * step for i in range(zip_count)]
+
+            old_result, old_seconds, old_peak = measure(old_path, payload, zip_codes_to_keep)
+            new_result, new_seconds, new_peak = measure(new_path, payload, zip_codes_to_keep)
+            assert old_result == new_result
+
+            print("{0:>9} {1:>5} {2:>10.3f} {3:>10.3f} {4:>12.1f} {5:>12.1f}".format(feature_count, zip_count, old_seconds, new_seconds, old_peak / 1e6, new_peak / 1e6))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,341 @@
+'''
+End-to-end benchmark of both functions, with no cloud access: check_safety against benchmarks/fake_arcgis.py,
+email_report against benchmarks/fake_sendgrid.py, and both against one in-process memory backend that counts every storage call
+
+Scenarios, each run --repeat times (the median is reported):
+    check_safety changed     new data upstream, so fetch, compute and write
+    check_safety unchanged   the same data again, answered with 304s
+    check_safety duplicate   a repeated trigger on a day that is already done, answered from the run lease
+    render_reports           the day_computed event from the last changed run, rendered and stored as report artifacts
+    email_report             every subscriber, over a few dozen zip sets
+The event bus is the local one (EVENT_BUS=local), with check_safety's events held until the render_reports scenario runs
+Both functions run warm, the way a reused Cloud Functions instance does (connections and clients are kept between runs),
+except that the render cache is cleared so rendering is measured
+
+Per-stage times come from wrapping the functions that do each stage (fetch, filter, merge, history, compute, write, render, send)
+filter is the time spent parsing and filtering ArcGIS responses, which happens while they are downloaded, so it overlaps fetch
+
+Results can be saved and compared, to catch regressions between commits (run both on the same machine):
+    python benchmarks/bench_pipeline.py --save before.json
+    python benchmarks/bench_pipeline.py --compare before.json
+Needs numpy and sendgrid (pip install -r check_safety/requirements.txt -r email_report/requirements.txt)
+Each function runs with its own directory's copies of the shared files, so it refuses to run while they differ (see shared.py)
+'''
+import argparse, json, os, random, statistics, subprocess, sys, tempfile, threading, time
+from collections import Counter
+
+benchmarks_directory = os.path.dirname(os.path.abspath(__file__))
+repository_directory = os.path.dirname(benchmarks_directory)
+sys.path.insert(0, benchmarks_directory)
+from fake_arcgis import FakeArcGIS
+from fake_sendgrid import FakeSendGrid
+
+# modules that exist in both function directories, so each function gets its own copy
+shared_modules = ["main", "storage", "regions", "events"]
+stages = ["fetch", "filter", "merge", "history", "compute", "write", "render", "send"]
+
+'''
+Wraps a storage backend, counting round trips (calls) per method and the JSON size of the documents read and written
+'''
+class CountingBackend:
+    writes = ("set", "set_all", "create", "set_all_if")
+
+    def __init__(self, inner):
+        self.inner = inner
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.calls = Counter()
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def __getattr__(self, name):
+        method = getattr(self.inner, name)
+
+        def counted(*args):
+            written = _size(args[-1]) if name in self.writes else 0
+            result = method(*args)
+            read = _size(result) if name not in self.writes else 0
+            if result is False:     # a create or set_all_if that didn't write
+                written = 0
+            with self._lock:
+                self.calls[name] += 1
+                self.bytes_written += written
+                self.bytes_read += read
+            return result
+        return counted
+
+'''
+Accumulates the time spent in wrapped functions, per stage
+'''
+class StageTimer:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.seconds = Counter()
+
+    def wrap(self, module, name, stage):
+        function = getattr(module, name)
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self.seconds[stage] += time.perf_counter() - start
+        setattr(module, name, timed)
+
+    def reset(self):
+        self.seconds = Counter()
+
+def _size(value):
+    if value is None:
+        return 0
+    if isinstance(value, dict) and value and isinstance(next(iter(value)), tuple):
+        value = list(value.values())    # get_all is keyed by (collection, document)
+    return len(json.dumps(value, default=str))
+
+'''
+Takes a function directory (e.g. "check_safety") and the names of the modules to import from it
+Returns a dict of { name : module }, imported fresh, so both functions' copies of main, storage and regions can be loaded side by side
+'''
+def load_function(directory, names):
+    for name in shared_modules + names:
+        sys.modules.pop(name, None)
+    sys.path.insert(0, os.path.join(repository_directory, directory))
+    try:
+        return { name : __import__(name) for name in names }
+    finally:
+        sys.path.pop(0)
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=repository_directory, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+'''
+Takes the check_safety modules, the backend, the fake ArcGIS and the number of days to seed
+Writes days_of_history days of raw snapshots before today and replays them, so check_safety has real history to read
+'''
+def seed_history(check_safety, backend, arcgis_server, days_of_history):
+    main = check_safety["main"]
+    today = main.days_since_epoch()
+    region_zips = check_safety["regions"].all_regions()
+    zips = sorted(set(zip for region in region_zips for zip in region_zips[region]))     # snapshots only hold the zips check_safety keeps
+
+    writes = list()
+    for day in range(today - days_of_history, today):
+        features = { zip : arcgis_server._feature(zip)["attributes"] for zip in zips }
+        for zip in features:
+            features[zip] = dict(features[zip], Cases=features[zip]["Cases"] - (today - day) * 3)
+        layer1 = { str(zip) : { field : features[zip][field] for field in ("Zip_Number", "Population", "Cases", "CaseRates") } for zip in zips }
+        layer2 = { str(zip) : { field : features[zip][field] for field in ("Zip_Number", "Positives", "NumberOfTests") } for zip in zips }
+        writes.append((main.raw_collection, day, { "date" : main.day_to_date(day), "layers" : [layer1, layer2] }))
+    backend.set_all(writes)
+    main.replay(today - days_of_history, today - 1)
+
+def measure(run, timer, backend, servers):
+    timer.reset()
+    backend.reset()
+    for server in servers:
+        if hasattr(server, "reset_counters"):
+            server.reset_counters()
+    sent_before = servers[-1].bytes_received
+
+    start = time.perf_counter()
+    run()
+    total = time.perf_counter() - start
+
+    result = { "total" : total }
+    result.update({ stage : timer.seconds.get(stage, 0.0) for stage in stages })
+    result["db_round_trips"] = sum(backend.calls.values())
+    result["db_bytes_read"] = backend.bytes_read
+    result["db_bytes_written"] = backend.bytes_written
+    result["arcgis_requests"] = servers[0].requests
+    result["arcgis_bytes"] = servers[0].bytes_sent
+    result["sendgrid_bytes"] = servers[-1].bytes_received - sent_before
+    return result
+
+def median_of(runs):
+    return { key : statistics.median(run[key] for run in runs) for key in runs[0] }
+
+def print_results(results):
+    columns = ["total"] + stages
+    print("{0:<24}".format("seconds") + "".join("{0:>9}".format(column) for column in columns))
+    for scenario in results:
+        print("{0:<24}".format(scenario) + "".join("{0:>9.3f}".format(results[scenario][column]) for column in columns))
+    print()
+    counts = ["db_round_trips", "db_bytes_read", "db_bytes_written", "arcgis_requests", "arcgis_bytes", "sendgrid_bytes"]
+    print("{0:<24}".format("counts") + "".join("{0:>17}".format(column) for column in counts))
+    for scenario in results:
+        print("{0:<24}".format(scenario) + "".join("{0:>17,.0f}".format(results[scenario][column]) for column in counts))
+
+'''
+Prints each timing against the baseline, and returns the list of (scenario, measure) that got slower than threshold allows
+Counts (round trips, bytes) are compared exactly, since they don't depend on the machine
+'''
+def compare(results, baseline, threshold):
+    regressions = list()
+    print()
+    print("compared with {0} (commit {1})".format(baseline.get("file"), baseline.get("commit")))
+    for scenario in results:
+        if scenario not in baseline["results"]:
+            continue
+        before = baseline["results"][scenario]
+        for key in results[scenario]:
+            if key not in before:
+                continue
+            old, new = before[key], results[scenario][key]
+            if key in ["total"] + stages:
+                worse = old > 0.001 and new > old * threshold
+                change = "{0:+.0%}".format(new / old - 1) if old > 0 else "n/a"
+            else:
+                worse = new > old
+                change = "{0:+,.0f}".format(new - old)
+            if worse or key in ("total", "db_round_trips"):
+                print("  {0:<24} {1:<18} {2:>12.4g} -> {3:<12.4g} {4:>8}{5}".format(scenario, key, old, new, change, "  REGRESSION" if worse else ""))
+            if worse:
+                regressions.append((scenario, key))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--features", type=int, default=5000, help="features (zips) in each ArcGIS layer")
+    parser.add_argument("--regions", type=int, default=3, help="configured regions")
+    parser.add_argument("--zips-per-region", type=int, default=20)
+    parser.add_argument("--subscribers", type=int, default=5000)
+    parser.add_argument("--zip-sets", type=int, default=30, help="distinct zip sets chosen by subscribers")
+    parser.add_argument("--history", type=int, default=60, help="days of history before today")
+    parser.add_argument("--arcgis-latency", type=float, default=0.05)
+    parser.add_argument("--page-size", type=int, default=2000, help="the fake layer's maxRecordCount")
+    parser.add_argument("--unfiltered", action="store_true", help="have the fake send whole layers, ignoring the where clause")
+    parser.add_argument("--sendgrid-latency", type=float, default=0.05)
+    parser.add_argument("--send-rate", type=float, default=0, help="SendGrid requests per second (0 for no limit)")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="compare with results saved by --save")
+    parser.add_argument("--threshold", type=float, default=1.25, help="how much slower a timing can get before it counts as a regression")
+    args = parser.parse_args()
+
+    sys.path.insert(0, repository_directory)
+    import shared
+    differing = shared.differing_copies()
+    if differing:
+        sys.exit("The shared files differ between the function directories (run python shared.py sync): " + ", ".join(copy for source, copy in differing))
+
+    arcgis_server = FakeArcGIS(features=args.features, latency=args.arcgis_latency, page_size=args.page_size, unfiltered=args.unfiltered).start()
+    sendgrid_server = FakeSendGrid(latency=args.sendgrid_latency).start()
+    servers = [arcgis_server, sendgrid_server]
+
+    chooser = random.Random(args.seed)
+    zips = arcgis_server.zips()
+    region_zips = { "region-{0}".format(i) : sorted(chooser.sample(zips, args.zips_per_region)) for i in range(args.regions) }
+    regions_file = tempfile.NamedTemporaryFile("w", suffix=".json", delete=False)
+    json.dump(region_zips, regions_file)
+    regions_file.close()
+    os.environ.update({ "REGIONS_FILE" : regions_file.name, "SENDGRID_HOST" : sendgrid_server.url, "SENDGRID_API_KEY" : "fake",
+        "SENDGRID_REQUESTS_PER_SECOND" : str(args.send_rate), "SENDGRID_CONCURRENCY" : "8", "EVENT_BUS" : "local" })
+
+    backend = CountingBackend(None)
+    timer = StageTimer()
+
+    email_report = load_function("email_report", ["main", "storage", "subscribers", "planner", "render", "delivery", "artifacts"])
+    check_safety = load_function("check_safety", ["main", "storage", "regions", "arcgis", "metrics", "events"])
+    published = list()
+    check_safety["events"].subscribe(lambda event, context: published.append(event))
+    backend.inner = check_safety["storage"].MemoryBackend()
+    email_report["storage"].set_backend(backend)
+    check_safety["storage"].set_backend(backend)
+    check_safety["arcgis"].service_url = arcgis_server.url
+
+    zip_sets = [sorted(chooser.sample(zips, chooser.randint(1, args.zips_per_region))) for i in range(max(args.zip_sets - args.regions, 0))]
+    choices = [{ "region" : region } for region in region_zips] + [{ "zips" : zip_set } for zip_set in zip_sets]
+    for i in range(args.subscribers):
+        email_report["subscribers"].subscribe("subscriber{0}@example.com".format(i), **choices[i % len(choices)])
+    seed_history(check_safety, backend, arcgis_server, args.history)
+
+    timer.wrap(check_safety["main"], "pull_filtered_data", "fetch")
+    timer.wrap(check_safety["arcgis"], "read_page", "filter")
+    timer.wrap(check_safety["main"], "merge_data", "merge")
+    timer.wrap(check_safety["main"], "read_upstream_cache", "history")
+    timer.wrap(check_safety["main"], "read_history_from_db", "history")
+    timer.wrap(check_safety["main"], "compute_region", "compute")
+    timer.wrap(check_safety["main"], "write_to_db", "write")
+    timer.wrap(email_report["planner"], "read_documents", "history")
+    timer.wrap(email_report["artifacts"], "read_current", "history")
+    timer.wrap(email_report["artifacts"], "store", "write")
+    timer.wrap(email_report["render"], "render_report", "render")
+    timer.wrap(email_report["delivery"], "send_all", "send")
+
+    request = type("Request", (), { "args" : {}, "get_json" : lambda self, silent=False: { "fromEmail" : "report@example.com" } })()
+    quiet = open(os.devnull, "w")
+
+    def run_check_safety(publish, day_done=False):
+        if publish:
+            arcgis_server.publish()
+        # every run is on the same day, so each one starts from that day's lease being free (or, for a duplicate, done)
+        today = check_safety["main"].days_since_epoch()
+        backend.inner.delete(check_safety["main"].runs_collection, today)
+        if day_done:
+            backend.inner.set(check_safety["main"].runs_collection, today, { "state" : "done", "result" : "done" })
+        stdout, sys.stdout = sys.stdout, quiet
+        try:
+            check_safety["main"].check_safety(None)
+        finally:
+            sys.stdout = stdout
+
+    def run_render_reports():
+        email_report["render"]._cache.clear()
+        stdout, sys.stdout = sys.stdout, quiet
+        try:
+            email_report["main"].render_reports(published[-1], None)
+        finally:
+            sys.stdout = stdout
+
+    def run_email_report():
+        email_report["render"]._cache.clear()
+        stdout, sys.stdout = sys.stdout, quiet
+        try:
+            email_report["main"].email_report(request)
+        finally:
+            sys.stdout = stdout
+
+    scenarios = [
+        ("check_safety changed", lambda: run_check_safety(True)),
+        ("check_safety unchanged", lambda: run_check_safety(False)),
+        ("check_safety duplicate", lambda: run_check_safety(False, day_done=True)),
+        ("render_reports", run_render_reports),
+        ("email_report", run_email_report),
+    ]
+    run_check_safety(True)      # warm up connections and imports
+
+    results = dict()
+    for name, run in scenarios:
+        results[name] = median_of([measure(run, timer, backend, servers) for i in range(args.repeat)])
+
+    print("commit {0}, {1} features, {2} regions + {3} zip sets, {4} subscribers, median of {5}".format(
+        git_commit(), args.features, args.regions, args.zip_sets - args.regions, args.subscribers, args.repeat))
+    print_results(results)
+
+    regressions = list()
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        baseline["file"] = args.compare
+        regressions = compare(results, baseline, args.threshold)
+
+    if args.save:
+        with open(args.save, "w") as save_file:
+            json.dump({ "commit" : git_commit(), "arguments" : vars(args), "results" : results }, save_file, indent=2)
+
+    arcgis_server.stop()
+    sendgrid_server.stop()
+    os.unlink(regions_file.name)
+    if regressions:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
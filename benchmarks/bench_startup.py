@@ -0,0 +1,112 @@
+'''
+Measures cold starts: each function is started in a fresh interpreter (python -X importtime), imported, and sent its first request
+against the fakes, the way a new Cloud Functions instance would be, and this reports
+    process      wall time for the whole interpreter, start to exit
+    import       time to import the function's main module
+    first call   time from the import to the first response
+plus the import-time breakdown: what importing main costs, module by module, and what is imported lazily during the first request
+
+Run from the repository root, and save a run to compare cold starts across commits:
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --repeat 10 --top 15 --save startup.json
+'''
+import argparse, json, os, re, statistics, subprocess, sys, time
+
+benchmarks_directory = os.path.dirname(os.path.abspath(__file__))
+repository_directory = os.path.dirname(benchmarks_directory)
+sys.path.insert(0, benchmarks_directory)
+from fake_arcgis import FakeArcGIS
+from fake_sendgrid import FakeSendGrid
+
+_import_line = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)$")
+
+# run in the function's directory: import main, then make its first call, with the function's own output kept out of ours
+child_code = """
+import json, os, sys, time
+started = time.perf_counter()
+import main
+imported = time.perf_counter()
+{setup}
+output, sys.stdout = sys.stdout, open(os.devnull, "w")
+{call}
+responded = time.perf_counter()
+sys.stdout = output
+print(json.dumps({{ "import" : (imported - started) * 1000, "first call" : (responded - imported) * 1000 }}))
+"""
+
+functions = {
+    "check_safety" : ("import arcgis; arcgis.service_url = os.environ['FAKE_ARCGIS_URL']", "main.check_safety(None)"),
+    "email_report" : (
+        "import storage; storage.get_backend().set(main.database_name, str(main.days_since_epoch()), { 'date' : '2020-12-04', 'zips' : [94601] })\n"
+        "request = type('Request', (), { 'args' : {}, 'get_json' : lambda self, silent=False: { 'fromEmail' : 'report@example.com', 'toEmails' : 'someone@example.com' } })()",
+        "main.email_report(request)"),
+}
+
+'''
+Takes the stderr of python -X importtime
+Returns (a list of (module, cumulative ms) imported directly by main, a list of (module, cumulative ms) imported after main finished importing)
+'''
+def import_breakdown(stderr):
+    entries = list()
+    for line in stderr.splitlines():
+        match = _import_line.match(line)
+        if match is not None:
+            entries.append((len(match.group(3)) // 2, match.group(4), int(match.group(2)) / 1000))
+
+    main_index = next(index for index, (level, module, cumulative) in enumerate(entries) if level == 0 and module == "main")
+    first = main_index
+    while first > 0 and entries[first - 1][0] > 0:
+        first -= 1
+
+    by_main = [(module, cumulative) for level, module, cumulative in entries[first:main_index] if level == 1]
+    lazily = [(module, cumulative) for level, module, cumulative in entries[main_index + 1:] if level == 0]
+    return by_main, lazily
+
+def run_once(function, environment):
+    setup, call = functions[function]
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", child_code.format(setup=setup, call=call)],
+        cwd=os.path.join(repository_directory, function), env=environment, capture_output=True, text=True)
+    wall = (time.perf_counter() - start) * 1000
+    if process.returncode != 0:
+        raise RuntimeError("{0} failed:\n{1}".format(function, process.stderr[-2000:]))
+
+    times = json.loads(process.stdout.strip().splitlines()[-1])
+    times["process"] = wall
+    return times, import_breakdown(process.stderr)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10, help="modules to list in each breakdown")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    arcgis_server = FakeArcGIS(features=200).start()
+    sendgrid_server = FakeSendGrid().start()
+    environment = dict(os.environ, STORAGE_BACKEND="memory", FAKE_ARCGIS_URL=arcgis_server.url,
+        SENDGRID_HOST=sendgrid_server.url, SENDGRID_API_KEY="fake", EVENT_BUS="local", REGIONS_FILE=os.path.join(repository_directory, "check_safety", "regions.json"))
+
+    results = dict()
+    for function in functions:
+        runs = [run_once(function, environment) for i in range(args.repeat)]
+        times = { key : statistics.median(run[0][key] for run in runs) for key in ["process", "import", "first call"] }
+        by_main, lazily = runs[-1][1]
+        results[function] = { "ms" : times, "imported_by_main" : dict(by_main), "imported_on_first_call" : dict(lazily) }
+
+        print("{0}: process {1:.0f} ms, import {2:.0f} ms, first call {3:.0f} ms (median of {4})".format(function, times["process"], times["import"], times["first call"], args.repeat))
+        for title, modules in [("imported by main", by_main), ("imported on the first call", lazily)]:
+            print("  {0}:".format(title))
+            for module, cumulative in sorted(modules, key=lambda item: -item[1])[:args.top]:
+                print("    {0:>8.1f} ms  {1}".format(cumulative, module))
+        print()
+
+    if args.save:
+        with open(args.save, "w") as save_file:
+            json.dump(results, save_file, indent=2)
+
+    arcgis_server.stop()
+    sendgrid_server.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+'''
+Offline checks of check_safety against recorded source payloads, with the memory backend and no network access
+Each case is a directory in benchmarks/fixtures with a sources.json, a regions.json and one directory of payloads per day (day-1, day-2, ...),
+which check_safety ingests in order as consecutive days (see SOURCES_FIXTURES in check_safety/sources.py)
+
+    outage   the tests feed is missing on day 2 and has nothing cached: that day is skipped for the region rather than stored with
+             zero tests, and day 3's changes are counted from day 1, so neither the daily changes nor the running totals jump
+
+Run from the repository root:
+    python benchmarks/check_fixtures.py
+Exits with 1 if any check fails
+'''
+import os, sys
+
+benchmarks_directory = os.path.dirname(os.path.abspath(__file__))
+fixtures_directory = os.path.join(benchmarks_directory, "fixtures")
+first_day = 18600       # 2020-12-04
+
+'''
+Takes a case's name
+Runs check_safety on each of its days, and returns a dict of { region : { day : document } } for what it stored
+'''
+def run_case(case):
+    directory = os.path.join(fixtures_directory, case)
+    os.environ.update({ "STORAGE_BACKEND" : "memory", "EVENT_BUS" : "off", "INSTRUMENTATION" : "off",
+        "REGIONS_FILE" : os.path.join(directory, "regions.json"), "SOURCES_FILE" : os.path.join(directory, "sources.json") })
+    sys.path.insert(0, os.path.join(benchmarks_directory, "..", "check_safety"))
+    import main, regions, storage
+
+    day_directories = sorted(name for name in os.listdir(directory) if name.startswith("day-"))
+    for index, name in enumerate(day_directories):
+        os.environ["SOURCES_FIXTURES"] = os.path.join(directory, name)
+        main.days_since_epoch = lambda day=first_day + index: day
+        main.check_safety(None)
+
+    backend = storage.get_backend()
+    return { region : backend.scan(regions.region_collection(region), 0, first_day + len(day_directories)) for region in regions.all_regions() }
+
+'''
+Returns a list of the checks that failed in the outage case
+'''
+def check_outage():
+    documents = run_case("outage")["oakland"]
+    expected = {
+        first_day : { "positive_tests" : 100, "total_tests" : 1000, "total_cases" : 1400, "new_positives" : None },
+        first_day + 2 : { "positive_tests" : 130, "total_tests" : 4000, "total_cases" : 1435,
+            "new_positives" : 30, "new_total_tests" : 3000, "new_cases" : 35,
+            "prefix_sum_new_positives" : 30, "prefix_count_new_positives" : 2, "prefix_sum_new_cases" : 35 },
+    }
+
+    failures = list()
+    if sorted(documents) != sorted(expected):
+        failures.append("outage: documents for days {0}, expected {1}".format(sorted(documents), sorted(expected)))
+    for day in expected:
+        for metric, value in expected[day].items():
+            found = documents.get(day, dict()).get(metric)
+            if found != value:
+                failures.append("outage: day {0} {1} is {2}, expected {3}".format(day - first_day + 1, metric, found, value))
+    return failures
+
+if __name__ == "__main__":
+    failures = check_outage()
+    for failure in failures:
+        print(failure)
+    print("{0} check(s) failed".format(len(failures)) if failures else "All checks passed")
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,146 @@
+'''
+A stand-in for the ArcGIS FeatureServer check_safety queries, for running it locally and in benchmarks
+Each layer holds one feature per zip, starting at first_zip, with the fields of both of the real layers
+It understands the parts of the query API check_safety uses: where Zip_Number IN (...), resultOffset, returnCountOnly,
+ETag / If-None-Match and gzip, and pages its answers like a layer with a maxRecordCount
+
+Run it on its own and point check_safety at it (arcgis.service_url):
+    python benchmarks/fake_arcgis.py --port 8026 --features 50000 --latency 0.1 --page-size 1000
+'''
+import argparse, gzip, json, re, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+first_zip = 10000
+_layer_path = re.compile(r"^/FeatureServer/(\d+)/query$")
+_zip_list = re.compile(r"Zip_Number IN \(([\d, ]*)\)")
+
+'''
+Runs the fake in a background thread
+features: number of features (zips) in each layer, latency: seconds to wait before answering each request,
+page_size: the most features sent in one answer (the layer's maxRecordCount),
+unfiltered: ignore the where clause and send every feature, the way check_safety used to download the whole county
+'''
+class FakeArcGIS:
+    def __init__(self, port=0, features=1000, latency=0.0, page_size=2000, unfiltered=False):
+        self.features = features
+        self.latency = latency
+        self.page_size = page_size
+        self.unfiltered = unfiltered
+        self.version = 1        # the ETag; bump it (and cases) to publish new data
+        self.cases = 0          # added to every feature's Cases and Positives
+        self.requests = 0
+        self.not_modified = 0
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self.server.daemon_threads = True
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{0}/FeatureServer".format(self.server.server_address[1])
+
+    def zips(self):
+        return list(range(first_zip, first_zip + self.features))
+
+    def publish(self, new_cases=10):
+        with self._lock:
+            self.version += 1
+            self.cases += new_cases
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset_counters(self):
+        with self._lock:
+            self.requests = 0
+            self.not_modified = 0
+            self.bytes_sent = 0
+
+    def _record(self, size, status):
+        with self._lock:
+            self.requests += 1
+            self.bytes_sent += size
+            if status == 304:
+                self.not_modified += 1
+
+    def _feature(self, zip):
+        index = zip - first_zip
+        cases = 500 + index % 1000 + self.cases
+        return { "attributes" : { "Zip_Number" : zip, "Population" : 30000 + index % 5000, "Cases" : cases, "CaseRates" : cases / 300.0,
+            "Positives" : cases - 100, "NumberOfTests" : 20000 + index % 3000 + self.cases * 5 }}
+
+    def _answer(self, parameters):
+        zips = self.zips()
+        where = _zip_list.search(parameters.get("where", [""])[0])
+        if where is not None and not self.unfiltered:
+            wanted = set(int(zip) for zip in where.group(1).split(",") if zip.strip())
+            zips = [zip for zip in zips if zip in wanted]
+
+        if parameters.get("returnCountOnly", [""])[0] == "true":
+            return { "count" : len(zips) }
+
+        offset = int(parameters.get("resultOffset", ["0"])[0])
+        page = zips[offset:offset + self.page_size]
+        answer = { "objectIdFieldName" : "FID", "fields" : [{ "name" : "Zip_Number" }], "features" : [self._feature(zip) for zip in page] }
+        if offset + self.page_size < len(zips):
+            answer["exceededTransferLimit"] = True
+        return answer
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                time.sleep(fake.latency)
+                parts = urlsplit(self.path)
+                etag = '"v{0}"'.format(fake.version)
+
+                if _layer_path.match(parts.path) is None:
+                    self.reply(404, b"", etag)
+                elif self.headers.get("If-None-Match") == etag:
+                    self.reply(304, b"", etag)
+                else:
+                    self.reply(200, json.dumps(fake._answer(parse_qs(parts.query))).encode(), etag)
+
+            def reply(self, status, body, etag):
+                self.send_response(status)
+                if status == 200 and "gzip" in self.headers.get("Accept-Encoding", ""):
+                    body = gzip.compress(body, compresslevel=5)
+                    self.send_header("Content-Encoding", "gzip")
+                self.send_header("ETag", etag)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                fake._record(len(body), status)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8026)
+    parser.add_argument("--features", type=int, default=1000)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--page-size", type=int, default=2000)
+    parser.add_argument("--unfiltered", action="store_true")
+    args = parser.parse_args()
+
+    fake = FakeArcGIS(args.port, args.features, args.latency, args.page_size, args.unfiltered)
+    print("Fake ArcGIS listening on {0} with zips {1} to {2}".format(fake.url, first_zip, first_zip + args.features - 1))
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
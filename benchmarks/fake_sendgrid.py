@@ -0,0 +1,111 @@
+'''
+A stand-in for SendGrid's v3 mail/send endpoint, for running email_report delivery locally and in benchmarks
+It accepts the same request bodies, answers 202 after a configurable latency, and can answer 429 or 500 to a share of requests
+Nothing is ever sent
+
+Run it on its own and point email_report at it:
+    python benchmarks/fake_sendgrid.py --port 8025 --latency 0.05 --throttle 0.1
+    SENDGRID_HOST=http://127.0.0.1:8025 SENDGRID_API_KEY=fake ...
+'''
+import argparse, json, random, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+max_personalizations = 1000
+
+'''
+Runs the fake in a background thread
+latency: seconds to wait before answering each request
+throttle: share of requests answered with 429, error: share answered with 500
+'''
+class FakeSendGrid:
+    def __init__(self, port=0, latency=0.0, throttle=0.0, error=0.0):
+        self.latency = latency
+        self.throttle = throttle
+        self.error = error
+        self.requests = 0
+        self.recipients = 0
+        self.statuses = dict()
+        self.bytes_received = 0
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self.server.daemon_threads = True
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{0}".format(self.server.server_address[1])
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _record(self, status, size, recipients):
+        with self._lock:
+            self.requests += 1
+            self.bytes_received += size
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+            if status == 202:
+                self.recipients += recipients
+
+    def _answer(self, body):
+        try:
+            message = json.loads(body)
+            personalizations = message["personalizations"]
+            if not 1 <= len(personalizations) <= max_personalizations or not message.get("from") or not message.get("content"):
+                return 400, 0
+        except (ValueError, KeyError, TypeError):
+            return 400, 0
+
+        roll = random.random()
+        if roll < self.throttle:
+            return 429, 0
+        elif roll < self.throttle + self.error:
+            return 500, 0
+        return 202, sum(len(personalization.get("to", [])) for personalization in personalizations)
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if self.path.rstrip("/") != "/v3/mail/send":
+                    status, recipients = 404, 0
+                else:
+                    time.sleep(fake.latency)
+                    status, recipients = fake._answer(body)
+                fake._record(status, len(body), recipients)
+
+                reply = b"" if status == 202 else json.dumps({ "errors" : [{ "message" : "fake {0}".format(status) }] }).encode()
+                self.send_response(status)
+                self.send_header("Content-Length", str(len(reply)))
+                self.end_headers()
+                self.wfile.write(reply)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8025)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--throttle", type=float, default=0.0)
+    parser.add_argument("--error", type=float, default=0.0)
+    args = parser.parse_args()
+
+    fake = FakeSendGrid(args.port, args.latency, args.throttle, args.error)
+    print("Fake SendGrid listening on {0}".format(fake.url))
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,306 @@
+'''
+Querying ArcGIS feature layers for a set of zips, and reading the responses (f=json) without holding them in memory
+'''
+import codecs, json, re
+from urllib.parse import urlencode
+import fetch, instrument
+
+service_url = "https://services5.arcgis.com/ROBnTHSNjoZ2Wm1P/arcgis/rest/services/COVID_19_Statistics/FeatureServer"
+zip_field = "Zip_Number"    # the zip field of the layers at service_url
+zips_per_query = 200    # keeps the where clause, and so the URL, a sensible length
+chunk_size = 64 * 1024
+_whitespace = re.compile(r"[ \t\n\r]*")
+_separator = re.compile(r"[ \t\n\r]*([,\]])[ \t\n\r]*")
+_decoder = json.JSONDecoder()
+
+'''
+Takes a file-like object (e.g. an HTTP response) holding an ArcGIS query response
+metadata, an optional dict that gets every other top-level key of the response (e.g. exceededTransferLimit)
+Yields the entries of the "features" array one at a time, as they are read
+Only one feature (plus one chunk of the response) is held in memory at a time
+ArcGIS answers a failed query (e.g. a bad where clause or a permissions error) with HTTP 200 and an "error" object instead of features,
+so a response with an error, or without a features array, raises ArcGISError once it has been read, rather than reading as an empty layer
+'''
+def iter_features(stream, metadata=None):
+    reader = _Reader(stream)
+    metadata = dict() if metadata is None else metadata
+    has_features = False
+
+    reader.expect("{")
+    while reader.peek() != "}":
+        key = reader.value()
+        reader.expect(":")
+
+        if key == "features":
+            has_features = True
+            reader.expect("[")
+            if reader.peek() == "]":
+                reader.expect("]")
+            else:
+                yield from reader.array_items()
+        else:
+            metadata[key] = reader.value()
+
+        if reader.peek() != ",":
+            break
+        reader.expect(",")
+    reader.expect("}")
+
+    _raise_for_error(metadata)
+    if not has_features:
+        raise ArcGISError("ArcGIS response has no features")
+
+'''
+Raised for a response ArcGIS sent in place of the results of a query
+'''
+class ArcGISError(ValueError):
+    pass
+
+def _raise_for_error(response):
+    error = response.get("error")
+    if error is not None:
+        if isinstance(error, dict):
+            details = "; ".join(str(detail) for detail in error.get("details") or [])
+            raise ArcGISError("ArcGIS query failed: {0} {1}{2}".format(error.get("code", ""), error.get("message", ""), " (" + details + ")" if details else ""))
+        raise ArcGISError("ArcGIS query failed: {0}".format(error))
+
+'''
+Takes the body of a returnCountOnly query
+Returns the count, or raises ArcGISError if the query failed
+'''
+def read_count(body):
+    response = json.load(body)
+    _raise_for_error(response)
+    if "count" not in response:
+        raise ArcGISError("ArcGIS response has no count")
+    return response["count"]
+
+'''
+Takes an iterable of ArcGIS features, a list of zip codes, and the name of the field that holds the zip
+Returns a dict containing only the attributes for those zips (zip is the key, as an int)
+Looks each feature up in a set, so it costs the same no matter how many zips are kept
+A layer that stores zips as text (e.g. "94601" or "94601-1234") is matched on the first five digits
+'''
+def filter_features(features, zip_codes_to_keep, zip_field=zip_field):
+    zips = set(zip_codes_to_keep)
+    filtered_data = dict()
+
+    for entry in features:
+        attributes = entry.get("attributes")
+        if attributes is None:
+            continue
+        zip = attributes.get(zip_field)
+        if zip in zips:
+            filtered_data[zip] = attributes
+        elif isinstance(zip, str) and zip[:5].isdigit() and int(zip[:5]) in zips:
+            filtered_data[int(zip[:5])] = attributes
+
+    return filtered_data
+
+'''
+Takes the URL of a feature layer (e.g. service_url + "/0"), a list of zip codes, a list of fields to return,
+optionally the offset of the first record to return, whether to ask for just the number of records,
+the layer's zip field, and whether that field holds text (so the zips are compared quoted)
+Returns the URL of a query for just those zips and fields, so the server doesn't send the rest of the county
+'''
+def query_url(layer_url, zip_codes, out_fields, offset=0, count_only=False, zip_field=zip_field, text_zips=False):
+    quote = "'" if text_zips else ""
+    parameters = {
+        "where" : "{0} IN ({1})".format(zip_field, ",".join(quote + str(int(zip)) + quote for zip in zip_codes)),
+        "outFields" : ",".join(out_fields),
+        "orderByFields" : zip_field,     # paging is only stable with a fixed order
+        "returnGeometry" : "false",
+        "outSR" : "4326",
+        "f" : "json",
+    }
+    if offset > 0:
+        parameters["resultOffset"] = offset
+    if count_only:
+        parameters["returnCountOnly"] = "true"
+    return layer_url + "/query?" + urlencode(parameters)
+
+'''
+Takes a list of (layer URL, list of fields), a list of zip codes, optionally a cache dict (see below),
+and the layers' zip field and whether it holds text rather than numbers (see query_url)
+Returns a list with the filtered data for those zips (see filter_features) from each layer, in the same order
+
+The zips are sent to the server in the where clause, zips_per_query at a time
+A layer can send fewer records than were asked for (its maxRecordCount) and set exceededTransferLimit,
+so for those queries the record count is fetched and the rest of the pages are requested by resultOffset
+Each of those three steps fetches everything it needs at once, so there are at most three rounds of requests whatever the size of the layers
+
+The cache dict maps the URL of a query's first page to { "etag", "last_modified", "data" : the filtered data from every page of that query }
+When it is given, first pages are requested conditionally, a 304 reuses the cached data, and the cache is updated in place
+'''
+def fetch_layers(layers, zip_codes_to_keep, cache=None, zip_field=zip_field, text_zips=False):
+    zips = sorted(set(zip_codes_to_keep))
+    queries = [(index, layer_url, out_fields, chunk) for index, (layer_url, out_fields) in enumerate(layers) for chunk in _chunks(zips)]
+    zip_query = { "zip_field" : zip_field, "text_zips" : text_zips }
+    urls = [query_url(layer_url, chunk, out_fields, **zip_query) for index, layer_url, out_fields, chunk in queries]
+
+    read = lambda body: read_page(body, zips, zip_field)
+    if cache is None:
+        first_pages = fetch.fetch_all(urls, read)
+    else:
+        first_pages = _fetch_first_pages_conditional(urls, read, cache)
+
+    results = [dict() for layer in layers]
+    cut_short = list()
+    for query, url, (filtered_data, metadata, features_read) in zip(queries, urls, first_pages):
+        results[query[0]].update(filtered_data)
+        if metadata.get("exceededTransferLimit"):
+            cut_short.append((query, url, features_read))
+
+    if not cut_short:
+        return results
+
+    counts = fetch.fetch_all([query_url(layer_url, chunk, out_fields, count_only=True, **zip_query) for (index, layer_url, out_fields, chunk), first_url, features_read in cut_short], read_count)
+
+    more_pages = list()
+    for ((index, layer_url, out_fields, chunk), first_url, page_size), count in zip(cut_short, counts):
+        for offset in range(page_size, count, max(page_size, 1)):
+            more_pages.append((index, first_url, query_url(layer_url, chunk, out_fields, offset, **zip_query)))
+
+    pages = fetch.fetch_all([url for index, first_url, url in more_pages], read)
+    for (index, first_url, url), (filtered_data, metadata, features_read) in zip(more_pages, pages):
+        results[index].update(filtered_data)
+        if cache is not None:
+            cache[first_url]["data"].update(filtered_data)
+
+    return results
+
+'''
+Takes a layer URL, a list of zip codes, the fields, and the layer's zip field and whether it holds text (see query_url)
+Returns the URLs of the first pages fetch_layers requests for them, which are its keys in the cache dict
+'''
+def first_page_urls(layer_url, zip_codes_to_keep, out_fields, zip_field=zip_field, text_zips=False):
+    return [query_url(layer_url, chunk, out_fields, zip_field=zip_field, text_zips=text_zips) for chunk in _chunks(sorted(set(zip_codes_to_keep)))]
+
+def _chunks(zips):
+    return [zips[i:i + zips_per_query] for i in range(0, len(zips), zips_per_query)]
+
+'''
+Takes the URLs of first pages, the function that reads a page, and the cache dict from fetch_layers
+Returns what read would have returned for each URL, using the cached data (as a single, complete page) when the server answers 304
+'''
+def _fetch_first_pages_conditional(urls, read, cache):
+    calls = list()
+    for url in urls:
+        cached = cache.get(url, dict())
+        calls.append(lambda url=url, cached=cached: fetch.fetch_conditional(url, read, cached.get("etag"), cached.get("last_modified")))
+
+    first_pages = list()
+    for url, (page, etag, last_modified) in zip(urls, fetch.run_all(calls)):
+        if page is None:
+            page = (dict(cache[url]["data"]), dict(), 0)
+        cache[url] = { "etag" : etag, "last_modified" : last_modified, "data" : dict(page[0]) }
+        first_pages.append(page)
+
+    return first_pages
+
+'''
+Takes a response body, a list of zip codes and the layer's zip field
+Returns (the filtered data for those zips, the response's other top-level keys, how many features the response held)
+'''
+@instrument.timed("filter_data")
+def read_page(body, zip_codes_to_keep, zip_field=zip_field):
+    metadata = dict()
+    features_read = 0
+
+    def counted(features):
+        nonlocal features_read
+        for feature in features:
+            features_read += 1
+            yield feature
+
+    filtered_data = filter_features(counted(iter_features(body, metadata)), zip_codes_to_keep, zip_field)
+    instrument.count("features_read", features_read)
+    return filtered_data, metadata, features_read
+
+'''
+Incrementally decodes JSON values from a byte stream
+Text that has been decoded is dropped from the buffer whenever more is read, so the buffer stays around one chunk long
+'''
+class _Reader:
+    def __init__(self, stream):
+        self.stream = stream
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        self.position = 0
+        self.finished = False
+
+    def read_more(self):
+        if self.finished:
+            raise ValueError("ArcGIS response ended early")
+
+        chunk = self.stream.read(chunk_size)
+        if not chunk:
+            self.finished = True
+            text = self.decoder.decode(b"", final=True)
+        else:
+            text = self.decoder.decode(chunk)
+
+        self.buffer = self.buffer[self.position:] + text
+        self.position = 0
+
+    def skip_whitespace(self):
+        while True:
+            self.position = _whitespace.match(self.buffer, self.position).end()
+            if self.position < len(self.buffer):
+                return
+            self.read_more()
+
+    def peek(self):
+        self.skip_whitespace()
+        return self.buffer[self.position]
+
+    def expect(self, character):
+        if self.peek() != character:
+            raise ValueError("Expected {0!r} in ArcGIS response, found {1!r}".format(character, self.buffer[self.position]))
+        self.position += 1
+
+    '''
+    Yields the items of an array whose opening bracket has already been read, up to and including the closing bracket
+    This is the hot loop, so it makes one decode and one regex match per item
+    '''
+    def array_items(self):
+        decode = _decoder.raw_decode
+        separator = _separator.match
+
+        while True:
+            buffer = self.buffer
+            try:
+                value, end = decode(buffer, self.position)
+            except json.JSONDecodeError:
+                skipped = _whitespace.match(buffer, self.position).end()
+                if self.position < skipped < len(buffer):
+                    self.position = skipped     # whitespace after a separator that ran into this chunk
+                else:
+                    self.read_more()    # the item isn't complete yet
+                continue
+
+            match = separator(buffer, end)
+            if match is None:
+                self.read_more()    # the separator after the item hasn't arrived yet, so decode the item again
+                continue
+
+            self.position = match.end()
+            yield value
+            if match.group(1) == "]":
+                return
+
+    def value(self):
+        self.skip_whitespace()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.position)
+            except json.JSONDecodeError:
+                self.read_more()    # the value isn't complete yet
+                continue
+
+            if end == len(self.buffer) and not self.finished:
+                self.read_more()    # a number or literal at the very end of the buffer may have been cut short, so decode it again
+                continue
+
+            self.position = end
+            return value
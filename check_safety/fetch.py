@@ -0,0 +1,166 @@
+'''
+Downloading upstream data over reused keep-alive connections, with timeouts, retries and gzip
+Several URLs can be fetched at once with fetch_all, so the fetch stage takes as long as the slowest URL rather than the sum of them
+'''
+import gzip, http.client, random, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+import instrument
+
+attempt_timeout = 20    # seconds to connect, or to wait for the next bytes of a response
+deadline = 60           # seconds for a whole fetch, retries included
+max_attempts = 4
+backoff = 0.5           # seconds before the first retry, doubled for each retry after that
+retry_statuses = {429, 500, 502, 503, 504}
+user_agent = "is-my-town-safe-yet"
+
+class FetchError(Exception):
+    pass
+
+'''
+Idle keep-alive connections, kept per (scheme, host, port) for the life of the process
+Warm Cloud Functions instances reuse them, so only the first fetch to a host pays for the TCP and TLS handshakes
+'''
+class ConnectionPool:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._idle = dict()
+
+    def acquire(self, scheme, host, port):
+        with self._lock:
+            idle = self._idle.get((scheme, host, port))
+            if idle:
+                return idle.pop()
+
+        if scheme == "https":
+            return http.client.HTTPSConnection(host, port, timeout=attempt_timeout)
+        else:
+            return http.client.HTTPConnection(host, port, timeout=attempt_timeout)
+
+    def release(self, scheme, host, port, connection):
+        with self._lock:
+            self._idle.setdefault((scheme, host, port), []).append(connection)
+
+pool = ConnectionPool()
+
+'''
+Takes a URL and a function that reads a file-like object (the response body, already un-gzipped)
+Returns whatever that function returns
+Failed attempts (connection errors, timeouts and retry_statuses) are retried with jittered exponential backoff,
+until max_attempts or the deadline is reached, and then a FetchError is raised
+'''
+def fetch(url, read_body):
+    return _fetch(url, read_body, dict())[0]
+
+'''
+Takes a URL, a function that reads a file-like object (see fetch), and the ETag and Last-Modified values from the last time the URL was fetched
+Returns (what that function returned, or None if the server says nothing has changed, the new ETag, the new Last-Modified)
+'''
+def fetch_conditional(url, read_body, etag=None, last_modified=None):
+    headers = dict()
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+
+    result, response = _fetch(url, read_body, headers)
+    if response.status == 304:
+        return None, etag, last_modified    # a 304 doesn't have to repeat the validators
+    else:
+        return result, response.getheader("ETag"), response.getheader("Last-Modified")
+
+'''
+Does the work for fetch and fetch_conditional, sending the extra headers with the request
+Returns (what read_body returned, or None for a 304, the response)
+'''
+def _fetch(url, read_body, headers):
+    parts = urlsplit(url)
+    path = parts.path + ("?" + parts.query if parts.query else "")
+    port = parts.port or (443 if parts.scheme == "https" else 80)
+    give_up_at = time.monotonic() + deadline
+
+    last_error = None
+    attempts_made = 0
+    for attempt in range(max_attempts):
+        if attempt > 0:
+            delay = backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+            if time.monotonic() + delay >= give_up_at:
+                break
+            time.sleep(delay)
+            instrument.count("upstream_retries")
+
+        attempts_made += 1
+        connection = pool.acquire(parts.scheme, parts.hostname, port)
+        try:
+            connection.request("GET", path, headers=dict(headers, **{ "Accept-Encoding" : "gzip", "User-Agent" : user_agent }))
+            response = connection.getresponse()
+            instrument.count("upstream_requests")
+
+            if response.status == 304:
+                instrument.count("upstream_not_modified")
+                response.read()
+                pool.release(parts.scheme, parts.hostname, port, connection)
+                return None, response
+
+            if response.status != 200:
+                response.read()
+                last_error = FetchError("{0} returned HTTP {1}".format(url, response.status))
+                if response.status not in retry_statuses:
+                    raise last_error
+                pool.release(parts.scheme, parts.hostname, port, connection)
+                continue
+
+            body = counted = _CountingReader(response)
+            if response.getheader("Content-Encoding", "").lower() == "gzip":
+                body = gzip.GzipFile(fileobj=counted)
+            result = read_body(body)
+
+            counted.read()      # drain anything read_body didn't need, so the connection can be reused
+            instrument.count("upstream_bytes", counted.bytes_read)
+            if response.will_close:
+                connection.close()
+            else:
+                pool.release(parts.scheme, parts.hostname, port, connection)
+            return result, response
+
+        except (OSError, http.client.HTTPException) as e:
+            connection.close()  # covers timeouts, resets and idle connections the server already closed
+            last_error = e
+        except Exception:
+            connection.close()  # e.g. a body read_body couldn't parse, which a retry won't fix
+            raise
+
+    raise FetchError("Giving up on {0} after {1} attempt(s): {2}".format(url, attempts_made, last_error))
+
+'''
+A response body that counts the bytes read from it, as they came over the wire (before un-gzipping)
+'''
+class _CountingReader:
+    def __init__(self, response):
+        self.response = response
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self.response.read() if size is None or size < 0 else self.response.read(size)
+        self.bytes_read += len(data)
+        return data
+
+'''
+Takes a list of URLs and a function that reads a file-like object (see fetch)
+Returns a list of what that function returned for each URL, in the same order
+All of the URLs are fetched at the same time
+'''
+def fetch_all(urls, read_body):
+    return run_all([lambda url=url: fetch(url, read_body) for url in urls])
+
+'''
+Takes a list of functions that take no arguments (e.g. calls to fetch or fetch_conditional), and optionally how many to run at once
+Returns a list of what each function returned, in the same order
+All of the functions are run at the same time, unless max_workers says otherwise
+'''
+def run_all(calls, max_workers=None):
+    if len(calls) <= 1 or max_workers == 1:
+        return [call() for call in calls]
+
+    with ThreadPoolExecutor(max_workers=min(len(calls), max_workers or len(calls))) as executor:
+        return list(executor.map(lambda call: call(), calls))
@@ -1,241 +1,508 @@
 # gcloud functions deploy check_safety --entry-point check_safety --trigger-http --runtime python38
-import urllib.request, json
-from datetime import date, datetime
-from google.cloud import firestore
-
-database_name = "is-my-town-safe"
+import hashlib, json, os, time
+from datetime import date, datetime, timedelta
+import events, instrument, metrics, regions, sources, storage, timeseries
+
+database_name = regions.database_name
+upstream_collection = database_name + "-upstream"
+upstream_document = "cache"
+raw_collection = database_name + "-raw"     # the normalized source data behind each computed day, for replay
+version_collection = database_name + "-meta"     # a small document that changes whenever the stored history does, for caches (see history_api),
+                                                  # and says which day was computed last (see email_report's planner)
+version_document = "version"
+runs_collection = database_name + "-runs"     # one run lease document per day (see acquire_lease)
+lease_seconds_variable = "RUN_LEASE_SECONDS"
+lease_seconds = float(os.environ.get(lease_seconds_variable, 600))     # longer than the function's timeout, so only a crashed run's lease expires
+busy_status = 409       # for a trigger that didn't run the day because another run holds it, so the scheduler's retry policy tries again
+logged_metrics = ["total_cases", "new_cases", "case_rate_per_100k", "7_day_avg_new_cases"]     # per region, in each run's log line
 
 '''
-Takes a dict and adds it to a document in a Firestore database
-database_name is determined by the global variable
+Takes a day number and a dict of { collection : dict }, and adds each dict to that day's document in that collection
+in the database (Firestore unless STORAGE_BACKEND says otherwise), in one batched commit
+along with any other (collection, document, dict) to write at the same time
+With conditions (see storage's set_all_if), the commit is one transaction that only writes if they all still hold
+A transaction holds at most storage.firestore_batch_limit writes, so the documents past that (the last regions) are written first, in batched commits;
+if the transaction then fails, the run is retried and rewrites them
+Returns True if it wrote, False if a condition failed
 '''
-def write_to_db(data):
+@instrument.timed("write_to_db")
+def write_to_db(day, documents, other_writes=(), conditions=None):
     
-    document_name = str(days_since_epoch()) # the document name is the number of days since 1970-01-01
-
-    db = firestore.Client()
-    db.collection(database_name).document(document_name).set(data)    
+    document_name = str(day) # the document name is the number of days since 1970-01-01
+
+    items = [(collection, document_name, documents[collection]) for collection in documents]
+    if conditions is not None:
+        room = max(storage.firestore_batch_limit - len(other_writes), 0)
+        if len(items) > room:
+            storage.get_backend().set_all(items[room:])
+            instrument.field("written_before_commit", len(items) - room)
+            items = items[:room]
+        return storage.get_backend().set_all_if(conditions, items + list(other_writes))
+    storage.get_backend().set_all(items + list(other_writes))
+    return True
 
 '''
-Takes a document_name in a firestore db, a key that corresponds to a value in a firestore db
-Returns the value of the key, or None if neither the document or the key can be found
+Takes a day number
+Returns (the lease, None) once this invocation holds the run lease for that day, or else (None, the response to give):
+the day has already been computed (the response is the one that run gave), or another invocation holds the lease (a busy_status response,
+since that run may yet time out or crash, and the trigger has to be retried until the day is done)
+A lease that was released, or whose holder is past its expiry (e.g. it crashed), is taken over in a transaction, so only one invocation gets it
+A repeated trigger for a day that is done costs the one read of the lease document
 '''
-def read_from_db(document_name, key):
-    db = firestore.Client()
-    doc = db.collection(database_name).document(str(document_name)).get()
-    if doc.exists:
-        doc_dict = doc.to_dict()
-        return doc_dict.get(key)
+def acquire_lease(day):
+    backend = storage.get_backend()
+    current = backend.get(runs_collection, day)
+    if current is not None and current.get("state") == "done":
+        return None, current.get("result")
+    if current is not None and current.get("state") == "running" and current.get("expires", 0) > time.time():
+        return None, ("Already running since " + current.get("started", ""), busy_status)
+
+    lease = { "state" : "running", "owner" : os.urandom(16).hex(), "started" : datetime.now().isoformat(), "expires" : time.time() + lease_seconds }
+    if current is None:
+        taken = backend.create(runs_collection, day, lease)
     else:
-        return None
+        taken = backend.set_all_if([(runs_collection, day, "owner", current.get("owner"))], [(runs_collection, day, lease)])
+    if not taken:
+        return None, ("Already running", busy_status)      # another invocation took it between our read and write
+    return lease, None
 
 '''
-Returns the number of days since 1970-01-01, using the current time and local timezone
+Takes a day number, the lease this invocation holds for it, the response it gave and any other (collection, document, dict) to write with it
+Releases the lease, if this invocation still holds it, so the next trigger that day runs again
 '''
-def days_since_epoch():
-    return int(int(datetime.now().timestamp()) / 60 / 60 / 24)    # may be a better way to calculate this
+def release_lease(day, lease, result, other_writes=()):
+    released = dict(lease, state="released", result=result, finished=datetime.now().isoformat())
+    storage.get_backend().set_all_if([(runs_collection, day, "owner", lease["owner"])], [(runs_collection, day, released)] + list(other_writes))
 
+'''
+Takes optionally the day just computed (by default, the day the version document already names, which costs one read)
+Returns the (collection, document, data) write that gives the stored history a new version, to go in the same commit as the history itself
+'''
+def version_write(computed_day=None):
+    if computed_day is None:
+        computed_day = (storage.get_backend().get(version_collection, version_document) or dict()).get("computed_day")
+    return (version_collection, version_document, { "version" : datetime.now().isoformat(), "computed_day" : computed_day })
 
 '''
-Takes a URL, which hopefully points at a JSON document
-Returns the parsed JSON that the URL returns
+Takes a day number, the list of regions whose documents for it were written and the version those writes gave the history (see version_write)
+Publishes the day_computed event, so the reports are rendered and stored (see email_report's render_reports)
+A failed publish is logged rather than raised, since the documents are already saved and email_report renders any report it finds missing
 '''
-def pull_data(address):
-    with urllib.request.urlopen(address) as url:
-        data = json.loads(url.read().decode())
+def publish_computed(day, region_ids, version):
+    try:
+        events.publish(events.day_computed, { "day" : day, "date" : day_to_date(day), "regions" : sorted(region_ids), "version" : version })
+    except Exception as e:
+        instrument.field("event_error", "{0}: {1}".format(type(e).__name__, e))
 
-    return data
+'''
+Takes a list of collections and a list of document_names (days since 1970-01-01)
+Returns a dict of { collection : { day : document dict } } for every one of those documents that exists
+All of the documents are fetched in a single batched get, rather than one round trip per day per collection
+'''
+def read_days_from_db(collections, days_to_read):
+    found = storage.get_backend().get_all([(collection, day) for collection in collections for day in days_to_read])
+
+    history = { collection : dict() for collection in collections }
+    for collection, document_name in found:
+        history[collection][int(document_name)] = found[(collection, document_name)]
+    return history
 
-''' 
-Takes ArcGis data and a list of zip codes
-Returns a dict containing only the data for those zips in the list of zip code (zip is the key)
 '''
-def filter_data(data, zip_codes_to_keep):
+Takes a dict of { region : collection } and the day being computed
+Returns (a dict of { collection : { day : document dict } } with every earlier document the metrics engine needs (see metrics.lookback),
+the monthly time series (see timeseries.read_months) covering those days, for today to be added to)
+The monthly documents are read in one batched get, and every region whose history they hold takes it from them;
+any other region (e.g. one added since) reads its daily documents instead (see read_daily_history_from_db)
+'''
+@instrument.timed("read_from_db")
+def read_history_from_db(region_collections, day):
+    lookback_days = max(sum(metrics.lookback(), []))
+    months = timeseries.read_months(timeseries.months_between(day - lookback_days, day))
+
+    history = dict()
+    daily = list()
+    for region, collection in region_collections.items():
+        found = timeseries.region_history(months, region, day)
+        if found is not None:
+            history[collection] = found
+        else:
+            daily.append(collection)
 
-    filtered_data = dict()
+    if daily:
+        history.update(read_daily_history_from_db(daily, day))
+    return history, months
 
-    for entry in data:
-        for zip in zip_codes_to_keep:
-            if "attributes" in entry and "Zip_Number" in entry["attributes"] and entry["attributes"]["Zip_Number"] == zip:
-                filtered_data.update({ zip : entry["attributes"] })
+'''
+Takes a list of collections and the day being computed
+Returns a dict of { collection : { day : document dict } } with every earlier document the metrics engine needs (see metrics.lookback)
+The exact days are read in one batched get; a day that should be "the latest on or before" but is missing costs one more query
+'''
+def read_daily_history_from_db(collections, day):
+    on_or_before, exactly = metrics.lookback()
+    history = read_days_from_db(collections, sorted(set(day - offset for offset in on_or_before + exactly)))
+
+    backend = storage.get_backend()
+    for collection in collections:
+        for offset in on_or_before:
+            if day - offset not in history[collection]:
+                found = backend.latest(collection, day - offset)
+                if found is not None:
+                    history[collection][found[0]] = found[1]
 
-    return filtered_data
+    return history
 
 '''
-data1 and data2 are dicts that look like
-{ key : { some info about the key }}
+One-time migration: adds the running totals (see metrics.add_running_totals) to every daily document in a collection
+Run with: python main.py backfill-prefixes (which does every region's collection)
+'''
+def backfill_prefixes(collection):
+    backend = storage.get_backend()
+    documents = metrics.add_running_totals(backend.scan(collection, 0, days_since_epoch()))
+    backend.set_all([(collection, day, documents[day]) for day in documents] + [version_write()])
 
-In most cases the keys are the same in each dict, but they don't have to be
 '''
-def merge_data(data1, data2):
-    for key in data2:
-        if key in data1:
-            data1[key].update(data2[key])
-        else:
-            data1.update({ key : data2[key]})   # merge unfound keypairs in data2 into data1
-    return data1
+One-time migration: builds the monthly time series (see timeseries) from every daily document and raw snapshot saved so far
+Zips only have values from the days that have a raw snapshot, since the daily documents just hold each region's totals
+Run with: python main.py migrate-monthly
+'''
+def migrate_monthly():
+    backend = storage.get_backend()
+    today = days_since_epoch()
+
+    months = dict()
+    for day, snapshot in backend.scan(raw_collection, 0, today).items():
+        timeseries.add_day(months, day, snapshot_data(snapshot), dict())
+    for region in regions.all_regions():
+        for day, document in backend.scan(regions.region_collection(region), 0, today).items():
+            timeseries.add_day(months, day, dict(), { region : document })
+
+    backend.set_all(timeseries.write_items(months) + [version_write()])
+    print("Migrated", len(months), "months")
 
 '''
-Take in a dict-of-dicts and a key on which we are aggregating
-Returns the sum of ints within that key
+Takes the normalized data from each source and the date it is for
+Returns the raw snapshot to archive for that day (Firestore wants string keys, so zips are strings)
 '''
-def aggregate(data, value_to_aggregate):
-    running_total = 0
+def raw_snapshot(layer_data, today):
+    return { "date" : today, "layers" : [{ str(zip) : data[zip] for zip in data } for data in layer_data] }
 
-    for key in data:
-        if value_to_aggregate in data[key]:
-            running_total += data[key][value_to_aggregate]
+'''
+Takes a raw snapshot
+Returns the merged data it holds, keyed by zip (see merge_data)
+'''
+def snapshot_data(snapshot):
+    return merge_data(*[{ int(zip) : dict(layer[zip]) for zip in layer } for layer in snapshot["layers"]])
 
-    return running_total
+'''
+Takes the first and last day (days since 1970-01-01) to recompute, inclusive
+Recomputes every region's documents for those days in one pass, from the archived raw snapshots
+(or, for days from before snapshots were archived, from the totals already saved in that day's document)
+Every document after first_day depends on the ones before it, so last_day should normally be today
+Run with: python main.py replay YYYY-MM-DD [YYYY-MM-DD]
+'''
+def replay(first_day, last_day):
+    backend = storage.get_backend()
+    region_zips = regions.all_regions()
+    lookback_days = max(sum(metrics.lookback(), []))
+
+    snapshots = backend.scan(raw_collection, first_day, last_day)
+    months = timeseries.read_months(timeseries.months_between(first_day, last_day))
+    for day in snapshots:
+        timeseries.add_day(months, day, snapshot_data(snapshots[day]), dict())
+
+    writes = list()
+    for region in region_zips:
+        collection = regions.region_collection(region)
+        stored = backend.scan(collection, first_day - lookback_days, last_day)    # one range read covers the history and the days being replaced
+        history = { day : stored[day] for day in stored if day < first_day }
+        found = backend.latest(collection, first_day - lookback_days - 1)   # carries the running totals across any gap before the range
+        if found is not None:
+            history[found[0]] = found[1]
+
+        new_totals = dict()
+        previous = history[max(history)] if history else None
+        for day in sorted(set(snapshots) | set(day for day in stored if day >= first_day)):
+            totals = region_totals(region_zips[region], snapshot_data(snapshots[day])) if day in snapshots else None
+            if totals is None or missing_totals(totals, previous):
+                if day not in stored:
+                    continue        # skipped by the run that archived it (see missing_totals)
+                totals = { metric : stored[day].get(metric) for metric, field in metrics.totals }
+            new_totals[day] = previous = totals
+
+        results = metrics.compute(history, new_totals)     # every day at once
+        for day in results:
+            results[day]["date"] = snapshots[day]["date"] if day in snapshots else stored[day].get("date", day_to_date(day))
+            results[day]["region"] = region
+            results[day]["zips"] = region_zips[region]
+            results[day]["updated"] = datetime.now().isoformat()
+            writes.append((collection, day, results[day]))
+            timeseries.add_day(months, day, dict(), { region : results[day] })
+
+    version = version_write()
+    backend.set_all(writes + timeseries.write_items(months) + [version])    # batched commits
+    print("Replayed", len(writes), "documents from", day_to_date(first_day), "to", day_to_date(last_day))
+    publish_computed(last_day, list(region_zips), version[2]["version"])    # the latest report may have changed
 
 '''
-Takes an int, n, which is the number of days to calculate the average
-data, a dict
-key, a string which is the corresponding key in data to average
-Returns an average of n ints. If n ints can't be found, return the average of however many ints were found up to n
+Returns (the upstream cache document: { "queries" : { key : { "url", "etag", "last_modified", "data" } }, "hash", "computed_day", ... }
+or an empty dict if there isn't one yet, the version of the stored history (see version_write) or None), in one batched read
 '''
-def n_day_average(n, data, key):
-    sum, count = n_day_sum(n, data, key)
-    
-    average = 0
-    if count > 0: 
-        average = sum / count
-    else:
-        average = sum
+@instrument.timed("read_from_db")
+def read_upstream_cache():
+    found = storage.get_backend().get_all([(upstream_collection, upstream_document), (version_collection, version_document)])
+    version = (found.get((version_collection, version_document)) or dict()).get("version")
+    return found.get((upstream_collection, upstream_document)) or dict(), version
 
-    return average
+'''
+Takes the queries dict from the upstream cache document
+Returns the cache dict for sources.ingest (keyed by URL, with int zips)
+'''
+def queries_to_fetch_cache(queries):
+    fetch_cache = dict()
+    for key in queries:
+        query = queries[key]
+        data = { int(zip) : query["data"][zip] for zip in query["data"] }
+        fetch_cache[query["url"]] = { "etag" : query.get("etag"), "last_modified" : query.get("last_modified"), "data" : data }
+    return fetch_cache
 
+'''
+Takes the cache dict filled in by sources.ingest
+Returns the queries dict to save in the upstream cache document (Firestore wants string keys, so URLs are hashed and zips are strings)
+'''
+def fetch_cache_to_queries(fetch_cache):
+    queries = dict()
+    for url in fetch_cache:
+        query = fetch_cache[url]
+        data = { str(zip) : query["data"][zip] for zip in query["data"] }
+        queries[hashlib.sha1(url.encode()).hexdigest()] = { "url" : url, "etag" : query["etag"], "last_modified" : query["last_modified"], "data" : data }
+    return queries
 
 '''
-Takes an number, n, which is the number of days to calculate the sum
-data, a dict
-key, a string which is the corresponding key in data to average
-Returns a sum of n numbers. If n numbers can't be found, return the sum of however many numbers were found up to n
+Takes the region registry and the normalized data from each source
+Returns a hash of both, which only changes when a recompute could give a different answer
 '''
-def n_day_sum(n, data, key):
-    sum = 0
-    count = 0
-    
-    todays_value = data.get(key)
-    if type(todays_value) == int or type(todays_value) == float:
-        sum = sum + todays_value
-        count = count + 1
+def content_hash(region_zips, layer_data):
+    content = { "regions" : region_zips, "layers" : [{ str(zip) : data[zip] for zip in data } for data in layer_data] }
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
 
-    todays_date = days_since_epoch()
+'''
+Returns the number of days since 1970-01-01, using the current time and local timezone
+'''
+def days_since_epoch():
+    return int(int(datetime.now().timestamp()) / 60 / 60 / 24)    # may be a better way to calculate this
 
-    for i in range(n):
-        response = read_from_db(todays_date - i, key)
-        if response is not None:
-            sum = sum + response
-            count = count + 1
+'''
+Takes a date string (YYYY-MM-DD)
+Returns the number of days since 1970-01-01 for that date
+'''
+def date_to_day(text):
+    return (date.fromisoformat(text) - date(1970, 1, 1)).days
 
+'''
+Takes a number of days since 1970-01-01
+Returns the date string (YYYY-MM-DD) for that day
+'''
+def day_to_date(day):
+    return str(date(1970, 1, 1) + timedelta(days=day))
 
-    return sum, count
 
-def check_safety(request):
-    zip_codes_to_keep = [94601, 94602, 94606, 94610, 94619]
-    
-    url1 = "https://services5.arcgis.com/ROBnTHSNjoZ2Wm1P/arcgis/rest/services/COVID_19_Statistics/FeatureServer/0/query?where=1%3D1&outFields=Zip_Number,Population,Cases,CaseRates&returnGeometry=false&outSR=4326&f=json"
-    url2 = "https://services5.arcgis.com/ROBnTHSNjoZ2Wm1P/arcgis/rest/services/COVID_19_Statistics/FeatureServer/1/query?where=1%3D1&outFields=Zip_Number,Positives,NumberOfTests&returnGeometry=false&outSR=4326&f=json"
-    
-    data1 = pull_data(url1)
-    filtered_data1 = filter_data(data1["features"], zip_codes_to_keep)
-    
-    data2 = pull_data(url2)
-    filtered_data2 = filter_data(data2["features"], zip_codes_to_keep)
+'''
+Takes a list of sources (see sources.load_sources), a list of zip codes, and optionally a cache dict for conditional requests
+Returns a list with the data for those zips from each source that has any, normalized to the common per-zip schema
+A source that failed and has no cached data is left out (see sources.ingest), so the other counties are still computed
+Only those zips and fields are requested where the source allows it, the sources are fetched in parallel (see sources.ingest),
+and each response is parsed as it streams in, so the whole body is never held in memory
+'''
+@instrument.timed("pull_data")
+def pull_filtered_data(source_list, zip_codes_to_keep, cache=None):
+    layer_data = sources.ingest(source_list, zip_codes_to_keep, cache)
+    instrument.field("sources", { source.id : len(data) for source, data in zip(source_list, layer_data) if data is not None })
+    return [data for data in layer_data if data is not None]
 
-    merged = merge_data(filtered_data1, filtered_data2)
-    today = str(date.today())
-    days = days_since_epoch()
+'''
+Takes any number of dicts that look like
+{ key : { some info about the key }}
+(e.g. each source's data, keyed by zip)
+Returns a new dict with every key, joined on the key with one dict lookup per record, so it costs the same as reading the records
+Where several dicts have the same field for a key, the last one wins
 
-    results = dict()
+In most cases the keys are the same in each dict, but they don't have to be (e.g. sources from different counties)
+'''
+@instrument.timed("merge_data")
+def merge_data(*data):
+    merged = dict()
+    for records in data:
+        for key in records:
+            if key in merged:
+                merged[key].update(records[key])
+            else:
+                merged[key] = dict(records[key])
+    return merged
 
-    results["date"] = today    # add the date to the database record
-    results["zips"] = zip_codes_to_keep
-    results["total_cases"] = aggregate(merged,"Cases")
-    results["total_population"] = aggregate(merged, "Population")
-    results["new_cases"] = results.get("total_cases") - read_from_db(days - 1, "total_cases")
-    results["case_rate_per_100k"] = results["total_cases"] / results["total_population"] * 100000   # just get this directly from the dashboard for a 28 day supply?
-    
-    results["positive_tests"] = aggregate(merged,"Positives")
-    results["new_positives"] = results.get("positive_tests") - read_from_db(days - 1, "positive_tests")
-    results["total_tests"] = aggregate(merged,"NumberOfTests")
-    results["new_total_tests"] = results.get("total_tests") - read_from_db(days - 1, "total_tests")
-    if results.get("new_total_tests") > 0:
-        results["percentage_new_positive_tests"] = results.get("new_positives") / results.get("new_total_tests")
-    else:
-        results["percentage_new_positive_tests"] = 0
-    results["percentage_positive_tests"] = results["positive_tests"] / results["total_tests"]
-    
-    results["7_day_avg_new_cases"] = n_day_average(7, results, "new_cases")
-    results["7_day_avg_new_cases_per_100k"] = results.get("7_day_avg_new_cases") / n_day_average(7, results, "total_population") * 100000
-    # results["7_day_avg_percent_new_pos_tests"] = n_day_average(7, results, "percentage_new_positive_tests")
-    results["7_day_avg_percent_new_pos_tests"] = n_day_sum(7, results, "new_positives")[0] / n_day_sum(7, results, "new_total_tests")[0]
-    results["7_day_avg_case_rate"] = n_day_average(7, results, "case_rate_per_100k")
-    results["7_day_avg_percentage_pos"] = n_day_average(7, results, "percentage_positive_tests")
-
-
-     # calculate how case rate and percentage positive have changed in the past week
-     # save that result in the data
-    week_old_avg_new_cases = read_from_db(days - 7,"7_day_avg_new_cases")
-    if week_old_avg_new_cases is not None:
-        results["7_day_change_avg_new_cases"] = results["7_day_avg_new_cases"] - week_old_avg_new_cases
-    else:
-        results["7_day_change_avg_new_cases"] = None
+'''
+Take in a dict-of-dicts and a key on which we are aggregating
+Returns the sum of ints within that key, or None if no dict has it (e.g. the only source with that field failed), so it is missing rather than 0
+'''
+def aggregate(data, value_to_aggregate):
+    running_total = None
 
-    week_old_avg_new_pos_tests = read_from_db(days - 7,"7_day_avg_percent_new_pos_tests")
-    if week_old_avg_new_pos_tests is not None:
-        results["7_day_change_percent_new_pos"] = results["7_day_avg_percent_new_pos_tests"] - week_old_avg_new_pos_tests
-    else:
-        results["7_day_change_percent_new_pos"] = None
+    for key in data:
+        if value_to_aggregate in data[key]:
+            running_total = (running_total or 0) + data[key][value_to_aggregate]
 
-    week_old_avg_case_rate = read_from_db(days - 7,"7_day_avg_case_rate")
-    if week_old_avg_case_rate is not None:
-        results["7_day_change_avg_case_rate"] = results["7_day_avg_case_rate"] - week_old_avg_case_rate
-    else:
-        results["7_day_change_avg_case_rate"] = None
-    
-    week_old_percentage_pos = read_from_db(days - 7,"7_day_avg_percentage_pos")   
-    if week_old_percentage_pos is not None:
-        results["7_day_change_avg_percentage_pos"] = results["7_day_avg_percentage_pos"] - week_old_percentage_pos
-    else:
-        results["7_day_change_avg_percentage_pos"] = None
+    return running_total
 
-    
+'''
+Takes a region's totals for a day (see metrics.totals) and the region's previous document, or None
+Returns the totals the previous document has that the day is missing
+A day like that isn't computed for the region, since its changes would count the missing totals as a drop to 0 and then a jump back;
+the next day with them is compared with the previous document instead, and its change covers both days
+'''
+def missing_totals(totals, previous):
+    if previous is None:
+        return []
+    return [metric for metric, field in metrics.totals if totals.get(metric) is None and previous.get(metric) is not None]
 
-    # calculate how case rate and percentage positive have changed in the past month
-    # save that result in the data
-    month_old_avg_new_cases = read_from_db(days - 28,"7_day_avg_new_cases")
-    if month_old_avg_new_cases is not None:
-        results["28_day_change_avg_new_cases"] = results["7_day_avg_new_cases"] - month_old_avg_new_cases
-    else:
-        results["28_day_change_avg_new_cases"] = None
+'''
+Takes the list of zip codes in a region and the merged data for (at least) those zips
+Returns the region's totals (see metrics.totals)
+'''
+def region_totals(zip_codes_to_keep, merged):
+    merged = { zip : merged[zip] for zip in zip_codes_to_keep if zip in merged }
+    return { metric : aggregate(merged, field) for metric, field in metrics.totals }
 
-    month_old_avg_new_pos_tests = read_from_db(days - 28,"7_day_avg_percent_new_pos_tests")
-    if month_old_avg_new_pos_tests is not None:
-        results["28_day_change_percent_new_pos"] = results["7_day_avg_percent_new_pos_tests"] - month_old_avg_new_pos_tests
-    else:
-        results["28_day_change_percent_new_pos"] = None
-    
-    month_old_avg_case_rate = read_from_db(days_since_epoch()-28,"7_day_avg_case_rate")
-    if month_old_avg_case_rate is not None:
-        results["28_day_change_avg_case_rate"] = results["case_rate_per_100k"] - month_old_avg_case_rate
-    else:
-        results["28_day_change_avg_case_rate"] = None
-    
-    month_old_percentage_pos = read_from_db(days_since_epoch()-28,"percentage_positive_tests")   
-    if month_old_percentage_pos is not None:
-        results["28_day_change_avg_percentage_pos"] = results["percentage_positive_tests"] - month_old_percentage_pos
-    else:
-        results["28_day_change_avg_percentage_pos"] = None
+'''
+Takes a region id, the list of zip codes in the region, its totals (see region_totals),
+the region's history (from read_history_from_db), and the day number and date being computed
+Returns the dict of results to save as that day's document for the region
+'''
+@instrument.timed("compute")
+def compute_region(region, zip_codes_to_keep, totals, history, days, today):
+    results = metrics.compute(history, { days : totals })[days]
 
+    results["date"] = today    # add the date to the database record
+    results["region"] = region
+    results["zips"] = zip_codes_to_keep
+    results["updated"] = datetime.now().isoformat()     # email_report caches rendered reports by this
+    return results
+
+'''
+Runs the day's ingest under the day's run lease (see acquire_lease), so a retried or overlapping trigger doesn't run it twice
+Once a day's documents are written, any later trigger that day gets the same response for one read
+A day with nothing new upstream releases its lease, so a later trigger checks again
+'''
+@instrument.invocation("check_safety")
+def check_safety(request):
+    days = days_since_epoch()
+    lease, response = acquire_lease(days)
+    if lease is None:
+        instrument.field("run", "skipped")
+        return response
 
-    for result in results:      # log what we are about to save to the db
-        print(result,": ",results[result])
+    try:
+        return ingest(days, lease)
+    except Exception:
+        release_lease(days, lease, None)
+        raise
 
-    write_to_db(results)
-    
-    response =  "Case Rate per 100k: " + str(results["case_rate_per_100k"])
+'''
+Takes the day number and the run lease held for it
+Downloads, computes and writes the day, and returns the response for it
+Everything is written under that day, even if the run finishes after midnight
+The final write is one transaction that holds only if this invocation still has the lease and the history is still at the version it was read at,
+since each day's changes are computed from the documents before it; if it doesn't, nothing is written, the lease is released
+and the response has busy_status, so the trigger is retried
+'''
+def ingest(days, lease):
+    region_zips = regions.all_regions()
+    zip_codes_to_keep = sorted(set(zip for region in region_zips for zip in region_zips[region]))  # every region is served from one download
+
+    upstream, history_version = read_upstream_cache()
+    fetch_cache = queries_to_fetch_cache(upstream.get("queries", {}))
+    layer_data = pull_filtered_data(sources.load_sources(), zip_codes_to_keep, fetch_cache)  # conditional, so unchanged sources are a 304
+
+    today = day_to_date(days)
+    upstream["queries"] = fetch_cache_to_queries(fetch_cache)
+    upstream["checked"] = datetime.now().isoformat()
+    new_hash = content_hash(region_zips, layer_data)
+
+    if new_hash == upstream.get("hash"):
+        # nothing has been published since the last computed day, so just note that we checked
+        # (missed days are handled by the running totals, and email_report reports the latest document)
+        upstream["unchanged_day"] = days
+        instrument.field("upstream", "unchanged")
+        instrument.field("computed_day", upstream.get("computed_day"))
+        response = "No change since " + str(upstream.get("computed_date"))
+        release_lease(days, lease, response, [(upstream_collection, upstream_document, upstream)])
+        return response
+
+    upstream["hash"] = new_hash
+    upstream["computed_day"] = days
+    upstream["computed_date"] = today
+
+    merged = merge_data(*layer_data)     # keyed by zip, so each region picks its zips straight out of it
+
+    # a region none of whose zips any source has (e.g. its county's feed is down with nothing cached) gets no document today, rather than zeros
+    computed = { region : region_zips[region] for region in region_zips if any(zip in merged for zip in region_zips[region]) }
+    if len(computed) < len(region_zips):
+        instrument.field("no_data", sorted(set(region_zips) - set(computed)))
+    collections = { region : regions.region_collection(region) for region in computed }
+    history, months = read_history_from_db(collections, days)     # one batched read for every region
+
+    documents = dict()
+    summaries = dict()
+    response = list()
+    missing = dict()
+    for region in computed:
+        collection = collections[region]
+        totals = region_totals(computed[region], merged)
+        previous = history[collection][max(history[collection])] if history[collection] else None
+        if missing_totals(totals, previous):
+            missing[region] = missing_totals(totals, previous)
+            continue
+        results = compute_region(region, computed[region], totals, history[collection], days, today)
+
+        summaries[region] = { metric : results[metric] for metric in logged_metrics }     # the headline numbers go in the log line
+
+        documents[collection] = results
+        response.append("Case Rate per 100k: " + str(results["case_rate_per_100k"]))
+
+    if missing:
+        instrument.field("missing_totals", missing)
+        computed = { region : computed[region] for region in computed if region not in missing }
+    timeseries.add_day(months, days, merged, { region : documents[collections[region]] for region in computed })
+    month = timeseries.month_of(days)
+
+    if len(region_zips) > 1:
+        response = [region + " " + line for region, line in zip(computed, response)]
+    response = "\n".join(response)
+
+    version = version_write(days)
+    done = (runs_collection, days, dict(lease, state="done", result=response, finished=datetime.now().isoformat()))
+    written = write_to_db(days, documents, [(upstream_collection, upstream_document, upstream), (raw_collection, days, raw_snapshot(layer_data, today))]
+        + timeseries.write_items({ month : months[month] }) + [version, done],
+        conditions=[(runs_collection, days, "owner", lease["owner"]), (version_collection, version_document, "version", history_version)])
+    if not written:
+        instrument.field("run", "conflict")
+        release_lease(days, lease, None)
+        return "The history changed while day {0} was being computed, so nothing was written".format(days), busy_status
+
+    instrument.field("upstream", "changed")
+    instrument.field("regions", summaries)
+    publish_computed(days, list(computed), version[2]["version"])
     return response
 
 # check_safety(None)
+
+if __name__ == "__main__":
+    import sys
+    if sys.argv[1:] == ["backfill-prefixes"]:
+        for region in regions.all_regions():
+            backfill_prefixes(regions.region_collection(region))
+    elif sys.argv[1:2] == ["replay"] and len(sys.argv) in (3, 4):
+        last_day = date_to_day(sys.argv[3]) if len(sys.argv) == 4 else days_since_epoch()
+        replay(date_to_day(sys.argv[2]), last_day)
+    elif sys.argv[1:] == ["migrate-monthly"]:
+        migrate_monthly()
+    else:
+        print("Usage: python main.py backfill-prefixes | replay YYYY-MM-DD [YYYY-MM-DD] | migrate-monthly")
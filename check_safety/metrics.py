@@ -0,0 +1,221 @@
+'''
+The metrics engine: every number check_safety saves, computed from a declarative spec with vectorized NumPy operations
+
+History is loaded into a days x metrics array (NaN where a document or a value is missing), and the days to compute
+are appended as new rows. Each step of the spec then fills in one column for all of the new rows at once,
+so computing one day or a year of days is the same code, and adding a metric or a window is one line below.
+history_api reads the stored metrics by these names, so this file (and timeseries.py) is kept identical in check_safety and history_api
+'''
+import numpy as np
+
+# raw totals, summed over a region's zips: (metric, ArcGIS field)
+totals = [
+    ("total_cases", "Cases"),
+    ("total_population", "Population"),
+    ("positive_tests", "Positives"),
+    ("total_tests", "NumberOfTests"),
+]
+
+# values for each day, in order: (metric, kind, inputs...)
+#   change:   how much a total has changed since the previous document (which covers every day since then)
+#   per_100k: a / b * 100000
+#   ratio:    a / b, or 0 when b isn't positive
+daily_metrics = [
+    ("new_cases", "change", "total_cases"),
+    ("new_positives", "change", "positive_tests"),
+    ("new_total_tests", "change", "total_tests"),
+    ("case_rate_per_100k", "per_100k", "total_cases", "total_population"),
+    ("percentage_new_positive_tests", "ratio", "new_positives", "new_total_tests"),
+    ("percentage_positive_tests", "ratio", "positive_tests", "total_tests"),
+]
+
+# rolling windows over today plus the n - 1 days before it: (metric, kind, n, inputs...)
+#   average:          the average of a over the days that have it
+#   average_per_100k: the average of a / the average of b * 100000
+#   sum_ratio:        the sum of a / the sum of b, or 0 when the sum of b isn't positive
+window_metrics = [
+    ("7_day_avg_new_cases", "average", 7, "new_cases"),
+    ("7_day_avg_new_cases_per_100k", "average_per_100k", 7, "new_cases", "total_population"),
+    ("7_day_avg_percent_new_pos_tests", "sum_ratio", 7, "new_positives", "new_total_tests"),
+    ("7_day_avg_case_rate", "average", 7, "case_rate_per_100k"),
+    ("7_day_avg_percentage_pos", "average", 7, "percentage_positive_tests"),
+]
+
+# how much a metric has changed since exactly n days ago, or None if there is no document from that day: (metric, n, input)
+change_metrics = [
+    ("7_day_change_avg_new_cases", 7, "7_day_avg_new_cases"),
+    ("7_day_change_percent_new_pos", 7, "7_day_avg_percent_new_pos_tests"),
+    ("7_day_change_avg_case_rate", 7, "7_day_avg_case_rate"),
+    ("7_day_change_avg_percentage_pos", 7, "7_day_avg_percentage_pos"),
+    ("28_day_change_avg_new_cases", 28, "7_day_avg_new_cases"),
+    ("28_day_change_percent_new_pos", 28, "7_day_avg_percent_new_pos_tests"),
+    ("28_day_change_avg_case_rate", 28, "7_day_avg_case_rate"),
+    ("28_day_change_avg_percentage_pos", 28, "7_day_avg_percentage_pos"),
+]
+
+# every window input gets a running total and a running count of days in each document (prefix_sum_<metric>, prefix_count_<metric>),
+# so a window is today's running total minus the running total on the day before the window, whatever its size
+prefix_metrics = sorted(set(name for window in window_metrics for name in window[3:]))
+# change metrics cover every day since the previous document, so after a missed day their count goes up by more than one
+daily_change_metrics = [metric for metric, kind, *inputs in daily_metrics if kind == "change"]
+# saved as ints, like the upstream counts they come from
+integer_metrics = [metric for metric, field in totals] + daily_change_metrics + ["prefix_count_" + metric for metric in prefix_metrics]
+
+columns = ([metric for metric, field in totals] + [metric[0] for metric in daily_metrics] + [metric[0] for metric in window_metrics]
+    + [metric[0] for metric in change_metrics] + ["prefix_sum_" + metric for metric in prefix_metrics] + ["prefix_count_" + metric for metric in prefix_metrics])
+column_index = { name : index for index, name in enumerate(columns) }
+
+'''
+Returns (days to look up the latest document on or before, days to look up exactly), as offsets back from the day being computed
+Computing a day needs the previous document, the document on or before the day each window starts, and the documents each change compares against
+'''
+def lookback():
+    on_or_before = sorted(set([1] + [window[2] for window in window_metrics]))
+    exactly = sorted(set(change[1] for change in change_metrics))
+    return on_or_before, exactly
+
+'''
+Takes a dict of { day : document } that has already been computed (see lookback for which days are needed)
+and a dict of { day : { total metric : value } } for the days to compute, which must all be later than the history
+Returns a dict of { day : results } for the days that were computed, with every column (NaN is saved as None)
+'''
+def compute(history, new_totals):
+    days, values = _table(history, new_totals)
+    start = len(history)
+
+    _compute_daily(days, values, start)
+    _compute_prefixes(days, values, start)
+    _compute_windows(days, values, start)
+    _compute_changes(days, values, start)
+
+    return { int(days[row]) : _row_to_dict(values[row]) for row in range(start, len(days)) }
+
+'''
+Takes a dict of { day : document } holding whole history
+Adds (or replaces) the running totals in every document, in day order, and returns the dict
+'''
+def add_running_totals(documents):
+    days, values = _table(dict(), documents)
+    _compute_prefixes(days, values, 0)
+
+    prefix_columns = ["prefix_sum_" + metric for metric in prefix_metrics] + ["prefix_count_" + metric for metric in prefix_metrics]
+    for row, day in enumerate(days):
+        for name in prefix_columns:
+            documents[int(day)][name] = _to_python(name, values[row, column_index[name]])
+    return documents
+
+'''
+Builds the days x metrics array, with the history rows first and then the rows to compute, each in day order
+'''
+def _table(history, new_rows):
+    days = np.array(sorted(history) + sorted(new_rows), dtype=np.int64)
+    values = np.full((len(days), len(columns)), np.nan)
+
+    for row, day in enumerate(days):
+        document = history.get(int(day)) if row < len(history) else new_rows[int(day)]
+        for name in document:
+            value = document[name]
+            if name in column_index and value is not None and not isinstance(value, bool) and isinstance(value, (int, float)):
+                values[row, column_index[name]] = value
+
+    return days, values
+
+def _elapsed(days, start):
+    elapsed = np.ones(len(days) - start)
+    if len(days) > 1:
+        first = max(start, 1)
+        elapsed[first - start:] = days[first:] - days[first - 1:-1]
+    return elapsed
+
+def _compute_daily(days, values, start):
+    new = slice(start, len(days))
+    for metric, kind, *inputs in daily_metrics:
+        a = values[:, column_index[inputs[0]]]
+        if kind == "change":
+            previous = np.concatenate(([np.nan], a[:-1]))   # the first row ever has nothing to compare with
+            result = a - previous
+        else:
+            b = values[:, column_index[inputs[1]]]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                if kind == "per_100k":
+                    result = a / b * 100000
+                elif kind == "ratio":
+                    result = np.where(b > 0, a / b, 0)
+                else:
+                    raise ValueError("Unknown daily metric kind: {0}".format(kind))
+        values[new, column_index[metric]] = result[new]
+
+def _compute_prefixes(days, values, start):
+    new = slice(start, len(days))
+    metric_columns = [column_index[metric] for metric in prefix_metrics]
+    sum_columns = [column_index["prefix_sum_" + metric] for metric in prefix_metrics]
+    count_columns = [column_index["prefix_count_" + metric] for metric in prefix_metrics]
+
+    observed = values[new][:, metric_columns]
+    present = ~np.isnan(observed)
+
+    weights = np.ones(observed.shape)
+    for position, metric in enumerate(prefix_metrics):
+        if metric in daily_change_metrics:
+            weights[:, position] = _elapsed(days, start)
+
+    base_sum = np.zeros(len(prefix_metrics))
+    base_count = np.zeros(len(prefix_metrics))
+    if start > 0:
+        base_sum = np.nan_to_num(values[start - 1, sum_columns])
+        base_count = np.nan_to_num(values[start - 1, count_columns])
+
+    values[new, sum_columns] = base_sum + np.cumsum(np.where(present, observed, 0), axis=0)
+    values[new, count_columns] = base_count + np.cumsum(np.where(present, weights, 0), axis=0)
+
+'''
+Takes a window size and an input metric
+Returns (sum, count) over the window ending on each row being computed, from the running totals
+'''
+def _window(days, values, start, n, metric):
+    sums = values[:, column_index["prefix_sum_" + metric]]
+    counts = values[:, column_index["prefix_count_" + metric]]
+
+    boundary = np.searchsorted(days, days[start:] - n, side="right") - 1     # the latest row on or before the day before the window
+    before = boundary >= 0                                                   # otherwise the window goes back past the first document
+    boundary_sum = np.where(before, np.nan_to_num(sums[np.maximum(boundary, 0)]), 0)
+    boundary_count = np.where(before, np.nan_to_num(counts[np.maximum(boundary, 0)]), 0)
+
+    return sums[start:] - boundary_sum, counts[start:] - boundary_count
+
+def _compute_windows(days, values, start):
+    for metric, kind, n, *inputs in window_metrics:
+        a_sum, a_count = _window(days, values, start, n, inputs[0])
+        with np.errstate(divide="ignore", invalid="ignore"):
+            a_average = np.where(a_count > 0, a_sum / a_count, a_sum)
+            if kind == "average":
+                result = a_average
+            else:
+                b_sum, b_count = _window(days, values, start, n, inputs[1])
+                if kind == "average_per_100k":
+                    b_average = np.where(b_count > 0, b_sum / b_count, b_sum)
+                    result = a_average / b_average * 100000
+                elif kind == "sum_ratio":
+                    result = np.where(b_sum > 0, a_sum / b_sum, 0)
+                else:
+                    raise ValueError("Unknown window metric kind: {0}".format(kind))
+        values[start:, column_index[metric]] = result
+
+def _compute_changes(days, values, start):
+    for metric, n, source in change_metrics:
+        column = values[:, column_index[source]]
+        target = days[start:] - n
+        row = np.minimum(np.searchsorted(days, target), len(days) - 1)
+        exact = days[row] == target
+        values[start:, column_index[metric]] = np.where(exact, column[start:] - column[row], np.nan)
+
+def _to_python(name, value):
+    if np.isnan(value) or np.isinf(value):
+        return None
+    elif name in integer_metrics:
+        return int(round(value))
+    else:
+        return float(value)
+
+def _row_to_dict(row):
+    return { name : _to_python(name, row[index]) for index, name in enumerate(columns) }
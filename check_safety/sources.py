@@ -0,0 +1,282 @@
+'''
+Upstream sources: every feed check_safety ingests, each one read into the common per-zip schema, so counties that publish
+in different formats and with different field names can be ingested together and joined by zip (see main.merge_data)
+
+A record in the common schema is { field : number } for whichever of the fields (the same as timeseries.zip_fields) a source has,
+and each source returns { zip (an int) : record } for the zips it was asked for
+
+Sources are configured in sources.json next to this file, or in the file named by SOURCES_FILE, as a list of
+    { "id" : a name for it, "type" : "arcgis", "csv" or "socrata", "zip_field" : the source's zip field, "fields" : { field : the source's field } }
+plus, for each type
+    arcgis    "url" of a feature layer, or "layer" of the service at arcgis.service_url; "text_zips" : true if the zip field holds text
+    csv       "url" of a CSV file with a header row
+    socrata   "url" of a dataset's resource endpoint (e.g. https://data.example.gov/resource/abcd-1234.json), queried for just the zips and fields
+              "where" : an extra SoQL condition, e.g. to pick one date out of a time series
+A CSV or Socrata source with several rows for a zip keeps the last one, in the order of its "order" field when it has one
+Every source is fetched at the same time, at most SOURCE_CONCURRENCY (default 4) at once, with conditional requests (see arcgis.fetch_layers)
+A source that fails (its feed is down, or sends something that can't be read) doesn't stop the others: the error is logged, and the source
+gives the data from its last download, kept in the cache, or is left out if there isn't any (see ingest)
+
+With SOURCES_FIXTURES set to a directory, each source reads a recorded payload from <directory>/<id>.json (or .csv) instead of the network,
+so the ingest can be run and checked offline. From check_safety/:
+    python sources.py record DIRECTORY      # saves each source's payload for the configured regions' zips
+    python sources.py show                  # ingests every source (from SOURCES_FIXTURES, if it is set) and prints what each one gave
+'''
+import codecs, csv, hashlib, json, os
+from urllib.parse import urlencode
+import arcgis, fetch, instrument, timeseries
+
+sources_file_variable = "SOURCES_FILE"
+default_sources_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sources.json")
+fixtures_variable = "SOURCES_FIXTURES"
+concurrency_variable = "SOURCE_CONCURRENCY"
+concurrency = int(os.environ.get(concurrency_variable, 4))
+fields = timeseries.zip_fields
+socrata_limit = 50000       # the most rows a Socrata query returns
+
+_sources = None
+
+'''
+One configured source: subclasses say how to download it and how to read its payload, and this normalizes what they read
+'''
+class Source:
+    extension = "json"      # of its fixture
+
+    def __init__(self, config):
+        self.id = config["id"]
+        self.zip_field = config["zip_field"]
+        self.fields = dict(config["fields"])
+        self.config = config
+        unknown = [field for field in self.fields if field not in fields]
+        if unknown or not self.fields:
+            raise ValueError("Source {0} must map some of {1}, not {2}".format(self.id, fields, unknown))
+
+    '''
+    Takes a list of zip codes and optionally the cache dict for conditional requests (see arcgis.fetch_layers)
+    Returns { zip : record in the common schema } for those zips, from the fixture when SOURCES_FIXTURES is set
+    If the download fails, the source's cache entries are put back the way they were before it raises, so they still hold the last complete download
+    '''
+    def load(self, zip_codes, cache=None):
+        directory = os.environ.get(fixtures_variable)
+        if directory:
+            with open(os.path.join(directory, self.id + "." + self.extension), "rb") as payload:
+                records = self.read(payload, zip_codes)
+        elif cache is None:
+            records = self.download(zip_codes)
+        else:
+            keys = self.cache_keys(zip_codes)
+            saved = { key : cache[key] for key in keys if key in cache }
+            try:
+                records = self.download(zip_codes, cache)
+            except Exception:
+                for key in keys:
+                    cache.pop(key, None)
+                cache.update(saved)
+                raise
+        return self.normalize(records)
+
+    '''
+    Takes a list of zip codes and the cache dict
+    Returns { zip : record in the common schema } from the source's last download, as the cache holds it, or None if it doesn't hold all of it
+    '''
+    def cached(self, zip_codes, cache):
+        keys = self.cache_keys(zip_codes)
+        if cache is None or not all(key in cache for key in keys):
+            return None
+        records = dict()
+        for key in keys:
+            records.update(cache[key]["data"])
+        return self.normalize(records)
+
+    '''
+    Takes { zip : the source's record }
+    Returns { zip : record in the common schema }, leaving out the fields it doesn't have a number for
+    '''
+    def normalize(self, records):
+        normalized = dict()
+        for zip in records:
+            record = { field : _number(records[zip].get(source_field)) for field, source_field in self.fields.items() }
+            normalized[zip] = { field : value for field, value in record.items() if value is not None }
+        return normalized
+
+    '''
+    Takes a list of zip codes and optionally the cache dict
+    Returns { zip : the source's record } for those zips, fetching payload_url conditionally, keyed in the cache by cache_key
+    '''
+    def download(self, zip_codes, cache=None):
+        url = self.payload_url(zip_codes)
+        read = lambda body: self.read(body, zip_codes)
+        if cache is None:
+            return fetch.fetch(url, read)
+
+        key = self.cache_key(url, zip_codes)
+        cached = cache.get(key, dict())
+        records, etag, last_modified = fetch.fetch_conditional(url, read, cached.get("etag"), cached.get("last_modified"))
+        if records is None:
+            records = dict(cached["data"])
+        cache[key] = { "etag" : etag, "last_modified" : last_modified, "data" : dict(records) }
+        return records
+
+    def cache_key(self, url, zip_codes):
+        return url
+
+    def cache_keys(self, zip_codes):
+        return [self.cache_key(self.payload_url(zip_codes), zip_codes)]
+
+'''
+A feature layer, queried for just the zips and fields it needs (see arcgis.fetch_layers)
+'''
+class ArcGISSource(Source):
+    @property
+    def url(self):
+        return self.config.get("url") or "{0}/{1}".format(arcgis.service_url, self.config["layer"])
+
+    def out_fields(self):
+        return [self.zip_field] + list(self.fields.values())
+
+    def download(self, zip_codes, cache=None):
+        return arcgis.fetch_layers([(self.url, self.out_fields())], zip_codes, cache, self.zip_field, self.config.get("text_zips", False))[0]
+
+    def read(self, body, zip_codes):
+        return arcgis.read_page(body, zip_codes, self.zip_field)[0]
+
+    def payload_url(self, zip_codes):
+        return arcgis.query_url(self.url, sorted(zip_codes), self.out_fields(), zip_field=self.zip_field, text_zips=self.config.get("text_zips", False))
+
+    def cache_keys(self, zip_codes):
+        return arcgis.first_page_urls(self.url, zip_codes, self.out_fields(), self.zip_field, self.config.get("text_zips", False))
+
+'''
+A CSV file with a header row, read a row at a time as it downloads
+'''
+class CSVSource(Source):
+    extension = "csv"
+
+    def read(self, body, zip_codes):
+        return _last_rows(csv.DictReader(codecs.getreader("utf-8-sig")(body)), self.zip_field, zip_codes, self.config.get("order"))
+
+    def payload_url(self, zip_codes):
+        return self.config["url"]
+
+    # the URL is the same whatever the zips, and only the rows for the zips asked for are cached
+    def cache_key(self, url, zip_codes):
+        return url + "#" + hashlib.sha1(",".join(str(zip) for zip in sorted(zip_codes)).encode()).hexdigest()[:16]
+
+'''
+A Socrata (SODA) dataset, queried with SoQL for just the zips and fields it needs
+'''
+class SocrataSource(Source):
+    def read(self, body, zip_codes):
+        return _last_rows(json.load(body), self.zip_field, zip_codes, self.config.get("order"))
+
+    def payload_url(self, zip_codes):
+        where = "{0} in ({1})".format(self.zip_field, ",".join("'{0}'".format(zip) for zip in sorted(zip_codes)))
+        if self.config.get("where"):
+            where = "({0}) AND ({1})".format(where, self.config["where"])
+        parameters = { "$select" : ",".join([self.zip_field] + list(self.fields.values())), "$where" : where, "$limit" : socrata_limit }
+        if self.config.get("order"):
+            parameters["$order"] = self.config["order"]
+        return self.config["url"] + "?" + urlencode(parameters)
+
+source_types = { "arcgis" : ArcGISSource, "csv" : CSVSource, "socrata" : SocrataSource }
+
+'''
+Takes one source's configuration (see above)
+Returns its Source
+'''
+def create_source(config):
+    if config.get("type") not in source_types:
+        raise ValueError("Unknown source type: {0}".format(config.get("type")))
+    return source_types[config["type"]](config)
+
+'''
+Returns the list of configured Sources, read once per process
+'''
+def load_sources():
+    global _sources
+    if _sources is None:
+        with open(os.environ.get(sources_file_variable, default_sources_file)) as sources_file:
+            _sources = [create_source(config) for config in json.load(sources_file)]
+    return _sources
+
+'''
+Takes a list of Sources, a list of zip codes, and optionally the cache dict for conditional requests
+Returns a list with each source's { zip : record in the common schema }, in the same order
+The sources are fetched at the same time, at most concurrency at once
+A source that fails is logged under source_errors and gives its cached data from the last download (logged under sources_stale),
+or None if there isn't any, so it can be left out; if every source fails, the first error is raised, since there is nothing to compute from
+Cache entries that none of the sources asked for this time (e.g. queries for a set of zips from before a zip set was added) are dropped,
+so the cache only ever holds the current queries
+'''
+def ingest(sources, zip_codes, cache=None):
+    if cache is not None:
+        used = set(key for source in sources for key in source.cache_keys(zip_codes))
+        for key in [key for key in cache if key not in used]:
+            del cache[key]
+
+    errors = dict()
+
+    def load(source):
+        try:
+            return source.load(zip_codes, cache)
+        except Exception as e:
+            errors[source.id] = e
+            return source.cached(zip_codes, cache)
+
+    results = fetch.run_all([lambda source=source: load(source) for source in sources], concurrency)
+    if errors:
+        instrument.field("source_errors", { id : "{0}: {1}".format(type(e).__name__, e) for id, e in errors.items() })
+        instrument.field("sources_stale", [source.id for source, records in zip(sources, results) if source.id in errors and records is not None])
+        if all(records is None for records in results):
+            raise errors[sources[0].id]
+    return results
+
+'''
+Takes rows (dicts), the zip field, a list of zip codes and optionally a field to order the rows by
+Returns { zip : the last row for that zip }
+'''
+def _last_rows(rows, zip_field, zip_codes, order=None):
+    zips = set(zip_codes)
+    if order:
+        rows = sorted(rows, key=lambda row: row.get(order) or "")
+    found = dict()
+    for row in rows:
+        zip = _zip(row.get(zip_field))
+        if zip in zips:
+            found[zip] = row
+    return found
+
+def _zip(value):
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    text = str(value or "").strip()
+    return int(text[:5]) if text[:5].isdigit() else None
+
+def _number(value):
+    if value is None or isinstance(value, bool):
+        return None
+    elif isinstance(value, (int, float)):
+        return value
+    text = str(value).strip().replace(",", "")
+    for kind in (int, float):
+        try:
+            return kind(text)
+        except ValueError:
+            pass
+    return None
+
+if __name__ == "__main__":
+    import sys
+    import regions
+    zips = sorted(set(zip for region_zips in regions.load_regions().values() for zip in region_zips))
+    if len(sys.argv) == 3 and sys.argv[1] == "record":
+        os.makedirs(sys.argv[2], exist_ok=True)
+        for source in load_sources():
+            with open(os.path.join(sys.argv[2], source.id + "." + source.extension), "wb") as payload:
+                payload.write(fetch.fetch(source.payload_url(zips), lambda body: body.read()))
+            print("Recorded", source.id)
+    elif sys.argv[1:] == ["show"]:
+        for source, records in zip(load_sources(), ingest(load_sources(), zips)):
+            print(source.id, len(records), "zips", json.dumps({ str(zip) : records[zip] for zip in sorted(records)[:3] }))
+    else:
+        print("Usage: python sources.py record DIRECTORY | show")
@@ -0,0 +1,392 @@
+'''
+Storage backends shared by check_safety, email_report and history_api
+Each function directory is deployed on its own, so this file is kept identical in all of them
+
+Every backend stores documents (dicts) by collection name and document name, and supports:
+    get(collection, document)               -> dict, or None if the document does not exist
+    get_many(collection, documents)         -> { document : dict } for the documents that exist, in one round trip
+    set(collection, document, data)         -> replaces the whole document
+    scan(collection, first_day, last_day)   -> { day : dict } for documents named by a day number in [first_day, last_day]
+    latest(collection, last_day)            -> (day, dict) for the newest document named by a day number <= last_day, or None
+    get_all(keys)                           -> { (collection, document) : dict } for (collection, document) keys across collections, in one round trip
+    set_all(items)                          -> writes a list of (collection, document, data) in as few batched commits as the backend allows
+    get_collection(collection)              -> { document : dict } for every document in a (small) collection
+    delete(collection, document)            -> removes a document, if it exists
+    create(collection, document, data)      -> writes a document only if it doesn't exist yet, atomically: True if it was created, False if it was already there
+    set_all_if(conditions, items)           -> in one transaction, checks a list of (collection, document, field, value) and writes the items (as set_all)
+                                               only if every one of those documents has that value in that field (None for a missing document or field):
+                                               True if they were written, False if any condition failed and nothing was
+                                               (at most firestore_batch_limit items, the most Firestore allows in a transaction)
+
+The backend is picked with the STORAGE_BACKEND environment variable: "firestore" (the default), "sqlite" or "memory"
+The sqlite backend writes to the file named by STORAGE_SQLITE_PATH (default is-my-town-safe.sqlite3)
+While instrumentation is on, every call is a db.<method> span and is counted as a round trip (see instrument.py)
+'''
+import copy, json, os, sqlite3, threading
+import instrument
+
+backend_variable = "STORAGE_BACKEND"
+sqlite_path_variable = "STORAGE_SQLITE_PATH"
+default_sqlite_path = "is-my-town-safe.sqlite3"
+firestore_batch_limit = 500     # the most writes Firestore allows in one commit
+
+'''
+Firestore, through a single client that is created on first use and reused for the life of the process
+Warm Cloud Functions instances keep the client, so only a cold start pays for auth and channel setup
+'''
+class FirestoreBackend:
+    def __init__(self):
+        self._client = None
+        self._lock = threading.Lock()
+
+    def client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    from google.cloud import firestore
+                    self._client = firestore.Client()
+        return self._client
+
+    def get(self, collection, document):
+        doc = self.client().collection(collection).document(str(document)).get()
+        if doc.exists:
+            return doc.to_dict()
+        else:
+            return None
+
+    def get_many(self, collection, documents):
+        db = self.client()
+        refs = [db.collection(collection).document(str(document)) for document in documents]
+
+        found = dict()
+        for doc in db.get_all(refs):
+            if doc.exists:
+                found[doc.id] = doc.to_dict()
+        return found
+
+    def set(self, collection, document, data):
+        self.client().collection(collection).document(str(document)).set(data)
+
+    def get_all(self, keys):
+        db = self.client()
+        refs = [db.collection(collection).document(str(document)) for collection, document in keys]
+
+        found = dict()
+        for doc in db.get_all(refs):
+            if doc.exists:
+                found[(doc.reference.parent.id, doc.id)] = doc.to_dict()
+        return found
+
+    def set_all(self, items):
+        db = self.client()
+        for start in range(0, len(items), firestore_batch_limit):
+            batch = db.batch()
+            for collection, document, data in items[start:start + firestore_batch_limit]:
+                batch.set(db.collection(collection).document(str(document)), data)
+            batch.commit()
+
+    def get_collection(self, collection):
+        return { doc.id : doc.to_dict() for doc in self.client().collection(collection).stream() }
+
+    def delete(self, collection, document):
+        self.client().collection(collection).document(str(document)).delete()
+
+    def create(self, collection, document, data):
+        from google.api_core.exceptions import AlreadyExists
+        try:
+            self.client().collection(collection).document(str(document)).create(data)
+            return True
+        except AlreadyExists:
+            return False
+
+    def set_all_if(self, conditions, items):
+        from google.cloud import firestore
+        if len(items) > firestore_batch_limit:
+            raise ValueError("A transaction can write at most {0} documents".format(firestore_batch_limit))
+        db = self.client()
+
+        # the transaction is retried from the top if another writer commits any of the documents it read first
+        @firestore.transactional
+        def commit(transaction):
+            snapshots = { (doc.reference.parent.id, doc.id) : doc for doc in transaction.get_all([db.collection(collection).document(str(document)) for collection, document, field, value in conditions]) }
+            for collection, document, field, value in conditions:
+                snapshot = snapshots.get((collection, str(document)))
+                current = snapshot.to_dict().get(field) if snapshot is not None and snapshot.exists else None
+                if current != value:
+                    return False
+            for collection, document, data in items:
+                transaction.set(db.collection(collection).document(str(document)), data)
+            return True
+
+        return commit(db.transaction())
+
+    def scan(self, collection, first_day, last_day):
+        from google.cloud import firestore
+
+        # document names are compared as strings, which orders day numbers correctly while they all have the same number of digits
+        ref = self.client().collection(collection)
+        query = ref.where(firestore.FieldPath.document_id(), ">=", ref.document(str(first_day)))
+        query = query.where(firestore.FieldPath.document_id(), "<=", ref.document(str(last_day)))
+
+        found = dict()
+        for doc in query.stream():
+            if doc.id.isdigit():
+                found[int(doc.id)] = doc.to_dict()
+        return found
+
+    def latest(self, collection, last_day):
+        from google.cloud import firestore
+
+        ref = self.client().collection(collection)
+        query = ref.where(firestore.FieldPath.document_id(), "<=", ref.document(str(last_day)))
+        query = query.order_by(firestore.FieldPath.document_id(), direction=firestore.Query.DESCENDING).limit(1)
+
+        for doc in query.stream():
+            if doc.id.isdigit():
+                return int(doc.id), doc.to_dict()
+        return None
+
+'''
+A single SQLite file, so the pipeline can be run and load tested without any cloud access
+Documents are stored as JSON, with the day number pulled out into its own indexed column for range scans
+'''
+class SQLiteBackend:
+    def __init__(self, path=default_sqlite_path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS documents (collection TEXT NOT NULL, document TEXT NOT NULL, day INTEGER, data TEXT NOT NULL, PRIMARY KEY (collection, document))")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS documents_by_day ON documents (collection, day)")
+
+    def get(self, collection, document):
+        with self._lock:
+            row = self._conn.execute("SELECT data FROM documents WHERE collection = ? AND document = ?", (collection, str(document))).fetchone()
+        if row is not None:
+            return json.loads(row[0])
+        else:
+            return None
+
+    def get_many(self, collection, documents):
+        names = [str(document) for document in documents]
+        if not names:
+            return dict()
+
+        placeholders = ",".join("?" * len(names))
+        with self._lock:
+            rows = self._conn.execute("SELECT document, data FROM documents WHERE collection = ? AND document IN ({0})".format(placeholders), [collection] + names).fetchall()
+        return { name : json.loads(data) for name, data in rows }
+
+    def set(self, collection, document, data):
+        self.set_all([(collection, document, data)])
+
+    def get_all(self, keys):
+        found = dict()
+        for collection in set(collection for collection, document in keys):
+            documents = self.get_many(collection, [document for key_collection, document in keys if key_collection == collection])
+            for name in documents:
+                found[(collection, name)] = documents[name]
+        return found
+
+    def set_all(self, items):
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO documents (collection, document, day, data) VALUES (?, ?, ?, ?)", self._rows(items))
+
+    def create(self, collection, document, data):
+        with self._lock, self._conn:
+            return self._conn.execute("INSERT OR IGNORE INTO documents (collection, document, day, data) VALUES (?, ?, ?, ?)", self._rows([(collection, document, data)])[0]).rowcount == 1
+
+    def set_all_if(self, conditions, items):
+        rows = self._rows(items)
+        with self._lock:
+            # IMMEDIATE takes the write lock before reading, so another process can't write in between
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for collection, document, field, value in conditions:
+                    row = self._conn.execute("SELECT data FROM documents WHERE collection = ? AND document = ?", (collection, str(document))).fetchone()
+                    if (json.loads(row[0]).get(field) if row is not None else None) != value:
+                        self._conn.rollback()
+                        return False
+                self._conn.executemany("INSERT OR REPLACE INTO documents (collection, document, day, data) VALUES (?, ?, ?, ?)", rows)
+                self._conn.commit()
+                return True
+            except BaseException:
+                self._conn.rollback()
+                raise
+
+    def get_collection(self, collection):
+        with self._lock:
+            rows = self._conn.execute("SELECT document, data FROM documents WHERE collection = ?", (collection,)).fetchall()
+        return { name : json.loads(data) for name, data in rows }
+
+    def delete(self, collection, document):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM documents WHERE collection = ? AND document = ?", (collection, str(document)))
+
+    def scan(self, collection, first_day, last_day):
+        with self._lock:
+            rows = self._conn.execute("SELECT day, data FROM documents WHERE collection = ? AND day BETWEEN ? AND ? ORDER BY day", (collection, first_day, last_day)).fetchall()
+        return { day : json.loads(data) for day, data in rows }
+
+    def latest(self, collection, last_day):
+        with self._lock:
+            row = self._conn.execute("SELECT day, data FROM documents WHERE collection = ? AND day <= ? ORDER BY day DESC LIMIT 1", (collection, last_day)).fetchone()
+        if row is not None:
+            return row[0], json.loads(row[1])
+        else:
+            return None
+
+    def _rows(self, items):
+        rows = list()
+        for collection, document, data in items:
+            name = str(document)
+            day = int(name) if name.isdigit() else None
+            rows.append((collection, name, day, json.dumps(data)))
+        return rows
+
+'''
+Plain dicts in process memory, for tests and benchmarks
+Documents are copied on the way in and out, so callers can't change stored data by accident (the same as a real database)
+'''
+class MemoryBackend:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.collections = dict()
+
+    def get(self, collection, document):
+        with self._lock:
+            data = self.collections.get(collection, {}).get(str(document))
+            return copy.deepcopy(data)
+
+    def get_many(self, collection, documents):
+        with self._lock:
+            stored = self.collections.get(collection, {})
+            return { str(document) : copy.deepcopy(stored[str(document)]) for document in documents if str(document) in stored }
+
+    def set(self, collection, document, data):
+        self.set_all([(collection, document, data)])
+
+    def get_all(self, keys):
+        with self._lock:
+            return { (collection, str(document)) : copy.deepcopy(self.collections[collection][str(document)]) for collection, document in keys if str(document) in self.collections.get(collection, {}) }
+
+    def set_all(self, items):
+        with self._lock:
+            for collection, document, data in items:
+                self.collections.setdefault(collection, {})[str(document)] = copy.deepcopy(data)
+
+    def get_collection(self, collection):
+        with self._lock:
+            return copy.deepcopy(self.collections.get(collection, {}))
+
+    def delete(self, collection, document):
+        with self._lock:
+            self.collections.get(collection, {}).pop(str(document), None)
+
+    def create(self, collection, document, data):
+        with self._lock:
+            stored = self.collections.setdefault(collection, {})
+            if str(document) in stored:
+                return False
+            stored[str(document)] = copy.deepcopy(data)
+            return True
+
+    def set_all_if(self, conditions, items):
+        with self._lock:
+            for collection, document, field, value in conditions:
+                if (self.collections.get(collection, {}).get(str(document)) or dict()).get(field) != value:
+                    return False
+            for collection, document, data in items:
+                self.collections.setdefault(collection, {})[str(document)] = copy.deepcopy(data)
+            return True
+
+    def scan(self, collection, first_day, last_day):
+        with self._lock:
+            stored = self.collections.get(collection, {})
+            days = sorted(int(name) for name in stored if name.isdigit() and first_day <= int(name) <= last_day)
+            return { day : copy.deepcopy(stored[str(day)]) for day in days }
+
+    def latest(self, collection, last_day):
+        with self._lock:
+            stored = self.collections.get(collection, {})
+            days = [int(name) for name in stored if name.isdigit() and int(name) <= last_day]
+            if days:
+                return max(days), copy.deepcopy(stored[str(max(days))])
+            else:
+                return None
+
+'''
+Wraps a backend so every call is timed and counted by instrument: db_round_trips, db_documents_read and db_documents_written
+Anything else (e.g. MemoryBackend.collections) is passed straight through
+'''
+class InstrumentedBackend:
+    reads = ("get", "get_many", "get_all", "get_collection", "scan", "latest")
+    writes = ("set", "set_all", "delete", "create", "set_all_if")
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def __getattr__(self, name):
+        method = getattr(self.backend, name)
+        if name not in self.reads and name not in self.writes:
+            return method
+
+        def instrumented(*args):
+            with instrument.span("db." + name):
+                result = method(*args)
+            instrument.count("db_round_trips")
+            if name == "set_all":
+                instrument.count("db_documents_written", len(args[0]))
+            elif name == "set_all_if":
+                instrument.count("db_documents_read", len(args[0]))
+                instrument.count("db_documents_written", len(args[1]) if result else 0)
+            elif name in self.writes:
+                instrument.count("db_documents_written")
+            elif isinstance(result, dict) and name != "get":
+                instrument.count("db_documents_read", len(result))
+            elif result is not None:
+                instrument.count("db_documents_read")
+            return result
+        return instrumented
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+'''
+Returns the process-wide backend, creating it on first use from the STORAGE_BACKEND environment variable
+'''
+def get_backend():
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = _instrumented(create_backend(os.environ.get(backend_variable, "firestore")))
+    return _backend
+
+'''
+Takes the name of a backend ("firestore", "sqlite" or "memory")
+Returns a new instance of that backend
+'''
+def create_backend(name):
+    if name == "firestore":
+        return FirestoreBackend()
+    elif name == "sqlite":
+        return SQLiteBackend(os.environ.get(sqlite_path_variable, default_sqlite_path))
+    elif name == "memory":
+        return MemoryBackend()
+    else:
+        raise ValueError("Unknown storage backend: {0}".format(name))
+
+'''
+Replaces the process-wide backend, e.g. with a MemoryBackend for local runs and benchmarks
+'''
+def set_backend(backend):
+    global _backend
+    with _backend_lock:
+        _backend = _instrumented(backend)
+
+def _instrumented(backend):
+    if instrument.enabled:
+        return InstrumentedBackend(backend)
+    else:
+        return backend
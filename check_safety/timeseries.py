@@ -0,0 +1,325 @@
+'''
+Monthly columnar time series: one document per calendar month with every zip's raw values and every region's metrics for each day of it
+A month-long trend for any zip or region is one read (two when it crosses a month), and the per-zip values are kept rather than
+thrown away after aggregating, so a zip can be looked at on its own
+
+Each month is a head document in the monthly_collection, named by its month ("2020-10"), holding
+    month, first_day (day number of the 1st), length (days in the month)
+    zip_fields, region_columns:             the names along the last axis of the arrays (see metrics.columns)
+    zip_parts, region_parts:                how many part documents the rows are split over
+and its part documents, "2020-10-zips-0", "2020-10-regions-0" and so on, each holding a block of rows in the order they were added
+    zips, zip_values:                       a [zip, day of month, field] array of the source values
+    regions, region_values:                 a [region, day of month, column] array of the metrics
+Arrays are little-endian float64 with NaN where there is no value, zlib-compressed and base64-encoded,
+so every storage backend can hold them as a string and decoding is one np.frombuffer
+A part holds at most part_bytes of raw array, so even values that don't compress keep every document well under Firestore's 1 MiB limit,
+however many zips and regions there are; the head and first parts are read in one batched get, so it takes a second get only once a month has more parts
+The names are stored with the arrays, so documents written before a field or metric was added still decode,
+and a month written before it was split (one document with every array in it) decodes as a month with one part
+history_api serves ranges from these documents, so this file is kept identical in check_safety and history_api
+'''
+import base64, calendar, json, math, zlib
+from datetime import date, timedelta
+import numpy as np
+import metrics, regions, storage
+
+monthly_collection = regions.database_name + "-monthly"
+zip_fields = ["Population", "Cases", "CaseRates", "Positives", "NumberOfTests"]
+_integers = frozenset(metrics.integer_metrics + ["Population", "Cases", "Positives", "NumberOfTests"])     # saved as ints, like the values they come from
+_epoch = date(1970, 1, 1)
+part_bytes = 512 * 1024     # raw float64 bytes in one part document, which base64 makes about 700 KB
+max_document_bytes = 1000000        # Firestore allows 1,048,576, including the document's name and some overhead per field
+_part_counts = { "zips" : "zip_parts", "regions" : "region_parts" }     # the head's field with the number of each kind of part
+
+'''
+Takes a day number (days since 1970-01-01)
+Returns the name of its month, e.g. "2020-10"
+'''
+def month_of(day):
+    day = _epoch + timedelta(days=int(day))
+    return "{0:04d}-{1:02d}".format(day.year, day.month)
+
+'''
+Takes a month name
+Returns (the day number of its first day, the number of days in it)
+'''
+def month_bounds(month):
+    year, number = int(month[:4]), int(month[5:7])
+    return (date(year, number, 1) - _epoch).days, calendar.monthrange(year, number)[1]
+
+'''
+Takes a first and last day number
+Returns the names of every month from the first day's to the last day's, in order
+'''
+def months_between(first_day, last_day):
+    months = list()
+    day = first_day
+    while day <= last_day:
+        month = month_of(day)
+        months.append(month)
+        first, length = month_bounds(month)
+        day = first + length
+    return months
+
+'''
+One month decoded into arrays, which can be read from and added to, and then encoded back into its document
+'''
+class Month:
+    def __init__(self, month):
+        self.month = month
+        self.first_day, self.length = month_bounds(month)
+        self.zips = list()
+        self._zip_values = np.full((0, self.length, len(zip_fields)), np.nan)
+        self._zip_document = None
+        self.regions = list()
+        self.region_values = np.full((0, self.length, len(metrics.columns)), np.nan)
+
+    '''
+    Takes the month's head document and lists of its zip and region part documents, in order
+    (a month written as one document is its own head and only part)
+    '''
+    @classmethod
+    def decode(cls, document, zip_parts, region_parts):
+        month = cls(document["month"])
+        month.zips = [int(zip) for part in zip_parts for zip in part["zips"]]
+        month._zip_document = (document, zip_parts)     # the zip arrays are decoded when they're first used, since reading history only needs the regions
+        month.regions = [region for part in region_parts for region in part["regions"]]
+        month.region_values = _decode_parts(region_parts, "regions", "region_values", month.length, document["region_columns"], metrics.columns)
+        return month
+
+    @property
+    def zip_values(self):
+        if self._zip_document is not None:
+            (document, parts), self._zip_document = self._zip_document, None
+            self._zip_values = _decode_parts(parts, "zips", "zip_values", self.length, document["zip_fields"], zip_fields)
+        return self._zip_values
+
+    @zip_values.setter
+    def zip_values(self, values):
+        self._zip_document = None
+        self._zip_values = values
+
+    '''
+    Returns a list of (document name, document) for the month's head and every part
+    Raises ValueError if any of them would be too big to store (see max_document_bytes)
+    '''
+    def encode(self):
+        zip_rows = _rows_per_part(self.length, len(zip_fields))
+        region_rows = _rows_per_part(self.length, len(metrics.columns))
+        zip_parts = [{ "zips" : self.zips[start:start + zip_rows], "zip_values" : _encode_array(self.zip_values[start:start + zip_rows]) }
+            for start in range(0, len(self.zips), zip_rows)]
+        region_parts = [{ "regions" : self.regions[start:start + region_rows], "region_values" : _encode_array(self.region_values[start:start + region_rows]) }
+            for start in range(0, len(self.regions), region_rows)]
+        head = {
+            "month" : self.month,
+            "first_day" : self.first_day,
+            "length" : self.length,
+            "zip_fields" : zip_fields,
+            "region_columns" : metrics.columns,
+            "zip_parts" : len(zip_parts),
+            "region_parts" : len(region_parts),
+        }
+
+        documents = [(self.month, head)] + [(part_name(self.month, "zips", index), part) for index, part in enumerate(zip_parts)] \
+            + [(part_name(self.month, "regions", index), part) for index, part in enumerate(region_parts)]
+        for name, document in documents:
+            size = len(name) + len(json.dumps(document))
+            if size > max_document_bytes:
+                raise ValueError("Monthly document {0} would be {1} bytes, more than the {2} a document can hold".format(name, size, max_document_bytes))
+        return documents
+
+    '''
+    Takes a day in this month and a dict of { zip : ArcGIS attributes } (e.g. merged data), and sets that day's row for each zip
+    '''
+    def set_zips(self, day, data):
+        for zip in data:
+            row = self._zip_row(int(zip))
+            self.zip_values[row, day - self.first_day, :] = [_number(data[zip].get(field)) for field in zip_fields]
+
+    '''
+    Takes a day in this month, a region id and the region's document for that day, and sets that day's row for the region
+    '''
+    def set_region(self, day, region, document):
+        row = self._region_row(region)
+        self.region_values[row, day - self.first_day, :] = [_number(document.get(column)) for column in metrics.columns]
+
+    '''
+    Returns a dict of { day : value } for the days in this month that have a value of that field for that zip
+    '''
+    def zip_series(self, zip, field):
+        if int(zip) not in self.zips:
+            return dict()
+        return self._series(self.zip_values[self.zips.index(int(zip)), :, zip_fields.index(field)], field)
+
+    '''
+    Returns a dict of { day : value } for the days in this month that have a value of that metric for that region
+    '''
+    def region_series(self, region, metric):
+        if region not in self.regions:
+            return dict()
+        return self._series(self.region_values[self.regions.index(region), :, metrics.column_index[metric]], metric)
+
+    '''
+    Returns the days in this month that have a row for that region, in order
+    '''
+    def region_days(self, region):
+        if region not in self.regions:
+            return list()
+        present = ~np.all(np.isnan(self.region_values[self.regions.index(region)]), axis=1)
+        return [self.first_day + int(index) for index in np.flatnonzero(present)]
+
+    '''
+    Returns the region's row for a day as a dict of { metric : value }, like the day's document without its text fields
+    '''
+    def region_row(self, region, day):
+        values = self.region_values[self.regions.index(region), day - self.first_day].tolist()
+        return { column : _to_python(column, value) for column, value in zip(metrics.columns, values) }
+
+    def _series(self, values, name):
+        return { self.first_day + index : _to_python(name, value) for index, value in enumerate(values.tolist()) if not math.isnan(value) }
+
+    def _zip_row(self, zip):
+        if zip not in self.zips:
+            self.zips.append(zip)
+            self.zip_values = np.concatenate([self.zip_values, np.full((1, self.length, len(zip_fields)), np.nan)])
+        return self.zips.index(zip)
+
+    def _region_row(self, region):
+        if region not in self.regions:
+            self.regions.append(region)
+            self.region_values = np.concatenate([self.region_values, np.full((1, self.length, len(metrics.columns)), np.nan)])
+        return self.regions.index(region)
+
+'''
+Takes a month name, "zips" or "regions" and a part number
+Returns the name of that part document
+'''
+def part_name(month, kind, index):
+    return "{0}-{1}-{2}".format(month, kind, index)
+
+'''
+Takes a list of month names
+Returns a dict of { month name : Month } for each of them (months with no document yet are empty)
+The heads and first parts are read in one batched get, and any parts after those in one more
+'''
+def read_months(month_names):
+    backend = storage.get_backend()
+    found = backend.get_many(monthly_collection, [name for month in month_names for name in (month, part_name(month, "zips", 0), part_name(month, "regions", 0))])
+
+    rest = [part_name(month, kind, index) for month in month_names if month in found for kind in _part_counts
+        for index in range(1, found[month].get(_part_counts[kind], 0))]
+    if rest:
+        found.update(backend.get_many(monthly_collection, rest))
+
+    months = dict()
+    for month in month_names:
+        head = found.get(month)
+        if head is None:
+            months[month] = Month(month)
+        elif "zip_parts" not in head:
+            months[month] = Month.decode(head, [head], [head])      # written before months were split
+        else:
+            parts = { kind : [found[part_name(month, kind, index)] for index in range(head[_part_counts[kind]])] for kind in _part_counts }
+            months[month] = Month.decode(head, parts["zips"], parts["regions"])
+    return months
+
+'''
+Takes a dict of { month name : Month }
+Returns the (collection, document, data) writes that save them, raising ValueError before any is written if one is too big (see Month.encode)
+'''
+def write_items(months):
+    return [(monthly_collection, name, document) for month in months for name, document in months[month].encode()]
+
+'''
+Takes a dict of { month name : Month } and adds a day to the right one: the merged ArcGIS data for every zip, and a dict of { region : document }
+'''
+def add_day(months, day, zip_data, region_documents):
+    month = months.setdefault(month_of(day), Month(month_of(day)))
+    month.set_zips(day, zip_data)
+    for region in region_documents:
+        month.set_region(day, region, region_documents[region])
+
+'''
+Takes a zip code, an ArcGIS field (see zip_fields) and a first and last day number
+Returns a dict of { day : value } for that zip over those days
+'''
+def zip_trend(zip, field, first_day, last_day):
+    trend = dict()
+    for month in read_months(months_between(first_day, last_day)).values():
+        trend.update(month.zip_series(zip, field))
+    return { day : trend[day] for day in sorted(trend) if first_day <= day <= last_day }
+
+'''
+Takes a region id, a metric (see metrics.columns) and a first and last day number
+Returns a dict of { day : value } for that region over those days
+'''
+def region_trend(region, metric, first_day, last_day):
+    trend = dict()
+    for month in read_months(months_between(first_day, last_day)).values():
+        trend.update(month.region_series(region, metric))
+    return { day : trend[day] for day in sorted(trend) if first_day <= day <= last_day }
+
+'''
+Takes a dict of { month name : Month }, a region id and the day being computed
+Returns the region's history for the metrics engine (see metrics.lookback) as { day : row }, taken from those months,
+or None if they don't hold all of it (e.g. the region is new, or its last row is from before the first month)
+'''
+def region_history(months, region, day):
+    days = sorted(found for month in months.values() for found in month.region_days(region) if found < day)
+    on_or_before, exactly = metrics.lookback()
+
+    wanted = dict()
+    for offset in on_or_before:
+        earlier = [found for found in days if found <= day - offset]
+        if not earlier:
+            return None
+        wanted[earlier[-1]] = None
+    for offset in exactly:
+        if day - offset in days:
+            wanted[day - offset] = None
+
+    return { found : months[month_of(found)].region_row(region, found) for found in wanted }
+
+def _encode_array(values):
+    return base64.b64encode(zlib.compress(np.ascontiguousarray(values, dtype="<f8").tobytes())).decode("ascii")
+
+def _decode_array(text, shape):
+    return np.frombuffer(zlib.decompress(base64.b64decode(text)), dtype="<f8").reshape(shape).copy()
+
+'''
+Takes part documents, the keys of their names and values, the month's length, the names stored along the last axis and the names wanted
+Returns the parts' arrays stacked into one, with its last axis in the wanted order (see _remap)
+'''
+def _decode_parts(parts, names_key, values_key, length, stored, wanted):
+    arrays = [_decode_array(part[values_key], (len(part[names_key]), length, len(stored))) for part in parts]
+    values = np.concatenate(arrays) if arrays else np.full((0, length, len(stored)), np.nan)
+    return _remap(values, stored, wanted)
+
+def _rows_per_part(length, columns):
+    return max(1, part_bytes // (length * columns * 8))
+
+'''
+Takes an array whose last axis is named by stored, and the names wanted
+Returns the array with its last axis in the wanted order (NaN for names that weren't stored)
+'''
+def _remap(values, stored, wanted):
+    if list(stored) == list(wanted):
+        return values
+    remapped = np.full(values.shape[:-1] + (len(wanted),), np.nan)
+    for index, name in enumerate(wanted):
+        if name in stored:
+            remapped[..., index] = values[..., list(stored).index(name)]
+    return remapped
+
+def _number(value):
+    if value is None or isinstance(value, bool) or not isinstance(value, (int, float)):
+        return np.nan
+    return value
+
+def _to_python(name, value):
+    if math.isnan(value) or math.isinf(value):
+        return None
+    elif name in _integers:
+        return int(round(value))
+    else:
+        return value
@@ -0,0 +1,57 @@
+'''
+Report artifacts: each region's finished report, rendered and stored by render_reports when check_safety publishes day_computed (see events.py),
+so sending a report is one batched read rather than reading the day's documents and rendering them on the critical path
+
+One document per region in the reports_collection, replaced on each render:
+    region, day, date, title, html, text
+    version: the version of the stored history it was rendered from (see check_safety's version_write)
+An artifact is current while its version matches the version document; anything else (a zip set registered since the last run,
+a render that hasn't finished, a write with no event) is left to the caller to render from the documents instead
+A region with no document yet gets no artifact, so an empty report is never stored as current
+'''
+import instrument, regions, render, storage
+
+reports_collection = regions.database_name + "-reports"
+version_collection = regions.database_name + "-meta"     # written by check_safety
+version_document = "version"
+
+'''
+Takes a region id, its latest document, the day it is for and the version of the history it was read at
+Returns the artifact for the region
+'''
+def build(region, document, day, version):
+    html, text = render.render_report(document)
+    return {
+        "region" : region,
+        "day" : day,
+        "date" : document.get("date"),
+        "title" : render.report_title(document),
+        "html" : html,
+        "text" : text,
+        "version" : version,
+    }
+
+'''
+Takes a list of artifacts, and saves them in one batched commit
+'''
+@instrument.timed("write_to_db")
+def store(artifacts):
+    storage.get_backend().set_all([(reports_collection, artifact["region"], artifact) for artifact in artifacts])
+
+'''
+Takes a list of region ids
+Returns a dict of { region id : artifact } for the regions with a current artifact, read in one batched get with the version document
+'''
+@instrument.timed("read_from_db")
+def read_current(region_ids):
+    found = storage.get_backend().get_all([(reports_collection, region) for region in region_ids] + [(version_collection, version_document)])
+    version = (found.get((version_collection, version_document)) or dict()).get("version")
+
+    current = dict()
+    for region in region_ids:
+        artifact = found.get((reports_collection, region))
+        if artifact is not None and version is not None and artifact.get("version") == version:
+            current[region] = artifact
+    instrument.count("artifacts_current", len(current))
+    instrument.count("artifacts_missing", len(region_ids) - len(current))
+    return current
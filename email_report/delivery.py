@@ -0,0 +1,241 @@
+'''
+Sending one message to many recipients through SendGrid
+
+Recipients are packed into personalizations (one per recipient, so nobody sees anyone else's address),
+personalizations_per_request at a time, and the requests are sent concurrently under a token bucket rate limit
+Requests that fail with a timeout, a connection error or a retry_statuses response are saved to the queue_collection
+and sent again by retry_queued with exponential backoff, so a 429 or a SendGrid outage doesn't lose the day's report
+retry_queued runs on its own schedule (see main.retry_deliveries) as well as at the start of each send, and claims each entry
+in a transaction before sending it, so overlapping runs never send the same entry twice
+
+SENDGRID_HOST points the client at a different server, e.g. benchmarks/fake_sendgrid.py
+SENDGRID_REQUESTS_PER_SECOND and SENDGRID_CONCURRENCY tune the rate limit and the number of requests in flight
+The sendgrid package is slow to import, so it is imported when the first client is created rather than on a cold start
+'''
+import os, random, threading, time
+from concurrent.futures import ThreadPoolExecutor
+import instrument, storage
+
+queue_collection = "is-my-town-safe-delivery-queue"
+personalizations_per_request = 1000     # the most SendGrid accepts in one request
+host_variable = "SENDGRID_HOST"
+default_host = "https://api.sendgrid.com"
+rate_variable = "SENDGRID_REQUESTS_PER_SECOND"
+default_rate = 10
+concurrency_variable = "SENDGRID_CONCURRENCY"
+default_concurrency = 4
+send_timeout = 30       # seconds for one request
+max_attempts = 6        # per request, including the first send
+backoff = 60            # seconds before the first retry, doubled for each retry after that
+max_age = 20 * 60 * 60  # seconds after which a queued message is dropped rather than sent late
+claim_seconds = 10 * 60     # how long a run has to send an entry it claimed before another run may take it over
+retry_statuses = {429, 500, 502, 503, 504}
+
+_client = None
+_client_settings = None
+_client_lock = threading.Lock()
+
+'''
+A token bucket shared by the sending threads
+rate tokens are added every second, up to burst, and each request takes one (a rate of 0 or less turns the limit off)
+'''
+class RateLimiter:
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+'''
+Returns a SendGrid client for SENDGRID_API_KEY and SENDGRID_HOST, with send_timeout on every request
+The client is created on first use and reused for the life of the process (and recreated if those variables change)
+'''
+def create_client():
+    global _client, _client_settings
+    settings = (os.environ.get('SENDGRID_API_KEY'), os.environ.get(host_variable, default_host))
+    with _client_lock:
+        if _client is None or _client_settings != settings:
+            from sendgrid import SendGridAPIClient
+            _client = SendGridAPIClient(settings[0], host=settings[1])
+            _client.client.timeout = send_timeout
+            _client_settings = settings
+        return _client
+
+'''
+Takes email addresses as a list, or as a single string separated by commas
+Returns a list of the addresses, without blanks or repeats, in the order they were given
+'''
+def parse_recipients(recipients):
+    if isinstance(recipients, str):
+        recipients = recipients.split(",")
+
+    seen = set()
+    parsed = list()
+    for address in recipients or []:
+        address = address.strip()
+        if address and address.lower() not in seen:
+            seen.add(address.lower())
+            parsed.append(address)
+    return parsed
+
+'''
+Takes the sender, a list of recipients, a subject and the HTML and plain text bodies
+Returns a list of SendGrid v3 mail/send request bodies, with at most personalizations_per_request recipients in each
+'''
+def pack(from_email, recipients, subject, html, text):
+    messages = list()
+    for start in range(0, len(recipients), personalizations_per_request):
+        messages.append({
+            "personalizations" : [{ "to" : [{ "email" : address }] } for address in recipients[start:start + personalizations_per_request]],
+            "from" : { "email" : from_email },
+            "subject" : subject,
+            "content" : [{ "type" : "text/plain", "value" : text }, { "type" : "text/html", "value" : html }],   # SendGrid wants text/plain first
+        })
+    return messages
+
+'''
+Takes the sender, recipients (see parse_recipients), a subject and the HTML and plain text bodies, and optionally a SendGrid client
+Sends the message to every recipient, queueing the requests that can be retried (see retry_queued)
+Returns { "sent", "queued", "failed" : number of recipients }
+'''
+def deliver(from_email, recipients, subject, html, text, client=None):
+    return deliver_all(from_email, [(recipients, subject, html, text)], client)
+
+'''
+Takes the sender, a list of (recipients, subject, HTML body, plain text body), and optionally a SendGrid client
+Sends each message to its recipients the same way as deliver, with the requests for every message sharing one rate limit and pool of workers
+Returns { "sent", "queued", "failed" : number of recipients }
+'''
+def deliver_all(from_email, reports, client=None):
+    messages = list()
+    for recipients, subject, html, text in reports:
+        messages.extend(pack(from_email, parse_recipients(recipients), subject, html, text))
+    results = send_all(client or create_client(), messages)
+
+    summary = { "sent" : 0, "queued" : 0, "failed" : 0 }
+    queue = list()
+    now = time.time()
+    for message, (status, error) in zip(messages, results):
+        count = len(message["personalizations"])
+        if error is None:
+            summary["sent"] += count
+        elif _retryable(status):
+            summary["queued"] += count
+            queue.append((queue_collection, os.urandom(16).hex(), { "message" : message, "attempts" : 1, "created" : now, "next_attempt" : _next_attempt(now, 1), "last_error" : error }))
+        else:
+            summary["failed"] += count
+            instrument.field("sendgrid_error", error)
+
+    if queue:
+        storage.get_backend().set_all(queue)
+    return summary
+
+'''
+Takes optionally a SendGrid client and the current time (seconds since the epoch)
+Sends every queued request that is due and that this run claims (see claim), removing the ones that are sent, rejected, too old or out of attempts
+and pushing the rest back with a longer wait
+Returns { "sent", "queued", "failed" : number of recipients }
+'''
+def retry_queued(client=None, now=None):
+    now = time.time() if now is None else now
+    backend = storage.get_backend()
+    summary = { "sent" : 0, "queued" : 0, "failed" : 0 }
+
+    due = list()
+    for name, entry in backend.get_collection(queue_collection).items():
+        if entry.get("claimed_until", 0) > now:
+            summary["queued"] += len(entry["message"]["personalizations"])     # another run is sending it
+        elif now - entry.get("created", now) > max_age:
+            summary["failed"] += len(entry["message"]["personalizations"])
+            backend.delete(queue_collection, name)
+        elif entry.get("next_attempt", 0) <= now:
+            claimed = claim(name, entry, now)
+            if claimed is not None:
+                due.append((name, claimed))
+        else:
+            summary["queued"] += len(entry["message"]["personalizations"])
+
+    if not due:
+        return summary
+
+    results = send_all(client or create_client(), [entry["message"] for name, entry in due])
+    requeue = list()
+    for (name, entry), (status, error) in zip(due, results):
+        count = len(entry["message"]["personalizations"])
+        attempts = entry["attempts"] + 1
+        if error is None:
+            summary["sent"] += count
+            backend.delete(queue_collection, name)
+        elif _retryable(status) and attempts < max_attempts:
+            summary["queued"] += count
+            requeue.append((queue_collection, name, dict(entry, attempts=attempts, next_attempt=_next_attempt(now, attempts), last_error=error, owner=None, claimed_until=0)))
+        else:
+            summary["failed"] += count
+            instrument.field("sendgrid_error", error)
+            backend.delete(queue_collection, name)
+
+    if requeue:
+        backend.set_all(requeue)
+    return summary
+
+'''
+Takes a queue entry's name, the entry as it was read and the current time
+Returns the entry as claimed by this run, or None if another run claimed it first
+The claim is a transaction on the entry's owner, so of two runs that read the same entry only one gets it
+'''
+def claim(name, entry, now):
+    claimed = dict(entry, owner=os.urandom(16).hex(), claimed_until=now + claim_seconds)
+    if storage.get_backend().set_all_if([(queue_collection, name, "owner", entry.get("owner"))], [(queue_collection, name, claimed)]):
+        return claimed
+    instrument.count("retry_claims_lost")
+    return None
+
+'''
+Takes a SendGrid client and a list of request bodies
+Returns a list of (HTTP status or None, error message or None) for each request, in the same order
+Up to SENDGRID_CONCURRENCY requests are in flight at once, started no faster than SENDGRID_REQUESTS_PER_SECOND
+'''
+@instrument.timed("send")
+def send_all(client, messages):
+    if not messages:
+        return []
+
+    limiter = RateLimiter(float(os.environ.get(rate_variable, default_rate)))
+    workers = min(int(os.environ.get(concurrency_variable, default_concurrency)), len(messages))
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        return list(executor.map(lambda message: _send(client, limiter, message), messages))
+
+def _send(client, limiter, message):
+    limiter.acquire()
+    instrument.count("sendgrid_requests")
+    try:
+        response = client.send(message)
+    except Exception as e:
+        return getattr(e, "status_code", None), "{0}".format(e)     # SendGrid's HTTPError has a status, timeouts and connection errors don't
+
+    if 200 <= response.status_code < 300:
+        return response.status_code, None
+    else:
+        return response.status_code, "HTTP {0}".format(response.status_code)
+
+def _retryable(status):
+    return status is None or status in retry_statuses
+
+def _next_attempt(now, attempts):
+    return now + backoff * 2 ** (attempts - 1) * random.uniform(0.5, 1.5)
@@ -0,0 +1,67 @@
+'''
+Pipeline events: check_safety publishes day_computed once a day's documents are written, and email_report's render_reports
+runs on it, so the reports are rendered and stored before anyone sends them
+Each function directory is deployed on its own, so this file is kept identical in check_safety and email_report
+
+EVENT_BUS picks where events go:
+    pubsub (default)   the Pub/Sub topic named by EVENTS_TOPIC (default is-my-town-safe-computed), in the project named by GOOGLE_CLOUD_PROJECT
+    local              the handlers subscribed in this process, called in order before publish returns (for running locally, tests and benchmarks)
+    off                nowhere
+A handler takes (event, context) like a Pub/Sub-triggered Cloud Function and gets the same event from either bus,
+so the one entry point serves both (see decode)
+'''
+import base64, json, os, threading
+import instrument
+
+bus_variable = "EVENT_BUS"
+topic_variable = "EVENTS_TOPIC"
+project_variable = "GOOGLE_CLOUD_PROJECT"
+default_topic = "is-my-town-safe-computed"
+publish_timeout = 30        # seconds to wait for Pub/Sub to accept a message
+
+day_computed = "day_computed"       # { "day", "date", "regions", "version" }: every region's document for that day is written
+
+_handlers = list()      # subscribed to the local bus
+_publisher = None
+_publisher_lock = threading.Lock()
+
+'''
+Takes an event type and a JSON-friendly dict, and publishes it on the bus EVENT_BUS names
+'''
+@instrument.timed("publish")
+def publish(event_type, data):
+    bus = os.environ.get(bus_variable, "pubsub").lower()
+    message = json.dumps(data).encode("utf-8")
+    if bus == "local":
+        event = { "data" : base64.b64encode(message).decode("ascii"), "attributes" : { "type" : event_type } }
+        for handler in list(_handlers):
+            handler(event, None)
+    elif bus == "pubsub":
+        publisher = _create_publisher()
+        topic = publisher.topic_path(os.environ.get(project_variable) or os.environ.get("GCP_PROJECT"), os.environ.get(topic_variable, default_topic))
+        publisher.publish(topic, message, type=event_type).result(timeout=publish_timeout)
+    elif bus != "off":
+        raise ValueError("Unknown event bus: {0}".format(bus))
+    instrument.count("events_published")
+
+'''
+Takes a handler (event, context), and calls it with every event published on the local bus in this process
+'''
+def subscribe(handler):
+    _handlers.append(handler)
+
+'''
+Takes an event, as a Pub/Sub-triggered function gets it
+Returns (event type, data dict)
+'''
+def decode(event):
+    return (event.get("attributes") or dict()).get("type"), json.loads(base64.b64decode(event["data"]))
+
+# the client is only needed on days with new data, so it is imported and created on the first publish and reused after that
+def _create_publisher():
+    global _publisher
+    with _publisher_lock:
+        if _publisher is None:
+            from google.cloud import pubsub_v1
+            _publisher = pubsub_v1.PublisherClient()
+        return _publisher
@@ -0,0 +1,152 @@
+'''
+Lightweight instrumentation: timing spans, counters and fields for one invocation, written as a single structured JSON log line when it finishes
+Each function directory is deployed on its own, so this file is kept identical in check_safety, email_report and history_api
+
+Cloud Logging reads a JSON line on stdout as a structured entry: severity and message are picked out, and everything else is searchable in jsonPayload
+Set INSTRUMENTATION=off to turn it off, which leaves a flag check in each span and counter and no log line
+Cloud Functions sends an instance one request at a time, so there is one invocation per process, shared by every thread it starts
+The first invocation in a process is marked cold_start, with the time from this module being imported to the response (roughly the function's import time plus its first run)
+'''
+import functools, json, os, threading, time
+
+enabled_variable = "INSTRUMENTATION"
+enabled = os.environ.get(enabled_variable, "on").lower() not in ("off", "0", "false", "no")
+
+_lock = threading.Lock()
+_invocation = None      # { "function", "start", "spans", "counters", "fields" } while an invocation is running
+_loaded = time.perf_counter()
+_cold = True
+
+class _Span:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exception):
+        seconds = time.perf_counter() - self.start
+        invocation = _invocation
+        if invocation is not None:
+            with _lock:
+                total = invocation["spans"].setdefault(self.name, [0, 0.0])
+                total[0] += 1
+                total[1] += seconds
+        return False
+
+class _NoSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        return False
+
+_no_span = _NoSpan()
+
+'''
+Takes a stage name
+Returns a context manager that adds the time spent inside it (and one call) to that stage's span
+'''
+def span(name):
+    if not enabled or _invocation is None:
+        return _no_span
+    return _Span(name)
+
+'''
+Takes a stage name, and decorates a function so every call to it is a span with that name
+'''
+def timed(name):
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled or _invocation is None:
+                return function(*args, **kwargs)
+            with _Span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+'''
+Takes a counter name and an amount to add to it
+'''
+def count(name, amount=1):
+    invocation = _invocation
+    if enabled and invocation is not None:
+        with _lock:
+            invocation["counters"][name] = invocation["counters"].get(name, 0) + amount
+
+'''
+Takes a field name and a JSON-friendly value to put in the log line
+'''
+def field(name, value):
+    invocation = _invocation
+    if enabled and invocation is not None:
+        with _lock:
+            invocation["fields"][name] = value
+
+'''
+Takes the name of the function being invoked, and starts collecting spans and counters for it (dropping anything from an earlier invocation)
+'''
+def start(function_name):
+    global _invocation, _cold
+    if enabled:
+        _invocation = { "function" : function_name, "start" : time.perf_counter(), "spans" : dict(), "counters" : dict(), "fields" : { "cold_start" : _cold } }
+        if _cold:
+            _invocation["fields"]["ms_before_first_invocation"] = round((_invocation["start"] - _loaded) * 1000, 3)
+        _cold = False
+
+'''
+Takes the outcome of the invocation and a Cloud Logging severity
+Prints the log line for the invocation and returns it as a dict, or returns None if instrumentation is off
+'''
+def finish(status="ok", severity="INFO"):
+    global _invocation
+    with _lock:
+        invocation, _invocation = _invocation, None
+    if not enabled or invocation is None:
+        return None
+
+    duration = (time.perf_counter() - invocation["start"]) * 1000
+    entry = {
+        "severity" : severity,
+        "message" : "{0} {1} in {2:.0f} ms".format(invocation["function"], status, duration),
+        "function" : invocation["function"],
+        "status" : status,
+        "duration_ms" : round(duration, 3),
+        "spans" : { name : { "count" : calls, "ms" : round(seconds * 1000, 3) } for name, (calls, seconds) in sorted(invocation["spans"].items()) },
+        "counters" : dict(sorted(invocation["counters"].items())),
+    }
+    entry.update(invocation["fields"])
+    if entry["cold_start"]:
+        entry["ms_to_first_response"] = round((time.perf_counter() - _loaded) * 1000, 3)
+    print(json.dumps(entry, default=str), flush=True)
+    return entry
+
+'''
+Takes the name of a function, and decorates its entry point so every call is one instrumented invocation
+An exception is logged with severity ERROR and then raised again
+An entry point called from inside another one's invocation (e.g. a handler on the local event bus, see events.py) gets a log line of its own,
+and the outer invocation carries on collecting once it returns
+'''
+def invocation(function_name):
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            global _invocation
+            outer = _invocation
+            start(function_name)
+            try:
+                result = function(*args, **kwargs)
+            except Exception as e:
+                field("error", "{0}: {1}".format(type(e).__name__, e))
+                finish("error", "ERROR")
+                _invocation = outer
+                raise
+            finish()
+            _invocation = outer
+            return result
+        return wrapper
+    return decorate
@@ -1,23 +1,23 @@
 # gcloud functions deploy email_report --entry-point email_report --trigger-http --runtime python38
-import os
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail
+# gcloud functions deploy render_reports --entry-point render_reports --trigger-topic is-my-town-safe-computed --runtime python38
+# gcloud functions deploy retry_deliveries --entry-point retry_deliveries --trigger-http --runtime python38
+# gcloud scheduler jobs create http retry-deliveries --schedule "*/5 * * * *" --uri <retry_deliveries URL>
 from datetime import date, datetime
-from google.cloud import firestore
-from flask import Flask, request
+import artifacts, delivery, events, instrument, planner, regions, render, storage, subscribers
 
 database_name = "is-my-town-safe"
+no_data_status = 503    # for a send with no document to report on yet, so the caller's retry policy tries again once check_safety has run
 
 '''
-Takes a document_name in a firestore db
-Returns a dict of the document or None if the document cannot be found
+Takes a document_name in the database (Firestore unless STORAGE_BACKEND says otherwise)
+Returns a dict of the latest document on or before that one (check_safety skips days when nothing new was published)
+or None if there isn't one
 '''
+@instrument.timed("read_from_db")
 def read_from_db(document_name):
-    db = firestore.Client()
-    doc = db.collection(database_name).document(str(document_name)).get()
-    if doc.exists:
-        doc_dict = doc.to_dict()
-        return doc_dict
+    found = storage.get_backend().latest(database_name, int(document_name))
+    if found is not None:
+        return found[1]
     else:
         return None
 
@@ -28,236 +28,56 @@ def days_since_epoch():
     return int(int(datetime.now().timestamp()) / 60 / 60 / 24)    # may be a better way to calculate this
 
 '''
-Takes a value, the amount that value changed from a previous value, and the number of days we are looking at
-Returns an HTML formatted string that is the percentage change between today's value and the previous value
-HTML color is red if there is an increase (bad outcome), green if there is a decrease (good outcome)
+Returns (HTML body, plain text body) for the default region's report on the latest document
+That is the stored artifact when it is current (see artifacts.py), or else rendered from the document,
+which is cached per document (see render.render_report)
+Returns None if there is no document yet, so an empty report is never sent (as in planner.build_reports)
 '''
-def calc_percentage(todays_data, amt_changed, num_days):
-    snippet = ""
-
-    if amt_changed is not None:
-        percent_change = amt_changed / (todays_data - amt_changed)
-        if percent_change <= 0:
-            color = "<span style=\"color:green\">"   # negative numbers mean improvement (green)
-        else:
-            color = "<span style=\"color:red\">"     # positive numbers mean worsening (red)
-        snippet += " {0}({1:+.1%} from {2} days ago)</span>".format(color, percent_change, num_days)
-
-    return snippet
-
-
 def create_body():
+    found = artifacts.read_current([regions.default_region])
+    if regions.default_region in found:
+        return found[regions.default_region]["html"], found[regions.default_region]["text"]
     todays_data = read_from_db(days_since_epoch())
-    body = ""
-    hstyle = "style=\"font-family: sans-serif; font-size: 24px; font-weight: normal; margin: 0; Margin-bottom: 15px;\""
-    pstyle = "style=\"font-family: sans-serif; font-size: 14px; font-weight: normal; margin: 0; Margin-bottom: 15px;\""
-
-    if todays_data is not None:
-        body += "<p {0}>COVID-19 data for {1}</p>\n".format(hstyle, todays_data.get("date"))
-
-        zips = ""
-        for zip in todays_data.get("zips"):
-            zips += str(zip) + ", "
-        zips = zips[:-2]        # trim the final comma and space from the list
-
-        body += "<p {0}><span style=\"color:gray\">Zip Codes Included: [{1}]</span></p>".format(pstyle, zips)
-
-
-        body += "<p {0}>Total cumulative cases: {1:,}<br>\n".format(pstyle, todays_data.get("total_cases"))
-        body += "New cases today: {0:,}\n".format(todays_data.get("new_cases"))
-        body += "</p>\n"
-
-        body += "<p {0}>Average new cases in the last 7 days: {1:,.0f}".format(pstyle, todays_data.get("7_day_avg_new_cases"))
-        body += calc_percentage(todays_data.get("7_day_avg_new_cases"), todays_data.get("7_day_change_avg_new_cases"), 7)
-        body += calc_percentage(todays_data.get("7_day_avg_new_cases"), todays_data.get("28_day_change_avg_new_cases"), 28)
-        body += "<br>\n"
-        body += "Per 100,000: {0:,.1f}\n".format(todays_data.get("7_day_avg_new_cases_per_100k"))
-        body += "</p>\n"
-        
-        '''
-        body += "<p {0}>7-day average case rate per 100,000: {1:,.1f}".format(pstyle, todays_data.get("7_day_avg_case_rate"))
-        body += calc_percentage(todays_data.get("7_day_avg_case_rate"),todays_data.get("7_day_change_avg_case_rate"),7)
-        body += calc_percentage(todays_data.get("7_day_avg_case_rate"),todays_data.get("28_day_change_avg_case_rate"),28)
-        body += "</p>\n"
-        '''
-
-        body += "<p {0}>7-day average of new positive tests: {1:.1%}".format(pstyle, todays_data.get("7_day_avg_percent_new_pos_tests"))
-        body += calc_percentage(todays_data.get("7_day_avg_percent_new_pos_tests"),todays_data.get("7_day_change_percent_new_pos"),7)
-        body += calc_percentage(todays_data.get("7_day_avg_percent_new_pos_tests"),todays_data.get("28_day_change_percent_new_pos"),28)
-        body += "</p>\n\n"
-        
-
-    body = get_pretty_email_header() + body + get_pretty_email_footer()
-    return body
-
+    if todays_data is None:
+        return None
+    return render.render_report(todays_data)
 
 '''
-Wrap the text we care about in a lot of inlined HTML
-Sourced from: https://github.com/leemunroe/responsive-html-email-template
+Runs on each event check_safety publishes (a Pub/Sub-triggered function, or a handler on the local event bus, see events.py)
+On day_computed, renders the report for every region that was computed and stores them as artifacts, so the send only fetches them
+A region with no document is left without an artifact, so it is never sent an empty report (see planner.build_reports)
 '''
-def get_pretty_email_header():
-    html_header = """
-    <!doctype html>
-    <html>
-    <head>
-        <meta name="viewport" content="width=device-width">
-        <meta http-equiv="Content-Type" content="text/html; charset=UTF-8">
-        <title>COVID-19 Report for Oakland</title>
-        <style>
-        /* -------------------------------------
-            INLINED WITH htmlemail.io/inline
-        ------------------------------------- */
-        /* -------------------------------------
-            RESPONSIVE AND MOBILE FRIENDLY STYLES
-        ------------------------------------- */
-        @media only screen and (max-width: 620px) {
-        table[class=body] h1 {
-            font-size: 28px !important;
-            margin-bottom: 10px !important;
-        }
-        table[class=body] p,
-                table[class=body] ul,
-                table[class=body] ol,
-                table[class=body] td,
-                table[class=body] span,
-                table[class=body] a {
-            font-size: 16px !important;
-        }
-        table[class=body] .wrapper,
-                table[class=body] .article {
-            padding: 10px !important;
-        }
-        table[class=body] .content {
-            padding: 0 !important;
-        }
-        table[class=body] .container {
-            padding: 0 !important;
-            width: 100% !important;
-        }
-        table[class=body] .main {
-            border-left-width: 0 !important;
-            border-radius: 0 !important;
-            border-right-width: 0 !important;
-        }
-        table[class=body] .btn table {
-            width: 100% !important;
-        }
-        table[class=body] .btn a {
-            width: 100% !important;
-        }
-        table[class=body] .img-responsive {
-            height: auto !important;
-            max-width: 100% !important;
-            width: auto !important;
-        }
-        }
-
-        /* -------------------------------------
-            PRESERVE THESE STYLES IN THE HEAD
-        ------------------------------------- */
-        @media all {
-        .ExternalClass {
-            width: 100%;
-        }
-        .ExternalClass,
-                .ExternalClass p,
-                .ExternalClass span,
-                .ExternalClass font,
-                .ExternalClass td,
-                .ExternalClass div {
-            line-height: 100%;
-        }
-        .apple-link a {
-            color: inherit !important;
-            font-family: inherit !important;
-            font-size: inherit !important;
-            font-weight: inherit !important;
-            line-height: inherit !important;
-            text-decoration: none !important;
-        }
-        #MessageViewBody a {
-            color: inherit;
-            text-decoration: none;
-            font-size: inherit;
-            font-family: inherit;
-            font-weight: inherit;
-            line-height: inherit;
-        }
-        .btn-primary table td:hover {
-            background-color: #34495e !important;
-        }
-        .btn-primary a:hover {
-            background-color: #34495e !important;
-            border-color: #34495e !important;
-        }
-        }
-        </style>
-    </head>
-    <body class="" style="background-color: #f6f6f6; font-family: sans-serif; -webkit-font-smoothing: antialiased; font-size: 14px; line-height: 1.4; margin: 0; padding: 0; -ms-text-size-adjust: 100%; -webkit-text-size-adjust: 100%;">
-        <!-- <span class="preheader" style="color: transparent; display: none; height: 0; max-height: 0; max-width: 0; opacity: 0; overflow: hidden; mso-hide: all; visibility: hidden; width: 0;">This is preheader text. Some clients will show this text as a preview.</span> -->
-        <table border="0" cellpadding="0" cellspacing="0" class="body" style="border-collapse: separate; mso-table-lspace: 0pt; mso-table-rspace: 0pt; width: 100%; background-color: #f6f6f6;">
-        <tr>
-            <td style="font-family: sans-serif; font-size: 14px; vertical-align: top;">&nbsp;</td>
-            <td class="container" style="font-family: sans-serif; font-size: 14px; vertical-align: top; display: block; Margin: 0 auto; max-width: 580px; padding: 10px; width: 580px;">
-            <div class="content" style="box-sizing: border-box; display: block; Margin: 0 auto; max-width: 580px; padding: 10px;">
-
-                <!-- START CENTERED WHITE CONTAINER -->
-                <table class="main" style="border-collapse: separate; mso-table-lspace: 0pt; mso-table-rspace: 0pt; width: 100%; background: #ffffff; border-radius: 3px;">
-                
-                <!-- START MAIN CONTENT AREA -->
-                <tr>
-                    <td class="wrapper" style="font-family: sans-serif; font-size: 14px; vertical-align: top; box-sizing: border-box; padding: 20px;">
-                    <table border="0" cellpadding="0" cellspacing="0" style="border-collapse: separate; mso-table-lspace: 0pt; mso-table-rspace: 0pt; width: 100%;">
-                        <tr>
-                        <td style="font-family: sans-serif; font-size: 14px; vertical-align: top;">
-    """
-    return html_header
-
-def get_pretty_email_footer():
-    html_footer = """
-                        </td>
-                        </tr>
-                    </table>
-                    </td>
-                </tr>
-                <!-- END MAIN CONTENT AREA -->
-                </table>
-
-                <!-- START FOOTER -->
-                <div class="footer" style="clear: both; Margin-top: 10px; text-align: center; width: 100%;">
-                <table border="0" cellpadding="0" cellspacing="0" style="border-collapse: separate; mso-table-lspace: 0pt; mso-table-rspace: 0pt; width: 100%;">
-                    <tr>
-                    <td class="content-block" style="font-family: sans-serif; vertical-align: top; padding-bottom: 10px; padding-top: 10px; font-size: 12px; color: #999999; text-align: center;">
-                        <br> Data sourced from <a href="https://covid-19.acgov.org/data" style="text-decoration: underline; color: #999999; font-size: 12px; text-align: center;">Alameda County Public Health Department</a>
-                        <br> Don't like these emails? Ask Tristan to stop sending them to you.
-                    </td>
-                    </tr>
-                    <tr>
-                    <td class="content-block powered-by" style="font-family: sans-serif; vertical-align: top; padding-bottom: 10px; padding-top: 10px; font-size: 12px; color: #999999; text-align: center;">
-                        Powered by <a href="http://htmlemail.io" style="color: #999999; font-size: 12px; text-align: center; text-decoration: none;">HTMLemail</a>.
-                    </td>
-                    </tr>
-                </table>
-                </div>
-                <!-- END FOOTER -->
+@instrument.invocation("render_reports")
+def render_reports(event, context):
+    event_type, data = events.decode(event)
+    if event_type != events.day_computed:
+        return
+    documents = planner.read_documents(data["regions"], data["day"])
+    rendered = [region for region in data["regions"] if documents[region] is not None]
+    artifacts.store([artifacts.build(region, documents[region], data["day"], data["version"]) for region in rendered])
+    instrument.field("rendered", len(rendered))
+    if len(rendered) < len(data["regions"]):
+        instrument.field("no_document", sorted(set(data["regions"]) - set(rendered)))
 
-            <!-- END CENTERED WHITE CONTAINER -->
-            </div>
-            </td>
-            <td style="font-family: sans-serif; font-size: 14px; vertical-align: top;">&nbsp;</td>
-        </tr>
-        </table>
-    </body>
-    </html>
-    """
-    return html_footer
 
+'''
+Runs every few minutes (from Cloud Scheduler), and sends anything a 429 or an outage held back that is due for another attempt (see delivery.retry_queued),
+so a queued report goes out within minutes of its backoff rather than on the next morning's send
+'''
+@instrument.invocation("retry_deliveries")
+def retry_deliveries(request):
+    summary = delivery.retry_queued()
+    instrument.field("retry_queue", summary)
+    if summary["failed"]:
+        return "SendGrid Error: {0} recipient(s) rejected".format(summary["failed"])
+    return "200"
 
 '''
 Responds to any HTTP request.
     Args:
         request (flask.Request): HTTP request object.
 '''
+@instrument.invocation("email_report")
 def email_report(request):
 
     # extract the fromEmail address and any toEmail addresses from the request
@@ -271,28 +91,34 @@ def email_report(request):
     # print("From Email: {}".format(from_temp))
 
 
+    to_temp = None
     if request_json and 'toEmails' in request_json:
         to_temp = request_json.get('toEmails')
     elif request_args and 'toEmails' in request_args:
         to_temp = request_args.get('toEmails')
     # print("To Emails: {}".format(to_temp))
 
-
-    subject = "COVID-19 Report for " + str(date.today())
-    body = create_body()
-    
-    message = Mail(
-        from_email=from_temp,
-        to_emails=to_temp,
-        subject=subject,
-        html_content=body)
-    try:
-        sg = SendGridAPIClient(os.environ.get('SENDGRID_API_KEY'))
-        response = sg.send(message)
-        print(response.status_code)
-        print(response.body)
-        print(response.headers)
-    except Exception as e:
-        return "SendGrid Error: {0}".format(e)
+    # anything a 429 or an outage held back on an earlier run goes out first
+    retried = delivery.retry_queued()
+    instrument.field("retry_queue", retried)
+
+    if to_temp:
+        # the default region's report, to the addresses in the request
+        subject = "COVID-19 Report for " + str(date.today())
+        created = create_body()
+        if created is None:
+            instrument.field("deferred", { regions.default_region : len(delivery.parse_recipients(to_temp)) })
+            return "No COVID-19 data has been saved yet, so nothing was sent", no_data_status
+        body, text_body = created
+        summary = delivery.deliver(from_temp, to_temp, subject, body, text_body)
+    else:
+        # every subscriber, with each distinct report rendered once
+        reports = planner.build_reports(subscribers.load_subscribers(), days_since_epoch(), str(date.today()))
+        instrument.field("reports", { region : len(recipients) for region, recipients, subject, body, text_body in reports })
+        summary = delivery.deliver_all(from_temp, [(recipients, subject, body, text_body) for region, recipients, subject, body, text_body in reports])
+
+    instrument.field("delivery", summary)
+    if summary["failed"]:
+        return "SendGrid Error: {0} recipient(s) rejected".format(summary["failed"])
 
     return "200"
@@ -0,0 +1,75 @@
+'''
+Planning the morning send: which report each subscriber gets, rendered once per report
+
+Subscribers are grouped by their canonical zip set, and each group is one region's report (see regions.zip_set_region),
+so thousands of subscribers over a few dozen zip sets cost a few dozen renders
+Most reports were already rendered when check_safety finished (see artifacts.py), and every group's artifact is fetched in one batched read
+For any group without a current artifact, the region documents are read together: one batched read for today (plus the small version
+document, which says which day check_safety last computed), and one more for that day when today has nothing new
+'''
+import artifacts, instrument, regions, render, storage
+
+'''
+Takes a list of subscriber documents (see subscribers.load_subscribers)
+Returns a dict of { region id : list of email addresses }
+'''
+def plan(subscribers):
+    groups = dict()
+    for subscriber in subscribers:
+        if subscriber.get("zips"):
+            region = regions.zip_set_region(subscriber["zips"])
+        else:
+            region = subscriber.get("region", regions.default_region)
+        groups.setdefault(region, []).append(subscriber["email"])
+    return groups
+
+'''
+Takes a list of region ids and a day number
+Returns a dict of { region id : the latest document on or before that day, or None }
+'''
+@instrument.timed("read_from_db")
+def read_documents(region_ids, day):
+    backend = storage.get_backend()
+    collections = { region : regions.region_collection(region) for region in region_ids }
+
+    found = backend.get_all([(collections[region], day) for region in region_ids] + [(artifacts.version_collection, artifacts.version_document)])
+    documents = { region : found.get((collections[region], str(day))) for region in region_ids }
+
+    # on a day with nothing new upstream, check_safety writes no documents, so read the last day it computed
+    computed_day = (found.get((artifacts.version_collection, artifacts.version_document)) or dict()).get("computed_day")
+    missing = [region for region in region_ids if documents[region] is None]
+    if missing and computed_day is not None and computed_day < day:
+        found = backend.get_all([(collections[region], computed_day) for region in missing])
+        for region in missing:
+            documents[region] = found.get((collections[region], str(computed_day)))
+
+    # a region that wasn't computed that day either (e.g. a zip set registered since) falls back to its own latest document
+    for region in region_ids:
+        if documents[region] is None:
+            latest = backend.latest(collections[region], day)
+            documents[region] = latest[1] if latest is not None else None
+
+    return documents
+
+'''
+Takes a list of subscriber documents, a day number and the date to show in subjects
+Returns a list of (region id, list of email addresses, subject, HTML body, plain text body), one per distinct report
+A group whose region has no document yet (a zip set registered since check_safety last ran) is left out and logged rather than sent an empty report,
+and gets its report once check_safety has computed the region
+'''
+def build_reports(subscribers, day, date):
+    groups = plan(subscribers)
+    found = artifacts.read_current(sorted(groups))
+    missing = [region for region in sorted(groups) if region not in found]
+    if missing:
+        documents = read_documents(missing, day)
+        for region in missing:
+            if documents[region] is None:
+                continue
+            html, text = render.render_report(documents[region])
+            found[region] = { "title" : render.report_title(documents[region]), "html" : html, "text" : text }
+
+    deferred = { region : len(groups[region]) for region in sorted(groups) if region not in found }
+    if deferred:
+        instrument.field("deferred", deferred)
+    return [(region, groups[region], "{0}: {1}".format(found[region]["title"], date), found[region]["html"], found[region]["text"]) for region in sorted(groups) if region in found]
@@ -0,0 +1,77 @@
+'''
+The registry of regions that check_safety reports on: a region id mapped to the list of zip codes it covers
+Each function directory is deployed on its own, so this file (and regions.json) is kept identical in check_safety, email_report and history_api
+
+Configured regions are read from regions.json next to this file, or from the file named by the REGIONS_FILE environment variable
+Subscribers can also pick their own zips (see email_report/subscribers.py): each distinct set of zips that isn't a configured region
+is registered in the zip_sets_collection as a region of its own, named by its zips (e.g. "zips-94601-94602")
+'''
+import json, os
+import storage
+
+regions_file_variable = "REGIONS_FILE"
+default_regions_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "regions.json")
+database_name = "is-my-town-safe"
+default_region = "oakland"      # its documents live in the original collection, so history from before regions existed still lines up
+zip_sets_collection = database_name + "-zip-sets"
+zip_set_prefix = "zips-"
+
+_regions = None
+
+'''
+Returns a dict of { region id : list of zip codes }, read once per process
+'''
+def load_regions():
+    global _regions
+    if _regions is None:
+        with open(os.environ.get(regions_file_variable, default_regions_file)) as regions_file:
+            _regions = { region : [int(zip) for zip in zips] for region, zips in json.load(regions_file).items() }
+    return _regions
+
+'''
+Returns a dict of { region id : list of zip codes } for the configured regions plus every registered zip set, in one read
+'''
+def all_regions():
+    region_zips = dict(load_regions())
+    for region, zip_set in sorted(storage.get_backend().get_collection(zip_sets_collection).items()):
+        region_zips.setdefault(region, canonical_zips(zip_set["zips"]))
+    return region_zips
+
+'''
+Takes zip codes, as ints or strings in any order and possibly repeated
+Returns them as a sorted list of unique ints, so the same set of zips always looks the same
+'''
+def canonical_zips(zips):
+    return sorted(set(int(zip) for zip in zips))
+
+'''
+Takes zip codes (see canonical_zips)
+Returns the id of the configured region with exactly those zips, or else the id of the zip set region for them
+'''
+def zip_set_region(zips):
+    zips = canonical_zips(zips)
+    region_zips = load_regions()
+    for region in region_zips:
+        if canonical_zips(region_zips[region]) == zips:
+            return region
+    return zip_set_prefix + "-".join(str(zip) for zip in zips)
+
+'''
+Takes a region id
+Returns the name of the collection that holds that region's daily documents
+'''
+def region_collection(region):
+    if region == default_region:
+        return database_name
+    else:
+        return database_name + "-" + region
+
+'''
+Takes a region id
+Returns the name to show for it in reports, e.g. "Oakland" or "zips 94601, 94602"
+'''
+def region_name(region):
+    if region.startswith(zip_set_prefix):
+        return "zips " + ", ".join(region[len(zip_set_prefix):].split("-"))
+    else:
+        return region.replace("-", " ").replace("_", " ").title()
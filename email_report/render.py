@@ -0,0 +1,334 @@
+'''
+Rendering the email report: an HTML body and a plain text alternative from one day's document
+The templates are built once per process, and rendered reports are cached by document (see cache_key),
+so repeated or concurrent sends of the same day render it once
+'''
+import hashlib, json, threading
+from collections import OrderedDict
+from html import escape
+import instrument, regions
+
+cache_size = 32     # rendered reports kept per process
+
+hstyle = "style=\"font-family: sans-serif; font-size: 24px; font-weight: normal; margin: 0; Margin-bottom: 15px;\""
+pstyle = "style=\"font-family: sans-serif; font-size: 14px; font-weight: normal; margin: 0; Margin-bottom: 15px;\""
+
+'''
+Wrap the text we care about in a lot of inlined HTML
+Sourced from: https://github.com/leemunroe/responsive-html-email-template
+'''
+html_header = """
+    <!doctype html>
+    <html>
+    <head>
+        <meta name="viewport" content="width=device-width">
+        <meta http-equiv="Content-Type" content="text/html; charset=UTF-8">
+        <title>COVID-19 Report for Oakland</title>
+        <style>
+        /* -------------------------------------
+            INLINED WITH htmlemail.io/inline
+        ------------------------------------- */
+        /* -------------------------------------
+            RESPONSIVE AND MOBILE FRIENDLY STYLES
+        ------------------------------------- */
+        @media only screen and (max-width: 620px) {
+        table[class=body] h1 {
+            font-size: 28px !important;
+            margin-bottom: 10px !important;
+        }
+        table[class=body] p,
+                table[class=body] ul,
+                table[class=body] ol,
+                table[class=body] td,
+                table[class=body] span,
+                table[class=body] a {
+            font-size: 16px !important;
+        }
+        table[class=body] .wrapper,
+                table[class=body] .article {
+            padding: 10px !important;
+        }
+        table[class=body] .content {
+            padding: 0 !important;
+        }
+        table[class=body] .container {
+            padding: 0 !important;
+            width: 100% !important;
+        }
+        table[class=body] .main {
+            border-left-width: 0 !important;
+            border-radius: 0 !important;
+            border-right-width: 0 !important;
+        }
+        table[class=body] .btn table {
+            width: 100% !important;
+        }
+        table[class=body] .btn a {
+            width: 100% !important;
+        }
+        table[class=body] .img-responsive {
+            height: auto !important;
+            max-width: 100% !important;
+            width: auto !important;
+        }
+        }
+
+        /* -------------------------------------
+            PRESERVE THESE STYLES IN THE HEAD
+        ------------------------------------- */
+        @media all {
+        .ExternalClass {
+            width: 100%;
+        }
+        .ExternalClass,
+                .ExternalClass p,
+                .ExternalClass span,
+                .ExternalClass font,
+                .ExternalClass td,
+                .ExternalClass div {
+            line-height: 100%;
+        }
+        .apple-link a {
+            color: inherit !important;
+            font-family: inherit !important;
+            font-size: inherit !important;
+            font-weight: inherit !important;
+            line-height: inherit !important;
+            text-decoration: none !important;
+        }
+        #MessageViewBody a {
+            color: inherit;
+            text-decoration: none;
+            font-size: inherit;
+            font-family: inherit;
+            font-weight: inherit;
+            line-height: inherit;
+        }
+        .btn-primary table td:hover {
+            background-color: #34495e !important;
+        }
+        .btn-primary a:hover {
+            background-color: #34495e !important;
+            border-color: #34495e !important;
+        }
+        }
+        </style>
+    </head>
+    <body class="" style="background-color: #f6f6f6; font-family: sans-serif; -webkit-font-smoothing: antialiased; font-size: 14px; line-height: 1.4; margin: 0; padding: 0; -ms-text-size-adjust: 100%; -webkit-text-size-adjust: 100%;">
+        <!-- <span class="preheader" style="color: transparent; display: none; height: 0; max-height: 0; max-width: 0; opacity: 0; overflow: hidden; mso-hide: all; visibility: hidden; width: 0;">This is preheader text. Some clients will show this text as a preview.</span> -->
+        <table border="0" cellpadding="0" cellspacing="0" class="body" style="border-collapse: separate; mso-table-lspace: 0pt; mso-table-rspace: 0pt; width: 100%; background-color: #f6f6f6;">
+        <tr>
+            <td style="font-family: sans-serif; font-size: 14px; vertical-align: top;">&nbsp;</td>
+            <td class="container" style="font-family: sans-serif; font-size: 14px; vertical-align: top; display: block; Margin: 0 auto; max-width: 580px; padding: 10px; width: 580px;">
+            <div class="content" style="box-sizing: border-box; display: block; Margin: 0 auto; max-width: 580px; padding: 10px;">
+
+                <!-- START CENTERED WHITE CONTAINER -->
+                <table class="main" style="border-collapse: separate; mso-table-lspace: 0pt; mso-table-rspace: 0pt; width: 100%; background: #ffffff; border-radius: 3px;">
+                
+                <!-- START MAIN CONTENT AREA -->
+                <tr>
+                    <td class="wrapper" style="font-family: sans-serif; font-size: 14px; vertical-align: top; box-sizing: border-box; padding: 20px;">
+                    <table border="0" cellpadding="0" cellspacing="0" style="border-collapse: separate; mso-table-lspace: 0pt; mso-table-rspace: 0pt; width: 100%;">
+                        <tr>
+                        <td style="font-family: sans-serif; font-size: 14px; vertical-align: top;">
+    """
+
+html_footer = """
+                        </td>
+                        </tr>
+                    </table>
+                    </td>
+                </tr>
+                <!-- END MAIN CONTENT AREA -->
+                </table>
+
+                <!-- START FOOTER -->
+                <div class="footer" style="clear: both; Margin-top: 10px; text-align: center; width: 100%;">
+                <table border="0" cellpadding="0" cellspacing="0" style="border-collapse: separate; mso-table-lspace: 0pt; mso-table-rspace: 0pt; width: 100%;">
+                    <tr>
+                    <td class="content-block" style="font-family: sans-serif; vertical-align: top; padding-bottom: 10px; padding-top: 10px; font-size: 12px; color: #999999; text-align: center;">
+                        <br> Data sourced from <a href="https://covid-19.acgov.org/data" style="text-decoration: underline; color: #999999; font-size: 12px; text-align: center;">Alameda County Public Health Department</a>
+                        <br> Don't like these emails? Ask Tristan to stop sending them to you.
+                    </td>
+                    </tr>
+                    <tr>
+                    <td class="content-block powered-by" style="font-family: sans-serif; vertical-align: top; padding-bottom: 10px; padding-top: 10px; font-size: 12px; color: #999999; text-align: center;">
+                        Powered by <a href="http://htmlemail.io" style="color: #999999; font-size: 12px; text-align: center; text-decoration: none;">HTMLemail</a>.
+                    </td>
+                    </tr>
+                </table>
+                </div>
+                <!-- END FOOTER -->
+
+            <!-- END CENTERED WHITE CONTAINER -->
+            </div>
+            </td>
+            <td style="font-family: sans-serif; font-size: 14px; vertical-align: top;">&nbsp;</td>
+        </tr>
+        </table>
+    </body>
+    </html>
+    """
+
+# the styles are filled in here, once, so rendering is a single format call
+html_body = (
+    "<p " + hstyle + ">COVID-19 data for {date}</p>\n"
+    "<p " + pstyle + "><span style=\"color:gray\">Zip Codes Included: [{zips}]</span></p>"
+    "<p " + pstyle + ">Total cumulative cases: {total_cases}<br>\n"
+    "New cases today: {new_cases}\n"
+    "</p>\n"
+    "<p " + pstyle + ">Average new cases in the last 7 days: {avg_new_cases}{avg_new_cases_7_html}{avg_new_cases_28_html}<br>\n"
+    "Per 100,000: {avg_new_cases_per_100k}\n"
+    "</p>\n"
+    "<p " + pstyle + ">7-day average of new positive tests: {avg_new_pos}{avg_new_pos_7_html}{avg_new_pos_28_html}</p>\n\n"
+)
+
+text_body = (
+    "COVID-19 data for {date}\n"
+    "Zip Codes Included: [{zips}]\n"
+    "\n"
+    "Total cumulative cases: {total_cases}\n"
+    "New cases today: {new_cases}\n"
+    "\n"
+    "Average new cases in the last 7 days: {avg_new_cases}{avg_new_cases_7_text}{avg_new_cases_28_text}\n"
+    "Per 100,000: {avg_new_cases_per_100k}\n"
+    "\n"
+    "7-day average of new positive tests: {avg_new_pos}{avg_new_pos_7_text}{avg_new_pos_28_text}\n"
+)
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+_rendering = dict()     # a lock per report being rendered, so concurrent callers wait for one render instead of each doing it
+
+'''
+Takes a day's document (or None)
+Returns (HTML body, plain text body), rendered once per document and then served from the cache
+'''
+@instrument.timed("render")
+def render_report(document):
+    key = cache_key(document)
+
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            instrument.count("render_cache_hits")
+            return _cache[key]
+        key_lock = _rendering.setdefault(key, threading.Lock())
+
+    with key_lock:
+        with _cache_lock:
+            if key in _cache:
+                instrument.count("render_cache_hits")
+                return _cache[key]
+
+        instrument.count("render_cache_misses")
+        report = (render_html(document), render_text(document))
+
+        with _cache_lock:
+            _cache[key] = report
+            while len(_cache) > cache_size:
+                _cache.popitem(last=False)
+            _rendering.pop(key, None)
+
+    return report
+
+'''
+Takes a day's document (or None)
+Returns the key it is cached under: its region, date and the time check_safety last wrote it,
+or a hash of its contents for documents written before they had an "updated" time
+'''
+def cache_key(document):
+    if document is None:
+        return None
+    elif document.get("updated") is not None:
+        return (document.get("region"), document.get("date"), document.get("updated"))
+    else:
+        return hashlib.sha1(json.dumps(document, sort_keys=True, default=str).encode()).hexdigest()
+
+def render_html(document):
+    body = ""
+    if document is not None:
+        body = html_body.format(**_fields(document, html=True))
+    return _header(report_title(document)) + body + html_footer
+
+'''
+Takes a day's document (or None)
+Returns the title of its report, e.g. "COVID-19 Report for Oakland", from the region the document covers
+'''
+def report_title(document):
+    region = regions.default_region
+    if document is not None and document.get("region"):
+        region = document["region"]
+    return "COVID-19 Report for " + regions.region_name(region)
+
+def _header(title):
+    return html_header.replace("<title>COVID-19 Report for Oakland</title>", "<title>" + escape(title) + "</title>", 1)
+
+def render_text(document):
+    if document is not None:
+        return text_body.format(**_fields(document, html=False))
+    else:
+        return "No COVID-19 data has been saved yet.\n"
+
+'''
+Takes a value, the amount that value changed from a previous value, and the number of days we are looking at
+Returns an HTML formatted string that is the percentage change between today's value and the previous value
+HTML color is red if there is an increase (bad outcome), green if there is a decrease (good outcome)
+'''
+def calc_percentage(todays_data, amt_changed, num_days):
+    percent_change = _percent_change(todays_data, amt_changed)
+    if percent_change is None:
+        return ""
+
+    if percent_change <= 0:
+        color = "<span style=\"color:green\">"   # negative numbers mean improvement (green)
+    else:
+        color = "<span style=\"color:red\">"     # positive numbers mean worsening (red)
+    return " {0}({1:+.1%} from {2} days ago)</span>".format(color, percent_change, num_days)
+
+'''
+The plain text version of calc_percentage
+'''
+def calc_percentage_text(todays_data, amt_changed, num_days):
+    percent_change = _percent_change(todays_data, amt_changed)
+    if percent_change is None:
+        return ""
+    return " ({0:+.1%} from {1} days ago)".format(percent_change, num_days)
+
+def _percent_change(todays_data, amt_changed):
+    if amt_changed is None or todays_data is None or todays_data == amt_changed:
+        return None
+    return amt_changed / (todays_data - amt_changed)
+
+'''
+Takes a value and a format spec
+Returns the formatted value, or "n/a" if there is no value (e.g. new cases on the first day)
+'''
+def _format(value, spec):
+    if value is None:
+        return "n/a"
+    return format(value, spec)
+
+'''
+Takes a day's document and whether the fields are for the HTML or plain text body
+Returns the dict of fields for the body template, with each percentage change worked out once
+'''
+def _fields(document, html):
+    percentage = calc_percentage if html else calc_percentage_text
+    suffix = "_html" if html else "_text"
+    avg_new_cases = document.get("7_day_avg_new_cases")
+    avg_new_pos = document.get("7_day_avg_percent_new_pos_tests")
+
+    return {
+        "date" : document.get("date"),
+        "zips" : ", ".join(str(zip) for zip in document.get("zips", [])),
+        "total_cases" : _format(document.get("total_cases"), ","),
+        "new_cases" : _format(document.get("new_cases"), ","),
+        "avg_new_cases" : _format(avg_new_cases, ",.0f"),
+        "avg_new_cases_7" + suffix : percentage(avg_new_cases, document.get("7_day_change_avg_new_cases"), 7),
+        "avg_new_cases_28" + suffix : percentage(avg_new_cases, document.get("28_day_change_avg_new_cases"), 28),
+        "avg_new_cases_per_100k" : _format(document.get("7_day_avg_new_cases_per_100k"), ",.1f"),
+        "avg_new_pos" : _format(avg_new_pos, ".1%"),
+        "avg_new_pos_7" + suffix : percentage(avg_new_pos, document.get("7_day_change_percent_new_pos"), 7),
+        "avg_new_pos_28" + suffix : percentage(avg_new_pos, document.get("28_day_change_percent_new_pos"), 28),
+    }
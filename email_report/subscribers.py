@@ -0,0 +1,90 @@
+'''
+The subscriber registry: one document per email address, in the subscribers_collection, holding the zips that subscriber wants reported
+A subscriber picks either a configured region or their own zips, and a set of zips that isn't a configured region
+is registered as a zip set region (see regions.py), so check_safety computes a document for it on its next run
+
+From email_report/:
+    python subscribers.py add someone@example.com oakland
+    python subscribers.py add someone@example.com 94601 94602
+    python subscribers.py remove someone@example.com
+    python subscribers.py list
+    python subscribers.py prune     # removes every zip set no subscriber has (e.g. left from before remove did it)
+'''
+import instrument, regions, storage
+
+subscribers_collection = regions.database_name + "-subscribers"
+
+'''
+Takes an email address and either a region id or a list of zip codes
+Saves the subscriber (replacing any earlier choice) and registers their zip set if it is new
+Returns the id of the region they will be sent
+'''
+def subscribe(email, zips=None, region=None):
+    if region is not None:
+        if region not in regions.load_regions():
+            raise ValueError("Unknown region: {0}".format(region))
+        zips = regions.load_regions()[region]
+    if not zips:
+        raise ValueError("A subscriber needs a region or at least one zip code")
+
+    zips = regions.canonical_zips(zips)
+    region = regions.zip_set_region(zips)
+    writes = [(subscribers_collection, _document_name(email), { "email" : email.strip(), "zips" : zips, "region" : region })]
+    if region not in regions.load_regions():
+        writes.append((regions.zip_sets_collection, region, { "zips" : zips }))
+
+    storage.get_backend().set_all(writes)
+    return region
+
+'''
+Takes an email address
+Removes that subscriber, if they exist, and their zip set if no other subscriber has it, so check_safety stops computing it
+'''
+def unsubscribe(email):
+    backend = storage.get_backend()
+    subscriber = backend.get(subscribers_collection, _document_name(email))
+    if subscriber is None:
+        return
+    backend.delete(subscribers_collection, _document_name(email))
+    if subscriber["region"] not in regions.load_regions() and all(other["region"] != subscriber["region"] for other in load_subscribers()):
+        backend.delete(regions.zip_sets_collection, subscriber["region"])
+
+'''
+Removes every registered zip set that no subscriber has
+Returns a sorted list of the zip set regions it removed
+'''
+def prune_zip_sets():
+    backend = storage.get_backend()
+    used = set(subscriber["region"] for subscriber in load_subscribers())
+    unused = sorted(region for region in backend.get_collection(regions.zip_sets_collection) if region not in used)
+    for region in unused:
+        backend.delete(regions.zip_sets_collection, region)
+    return unused
+
+'''
+Returns a list of every subscriber document: { "email", "zips", "region" }
+'''
+@instrument.timed("read_from_db")
+def load_subscribers():
+    return list(storage.get_backend().get_collection(subscribers_collection).values())
+
+def _document_name(email):
+    return email.strip().lower()
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) >= 4 and sys.argv[1] == "add":
+        if len(sys.argv) == 4 and not sys.argv[3].isdigit():
+            print(subscribe(sys.argv[2], region=sys.argv[3]))
+        else:
+            print(subscribe(sys.argv[2], zips=sys.argv[3:]))
+    elif len(sys.argv) == 3 and sys.argv[1] == "remove":
+        unsubscribe(sys.argv[2])
+    elif sys.argv[1:] == ["prune"]:
+        for region in prune_zip_sets():
+            print("Removed", region)
+    elif sys.argv[1:] == ["list"]:
+        for subscriber in sorted(load_subscribers(), key=lambda subscriber: subscriber["email"].lower()):
+            print(subscriber["email"], subscriber["region"], subscriber["zips"])
+    else:
+        print("Usage: python subscribers.py add EMAIL REGION | add EMAIL ZIP [ZIP ...] | remove EMAIL | list | prune")
@@ -0,0 +1,191 @@
+# gcloud functions deploy history_api --entry-point history_api --trigger-http --runtime python38
+'''
+A read-only HTTP API over the stored history: any metrics for a region over a range of dates, as JSON or CSV
+
+    GET ?region=oakland&metrics=case_rate_per_100k,7_day_avg_new_cases&from=2020-10-01&to=2020-10-31&format=csv
+
+    region    a configured region id or a zip set region id (default oakland)
+    metrics   comma-separated names from metrics.columns (default every metric but the running totals)
+    from, to  dates (YYYY-MM-DD), inclusive (default the 30 days up to today)
+    format    json (default) or csv
+
+A range is read from the monthly time series (see timeseries.py), one batched get for every month it covers; days from before the
+monthly documents existed are read from the region's daily documents, in one range query
+Responses are cached in the instance, keyed by (region, metrics, range, format), along with the version of the stored history they were read at.
+check_safety gives the history a new version in the same commit as every write (see version_collection), and this reads that version at most
+once every HISTORY_API_VERSION_TTL seconds (default 60), so a dashboard polling the same range costs no reads in between and one read after
+Every response has an ETag made from the version and the query, so a client sending If-None-Match gets a 304 until the next write
+'''
+import csv, hashlib, io, json, os, time
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+import instrument, metrics, regions, storage, timeseries
+
+database_name = regions.database_name
+version_collection = database_name + "-meta"     # written by check_safety
+version_document = "version"
+
+version_ttl_variable = "HISTORY_API_VERSION_TTL"
+cache_size_variable = "HISTORY_API_CACHE_SIZE"
+version_ttl = float(os.environ.get(version_ttl_variable, 60))
+cache_size = int(os.environ.get(cache_size_variable, 256))
+default_days = 30
+max_days = 731      # two years of days in one response
+default_metrics = [column for column in metrics.columns if not column.startswith("prefix_")]
+formats = { "json" : "application/json", "csv" : "text/csv; charset=utf-8" }
+
+_version = (None, None)     # (time.monotonic() when read, version), shared by every request this instance serves
+_responses = OrderedDict()      # { query : (version, body) }, least recently used first
+
+'''
+Returns the version of the stored history: re-read from the version document once its TTL has passed, or else the one already read
+A database that check_safety hasn't written to yet has the version "none"
+'''
+def current_version():
+    global _version
+    read_at, version = _version
+    now = time.monotonic()
+    if read_at is None or now - read_at >= version_ttl:
+        document = storage.get_backend().get(version_collection, version_document)
+        version = document["version"] if document is not None else "none"
+        _version = (now, version)
+    return version
+
+'''
+Takes a region id and a first and last day number
+Returns a dict of { day : { metric : value } } for every day in that range that has a document for the region, in order
+'''
+@instrument.timed("read_from_db")
+def read_range(region, first_day, last_day):
+    rows = dict()
+    for month in timeseries.read_months(timeseries.months_between(first_day, last_day)).values():
+        for day in month.region_days(region):
+            if first_day <= day <= last_day:
+                rows[day] = month.region_row(region, day)
+
+    # the monthly documents start with the first run that wrote them (or the migration), so anything earlier is in the daily documents
+    before = min(rows) - 1 if rows else last_day
+    if first_day <= before:
+        for day, document in storage.get_backend().scan(regions.region_collection(region), first_day, before).items():
+            rows[day] = { column : document.get(column) for column in metrics.columns }
+
+    return { day : rows[day] for day in sorted(rows) }
+
+'''
+Takes a region id, a list of metrics, a first and last day number, a format and the rows from read_range
+Returns the response body in that format
+'''
+@instrument.timed("render")
+def render(region, metric_names, first_day, last_day, output_format, rows):
+    if output_format == "csv":
+        output = io.StringIO()
+        writer = csv.writer(output, lineterminator="\n")
+        writer.writerow(["date"] + list(metric_names))
+        for day in rows:
+            writer.writerow([day_to_date(day)] + ["" if rows[day].get(metric) is None else rows[day][metric] for metric in metric_names])
+        return output.getvalue()
+
+    return json.dumps({
+        "region" : region,
+        "name" : regions.region_name(region),
+        "from" : day_to_date(first_day),
+        "to" : day_to_date(last_day),
+        "metrics" : list(metric_names),
+        "days" : [dict([("date", day_to_date(day))] + [(metric, rows[day].get(metric)) for metric in metric_names]) for day in rows],
+    })
+
+'''
+Takes the request's arguments
+Returns (region, tuple of metrics, first day, last day, format), which is also the key for the response cache, or raises ValueError with a message for the client
+'''
+def parse_query(args):
+    region = args.get("region") or regions.default_region
+    if region not in regions.load_regions() and not region.startswith(regions.zip_set_prefix):
+        raise ValueError("Unknown region: {0}".format(region))
+
+    metric_names = tuple(metric.strip() for metric in args.get("metrics", "").split(",") if metric.strip()) or tuple(default_metrics)
+    unknown = [metric for metric in metric_names if metric not in metrics.column_index]
+    if unknown:
+        raise ValueError("Unknown metrics: {0}".format(", ".join(unknown)))
+
+    try:
+        last_day = date_to_day(args["to"]) if args.get("to") else days_since_epoch()
+        first_day = date_to_day(args["from"]) if args.get("from") else last_day - default_days + 1
+    except ValueError:
+        raise ValueError("Dates must be YYYY-MM-DD")
+    if first_day > last_day or last_day - first_day + 1 > max_days:
+        raise ValueError("The range must be from one to {0} days".format(max_days))
+
+    output_format = args.get("format", "json").lower()
+    if output_format not in formats:
+        raise ValueError("Unknown format: {0} (use json or csv)".format(output_format))
+
+    return region, metric_names, first_day, last_day, output_format
+
+'''
+Takes a version of the history and a query (see parse_query)
+Returns its ETag, the same in every instance
+'''
+def etag(version, query):
+    return '"{0}"'.format(hashlib.sha256(json.dumps([version, query]).encode("utf-8")).hexdigest()[:32])
+
+'''
+Takes the ETag of a response and the request's If-None-Match header
+Returns True if the client already has that response
+'''
+def not_modified(tag, if_none_match):
+    if not if_none_match:
+        return False
+    return any(candidate.strip() in (tag, "W/" + tag, "*") for candidate in if_none_match.split(","))
+
+'''
+Returns the number of days since 1970-01-01, using the current time and local timezone
+'''
+def days_since_epoch():
+    return int(int(datetime.now().timestamp()) / 60 / 60 / 24)
+
+def date_to_day(text):
+    return (date.fromisoformat(text) - date(1970, 1, 1)).days
+
+def day_to_date(day):
+    return str(date(1970, 1, 1) + timedelta(days=day))
+
+'''
+Responds to any HTTP request.
+    Args:
+        request (flask.Request): HTTP request object.
+    Returns (body, status, headers)
+'''
+@instrument.invocation("history_api")
+def history_api(request):
+    try:
+        query = parse_query(request.args)
+    except ValueError as e:
+        instrument.field("error", str(e))
+        return str(e), 400, { "Content-Type" : "text/plain; charset=utf-8" }
+    instrument.field("query", query)
+
+    version = current_version()
+    tag = etag(version, query)
+    headers = { "ETag" : tag, "Cache-Control" : "public, max-age={0:.0f}".format(version_ttl), "Content-Type" : formats[query[4]] }
+
+    if not_modified(tag, request.headers.get("If-None-Match")):
+        instrument.count("not_modified")
+        return "", 304, headers
+
+    cached = _responses.get(query)
+    if cached is not None and cached[0] == version:
+        instrument.count("response_cache_hits")
+        _responses.move_to_end(query)
+        return cached[1], 200, headers
+
+    instrument.count("response_cache_misses")
+    region, metric_names, first_day, last_day, output_format = query
+    body = render(region, metric_names, first_day, last_day, output_format, read_range(region, first_day, last_day))
+
+    _responses[query] = (version, body)
+    _responses.move_to_end(query)
+    while len(_responses) > cache_size:
+        _responses.popitem(last=False)
+
+    return body, 200, headers
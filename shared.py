@@ -0,0 +1,49 @@
+'''
+Files shared between the function directories
+Each function directory is deployed on its own, so every directory that uses a shared file has its own copy of it,
+and check_safety's copy is the one the others are made from. Run this from the repository's root before deploying:
+    python shared.py check      # lists every copy that differs from check_safety's, and exits with 1 if any does
+    python shared.py sync       # copies check_safety's version over every copy that differs
+'''
+import filecmp, os, shutil, sys
+
+repository_directory = os.path.dirname(os.path.abspath(__file__))
+source_directory = "check_safety"
+
+# { file : the other directories with a copy of it }
+shared_files = {
+    "storage.py" : ["email_report", "history_api"],
+    "instrument.py" : ["email_report", "history_api"],
+    "regions.py" : ["email_report", "history_api"],
+    "regions.json" : ["email_report", "history_api"],       # email_report maps subscribers to the regions check_safety computes from this
+    "metrics.py" : ["history_api"],
+    "timeseries.py" : ["history_api"],
+    "events.py" : ["email_report"],
+}
+
+'''
+Returns a list of (check_safety's path, the path of a copy that differs from it or is missing), relative to the repository
+'''
+def differing_copies():
+    differing = list()
+    for name, directories in shared_files.items():
+        source = os.path.join(source_directory, name)
+        for directory in directories:
+            copy = os.path.join(directory, name)
+            if not os.path.exists(os.path.join(repository_directory, copy)) \
+                    or not filecmp.cmp(os.path.join(repository_directory, source), os.path.join(repository_directory, copy), shallow=False):
+                differing.append((source, copy))
+    return differing
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["check"]:
+        differing = differing_copies()
+        for source, copy in differing:
+            print(copy, "differs from", source)
+        sys.exit(1 if differing else 0)
+    elif sys.argv[1:] == ["sync"]:
+        for source, copy in differing_copies():
+            shutil.copyfile(os.path.join(repository_directory, source), os.path.join(repository_directory, copy))
+            print("Copied", source, "to", copy)
+    else:
+        print("Usage: python shared.py check | sync")